@@ -19,7 +19,17 @@ from intrinsic.util import triu_to_square
 from pettingzoo.sisl import waterworld_v4
 
 
+def _node_reward(r, states, spatial_dims):
+    # a scalar reward, or one reward per batched copy, broadcast over the spatial dims of a node.
+    r = torch.as_tensor(r, dtype=states.dtype, device=states.device)
+    return r.view(r.shape + (1,) * spatial_dims)
+
+
 class WaterworldAgent:
+    # encoder and decoder parameters, in the order they lead parameters().
+    _head_names = ("input_encoder", "input_encoder_bias", "value_decoder", "value_decoder_bias", "policy_decoder",
+                   "policy_decoder_bias")
+
     def __init__(self, input_channels=2, num_nodes=4, channels=3, spatial=5, kernel=3, sensors=20, action_dim=2, epsilon=0,
                  device="cpu", *args, **kwargs):
         """
@@ -42,10 +52,24 @@ class WaterworldAgent:
         self.version = 0
         self.input_channels = input_channels
         self.input_size = sensors * 5 + 2
-        self.core_model = Intrinsic(num_nodes, node_shape=(1, channels, spatial, spatial), kernel_size=kernel)
+        self.core_model = self._build_core(num_nodes, kernel)
+        self._build_heads()
+        # contiguous parameter and gradient vectors, once flatten has been called.
+        self.flat = None
+        self.flat_grad = None
+
+        self.v_loss = None
+        self.p_loss = None
+
+    def _build_core(self, num_nodes, kernel):
+        # subclasses with a different core override this, so the base core is never built and thrown away.
+        return Intrinsic(num_nodes, node_shape=(1, self.channels, self.spatial, self.spatial), kernel_size=kernel)
 
+    def _build_heads(self):
+        device = self.device
         # transform inputs to core model space
-        input_encoder = torch.empty((self.input_size, self.spatial * self.spatial * input_channels), device=device)
+        input_encoder = torch.empty((self.input_size, self.spatial * self.spatial * self.input_channels),
+                                    device=device)
         input_encoder = torch.nn.init.xavier_normal_(input_encoder)
         self.input_encoder = torch.nn.Parameter(input_encoder)
 
@@ -63,15 +87,26 @@ class WaterworldAgent:
 
         self.input_encoder_bias = torch.nn.Parameter(torch.zeros((1,), device=self.device) + .001)
 
-        self.v_loss = None
-        self.p_loss = None
+    def empty_like(self):
+        """
+        Agent with this agent's configuration and fresh bookkeeping (id, version, fitness, losses), built without
+        constructing or initializing any model. The core model and heads still reference this agent's and are expected
+        to be replaced, as clone and EvoController.multiclone do.
+        """
+        new_agent = copy.copy(self)
+        new_agent.id = randomname.get_name()
+        new_agent.debug = False
+        new_agent.generation = 0.
+        new_agent.fitness = 0.
+        new_agent.version = 0
+        new_agent.v_loss = None
+        new_agent.p_loss = None
+        new_agent.flat = None
+        new_agent.flat_grad = None
+        return new_agent
 
     def clone(self, fuzzy=True, set_dev=None):
-        new_agent = type(self)(num_nodes=self.core_model.num_nodes,
-                                    channels=self.channels, spatial=self.spatial,
-                                    kernel=self.core_model.edge.kernel_size, sensors=self.num_sensors,
-                                    action_dim=self.action_dim,
-                                    device=self.device, input_channels=self.input_channels)
+        new_agent = self.empty_like()
         if set_dev is None:
             set_dev = self.device
         if not fuzzy:
@@ -80,35 +115,30 @@ class WaterworldAgent:
             new_agent.fitness = self.fitness
             new_agent.v_loss = self.v_loss
             new_agent.p_loss = self.p_loss
-        new_agent.epsilon = self.epsilon
 
         with torch.no_grad():
             new_core = self.core_model.clone(fuzzy=fuzzy, device=set_dev)
             new_agent.core_model = new_core
-            new_agent.policy_decoder = torch.nn.Parameter(self.policy_decoder.detach().to(set_dev))
-            new_agent.value_decoder = torch.nn.Parameter(self.value_decoder.detach().to(set_dev))
-            new_agent.input_encoder = torch.nn.Parameter(self.input_encoder.detach().to(set_dev))
-            new_agent.policy_decoder_bias = torch.nn.Parameter(self.policy_decoder_bias.detach().to(set_dev))
-            new_agent.value_decoder_bias = torch.nn.Parameter(self.value_decoder_bias.detach().to(set_dev))
-            new_agent.input_encoder_bias = torch.nn.Parameter(self.input_encoder_bias.detach().to(set_dev))
+            new_agent.policy_decoder = torch.nn.Parameter(self.policy_decoder.detach().to(set_dev, copy=True))
+            new_agent.value_decoder = torch.nn.Parameter(self.value_decoder.detach().to(set_dev, copy=True))
+            new_agent.input_encoder = torch.nn.Parameter(self.input_encoder.detach().to(set_dev, copy=True))
+            new_agent.policy_decoder_bias = torch.nn.Parameter(self.policy_decoder_bias.detach().to(set_dev,
+                                                                                                     copy=True))
+            new_agent.value_decoder_bias = torch.nn.Parameter(self.value_decoder_bias.detach().to(set_dev, copy=True))
+            new_agent.input_encoder_bias = torch.nn.Parameter(self.input_encoder_bias.detach().to(set_dev, copy=True))
         return new_agent
 
-    def instantiate(self):
-        new_agent = type(self)(num_nodes=self.core_model.num_nodes,
-                                    channels=self.channels, spatial=self.spatial,
-                                    kernel=self.core_model.edge.kernel_size, sensors=self.num_sensors,
-                                    action_dim=self.action_dim,
-                                    device=self.device, input_channels=self.input_channels)
-        new_core = self.core_model.instantiate()
-        new_agent.core_model = new_core
-        new_agent.policy_decoder = self.policy_decoder.clone()
-        new_agent.value_decoder = self.value_decoder.clone()
-        new_agent.input_encoder = self.input_encoder.clone()
-        new_agent.policy_decoder_bias = self.policy_decoder_bias.clone()
-        new_agent.value_decoder_bias = self.value_decoder_bias.clone()
-        new_agent.input_encoder_bias = self.input_encoder_bias.clone()
-        new_agent.epsilon = self.epsilon
-        new_agent.id = self.id
+    def instantiate(self, instances=None):
+        """
+        Copy of the agent for one episode. The encoder, decoders and core parameters are shared with this agent, so
+        losses of the copy backpropagate straight into it, only the core model's dynamic state belongs to the copy.
+        :param instances: Number of copies batched in the returned agent, its forward then takes (instances, ...)
+                          observations. None for a single copy.
+        """
+        new_agent = copy.copy(self)
+        new_agent.core_model = self.core_model.instantiate(instances=instances)
+        new_agent.v_loss = None
+        new_agent.p_loss = None
         return new_agent
 
     def detach(self):
@@ -155,23 +185,85 @@ class WaterworldAgent:
         plt.plot(loss_hist)
         plt.show()
 
+    def named_parameters(self):
+        """
+        :return: list of (name, parameter), the heads then the core model's parameters prefixed with "core_model.".
+        """
+        return [(name, getattr(self, name)) for name in self._head_names] + \
+               [("core_model." + name, p) for name, p in self.core_model.named_parameters()]
+
     def parameters(self):
-        agent_heads = [self.input_encoder, self.input_encoder_bias, self.value_decoder,
-                       self.value_decoder_bias, self.policy_decoder, self.policy_decoder_bias] + self.core_model.parameters()
-        return agent_heads
+        return [p for _, p in self.named_parameters()]
 
     def set_grad(self, grad):
-        # MUST BE IN SAME ORDER AS PARAMETERS (BAD PRACTICE BUT LAZY)
-        self.policy_decoder_bias.grad = grad[5]
-        self.policy_decoder.grad = grad[4]
+        # in the order of parameters
+        for p, g in zip(self.parameters(), grad):
+            p.grad = g
+
+    def set_parameters(self, params):
+        # same order as parameters, the core model is replaced in place so instantiate it first to keep the original.
+        heads = len(self._head_names)
+        for name, p in zip(self._head_names, params[:heads]):
+            setattr(self, name, p)
+        self.core_model.set_parameters(params[heads:])
+        return self
 
-        self.value_decoder_bias.grad = grad[3]
-        self.value_decoder.grad = grad[2]
+    def flatten(self, flat=None, grad=None):
+        """
+        Backs every parameter with one contiguous vector, self.flat, and every gradient with self.flat_grad, so they
+        are moved, accumulated, blended and saved as single tensors. Each parameter stays a leaf that is a view of the
+        vector, autograd accumulates into its view of flat_grad in place. Replacing a parameter afterwards (clone,
+        to, ...) leaves an agent that needs flattening again.
+        :param flat: optional vector to use as storage, e.g. a slot of shared memory, already holding the parameters in
+                     the order of parameters(). By default the current values are copied into a new vector.
+        :param grad: optional vector like flat to use as gradient storage, it is zeroed.
+        :return: self
+        """
+        params = self.parameters()
+        if len({p.dtype for p in params}) > 1:
+            raise ValueError("Flattening requires all parameters to have the same dtype.")
+        if flat is None:
+            with torch.no_grad():
+                flat = torch.cat([p.detach().reshape(-1) for p in params])
+        sizes = [p.numel() for p in params]
+        views = []
+        for v, p in zip(flat.split(sizes), params):
+            v = v.view(p.shape)
+            # tensors that are not optimized stay plain tensors.
+            views.append(torch.nn.Parameter(v) if p.requires_grad else v)
+        if grad is None:
+            grad = torch.zeros_like(flat)
+        else:
+            grad.zero_()
+        self.flat = flat
+        self.flat_grad = grad
+        self.set_parameters(views)
+        self._bind_grad()
+        return self
 
-        self.input_encoder_bias.grad = grad[1]
-        self.input_encoder.grad = grad[0]
+    def _bind_grad(self):
+        params = self.parameters()
+        for p, g in zip(params, self.flat_grad.split([p.numel() for p in params])):
+            if p.requires_grad:
+                p.grad = g.view(p.shape)
 
-        self.core_model.set_grad(grad[6:])
+    def set_flat_grad(self, grad):
+        """
+        Sets the gradient of a flattened agent from one vector.
+        :param grad: vector like self.flat, or a scalar.
+        """
+        with torch.no_grad():
+            self.flat_grad.copy_(grad)
+        # optimizers may have dropped the views when zeroing gradients.
+        self._bind_grad()
+
+    def __setstate__(self, state):
+        # gradients are not pickled, views of flat_grad are rebound on arrival.
+        state.setdefault("flat", None)
+        state.setdefault("flat_grad", None)
+        self.__dict__.update(state)
+        if self.flat is not None:
+            self._bind_grad()
 
     def __eq__(self, other):
         return hash(self)
@@ -184,28 +276,30 @@ class WaterworldAgent:
 
     def forward(self, X, r=None):
         """
-        :param X: Agent Sensor Data
-        :param r: instant reward form last state
+        :param X: Agent Sensor Data, (copies, sensors) for an agent instantiated with batched copies
+        :param r: instant reward form last state, a scalar or one per copy
         :return: Mu, Sigma, Value - the mean and variance of the action distribution, and the state value estimate
         """
         # create a state matrix for injection into core from input observation
-        encoded_input = ((X + self.input_encoder_bias) @ self.input_encoder).view(self.input_channels, self.spatial, self.spatial)
+        batch = X.shape[:-1]
+        encoded_input = ((X + self.input_encoder_bias) @ self.input_encoder).view(
+            batch + (self.input_channels, self.spatial, self.spatial))
         in_states = torch.zeros_like(self.core_model.states)
         mask = in_states.bool()
-        mask[0, :self.input_channels, :, :] = True
+        mask[..., 0, :self.input_channels, :, :] = True
         # in_states[0, :self.input_channels, :, :] = .25 * in_states[0, :self.input_channels, :, :] + .75 * encoded_input
-        in_states[0, :self.input_channels, :, :] = encoded_input
+        in_states[..., 0, :self.input_channels, :, :] = encoded_input
         if r is not None:
-            in_states[2, 0, :, :] = r
+            in_states[..., 2, 0, :, :] = _node_reward(r, in_states, 2)
         # run a model time step
         for i in range(1):
             out_states = self.core_model(in_states, mask)
         # compute next action and value estimates
-        action_params = (out_states[1, 0, :, :].flatten() + self.policy_decoder_bias) @ self.policy_decoder
-        value_est = (out_states[3, 0, :, :].flatten() + self.value_decoder_bias) @ self.value_decoder
+        action_params = (out_states[..., 1, 0, :, :].flatten(-2) + self.policy_decoder_bias) @ self.policy_decoder
+        value_est = (out_states[..., 3, 0, :, :].flatten(-2) + self.value_decoder_bias) @ self.value_decoder
         act_fxn = torch.nn.Softplus()
-        c1 = act_fxn((action_params[0:2])) + 1.0
-        c2 = act_fxn(action_params[2:]) + 1.0
+        c1 = act_fxn((action_params[..., 0:2])) + 1.0
+        c2 = act_fxn(action_params[..., 2:]) + 1.0
         return c1, c2, value_est
 
 
@@ -218,38 +312,48 @@ class DisjointWaterWorldAgent(WaterworldAgent):
 
     def forward(self, X, r=None):
         """
-        :param X: Agent Sensor Data
-        :param r: instant reward form last state
+        :param X: Agent Sensor Data, (copies, sensors) for an agent instantiated with batched copies
+        :param r: instant reward form last state, a scalar or one per copy
         :return: Mu, Sigma, Value - the mean and variance of the action distribution, and the state value estimate
         """
         # create a state matrix for injection into core from input observation
-        encoded_input = ((X + self.input_encoder_bias) @ self.input_encoder).view(self.input_channels, self.spatial, self.spatial)
+        batch = X.shape[:-1]
+        encoded_input = ((X + self.input_encoder_bias) @ self.input_encoder).view(
+            batch + (self.input_channels, self.spatial, self.spatial))
         in_states = torch.zeros_like(self.core_model.states)
         mask = in_states.bool()
-        mask[0, :self.input_channels, :, :] = True
+        mask[..., 0, :self.input_channels, :, :] = True
         # in_states[0, :self.input_channels, :, :] = .25 * in_states[0, :self.input_channels, :, :] + .75 * encoded_input
-        in_states[0, :self.input_channels, :, :] = encoded_input
+        in_states[..., 0, :self.input_channels, :, :] = encoded_input
         if r is not None:
-            in_states[2, 0, :, :] = r
+            in_states[..., 2, 0, :, :] = _node_reward(r, in_states, 2)
         # run a model time step
         for i in range(1):
             out_states = self.core_model(in_states, mask)
         # compute next action and value estimates
-        action_params = (out_states[1, 0, :, :].flatten() + self.policy_decoder_bias) @ self.policy_decoder
-        value_est = ((X + self.value_decoder_bias) @ self.value_decoder).flatten(0) # out_states[2, 0, :, :].flatten() @ self.value_decoder
-        c1 = torch.exp(action_params[0:2]) + .1
-        c2 = torch.exp(action_params[2:]) + .1
+        action_params = (out_states[..., 1, 0, :, :].flatten(-2) + self.policy_decoder_bias) @ self.policy_decoder
+        value_est = (X + self.value_decoder_bias) @ self.value_decoder # out_states[2, 0, :, :].flatten() @ self.value_decoder
+        c1 = torch.exp(action_params[..., 0:2]) + .1
+        c2 = torch.exp(action_params[..., 2:]) + .1
         return c1, c2, value_est
 
 
 class FCWaterworldAgent(WaterworldAgent):
 
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        # the heads depend on the decode node, so it is set before they are built.
         if "decode_node" in kwargs:
             self.decode_node = kwargs["decode_node"]
         else:
             self.decode_node = 2
+        super().__init__(*args, **kwargs)
+        self.kernel_size = None
+
+    def _build_core(self, num_nodes, kernel):
+        return FCIntrinsic(num_nodes=4, node_shape=(1, self.channels, self.spatial), inject_noise=True,
+                           device=self.device)
+
+    def _build_heads(self):
         if self.decode_node is None:
             self.value_decoder = torch.empty((self.input_size, 1), device=self.device)
             self.value_decoder = torch.nn.Parameter(torch.nn.init.xavier_normal_(self.value_decoder))
@@ -267,102 +371,42 @@ class FCWaterworldAgent(WaterworldAgent):
         self.input_encoder = torch.nn.Parameter(input_encoder)
         self.input_encoder_bias = torch.nn.Parameter(torch.zeros((1,), device=self.device) + .001)
 
-        self.core_model = FCIntrinsic(num_nodes=4, node_shape=(1, self.channels, self.spatial), inject_noise=True,
-                                      device=self.device)
-        self.kernel_size = None
-
-    def parameters(self):
-        agent_heads = [self.input_encoder, self.input_encoder_bias, self.value_decoder,
-                       self.value_decoder_bias, self.policy_decoder, self.policy_decoder_bias] + self.core_model.parameters()
-        return agent_heads
-
-    def set_grad(self, grad):
-        # MUST BE IN SAME ORDER AS PARAMETERS (BAD PRACTICE BUT LAZY)
-        self.policy_decoder_bias.grad = grad[5]
-        self.policy_decoder.grad = grad[4]
-
-        self.value_decoder_bias.grad = grad[3]
-        self.value_decoder.grad = grad[2]
-
-        self.input_encoder_bias.grad = grad[1]
-        self.input_encoder.grad = grad[0]
-
-        self.core_model.set_grad(grad[6:])
 
     def forward(self, X, r=None):
         """
-        :param X: Agent Sensor Data
-        :param r: instant reward form last state
+        :param X: Agent Sensor Data, (copies, sensors) for an agent instantiated with batched copies
+        :param r: instant reward form last state, a scalar or one per copy
         :return: Mu, Sigma, Value - the mean and variance of the action distribution, and the state value estimate
         """
         X = X.to(self.device)
         # create a state matrix for injection into core from input observation
-        encoded_input = ((X + self.input_encoder_bias) @ self.input_encoder).view(self.spatial, self.input_channels).transpose(0, 1)
+        batch = X.shape[:-1]
+        encoded_input = ((X + self.input_encoder_bias) @ self.input_encoder).view(
+            batch + (self.spatial, self.input_channels)).transpose(-1, -2)
         in_states = torch.zeros_like(self.core_model.states)
         mask = in_states.bool()
-        mask[0, :self.input_channels, :] = True
+        mask[..., 0, :self.input_channels, :] = True
         # in_states[0, :self.input_channels, :, :] = .25 * in_states[0, :self.input_channels, :, :] + .75 * encoded_input
-        in_states[0, :self.input_channels, :] = encoded_input
+        in_states[..., 0, :self.input_channels, :] = encoded_input
         if r is not None:
-            in_states[3, 0, :] = r
+            in_states[..., 3, 0, :] = _node_reward(r, in_states, 1)
         # run a model time step
         for i in range(1):
             out_states = self.core_model(in_states, mask)
         # compute next action and value estimates
-        action_params = out_states[1, 0, :].flatten() @ self.policy_decoder + self.policy_decoder_bias
+        action_params = out_states[..., 1, 0, :] @ self.policy_decoder + self.policy_decoder_bias
         if self.decode_node is None:
-            critic_in = X.flatten().double()
+            critic_in = X.double()
         else:
-            critic_in = out_states[self.decode_node, 0, :].flatten()
-        value_est = (torch.concat((critic_in.detach(), X), dim=0) @ self.value_decoder).flatten() + self.value_decoder_bias # out_states[2, 0, :, :].flatten() @ self.value_decoder
+            critic_in = out_states[..., self.decode_node, 0, :]
+        value_est = (torch.concat((critic_in.detach(), X), dim=-1) @ self.value_decoder) + self.value_decoder_bias # out_states[2, 0, :, :].flatten() @ self.value_decoder
         if self.debug:
             value_est.register_hook(lambda grad: print("Grad Val Est", torch.abs(grad).sum()))
         act_fxn = torch.square
-        c1 = act_fxn(action_params[0:2]) + 1.0
-        c2 = act_fxn(action_params[2:]) + 1.0
+        c1 = act_fxn(action_params[..., 0:2]) + 1.0
+        c2 = act_fxn(action_params[..., 2:]) + 1.0
         return c1, c2, value_est
 
-    def clone(self, fuzzy=True):
-        new_agent = FCWaterworldAgent(num_nodes=self.core_model.num_nodes,
-                                    channels=self.channels, spatial=self.spatial, sensors=self.num_sensors,
-                                    action_dim=self.action_dim,
-                                    device=self.device, input_channels=self.input_channels, decode_node=self.decode_node)
-        if not fuzzy:
-            new_agent.id = self.id
-            new_agent.version = self.version
-            new_agent.fitness = self.fitness
-            new_agent.v_loss = self.v_loss
-            new_agent.p_loss = self.p_loss
-        new_agent.epsilon = self.epsilon
-
-        with torch.no_grad():
-            new_core = self.core_model.clone(fuzzy=fuzzy)
-            new_agent.core_model = new_core
-            new_agent.policy_decoder = torch.nn.Parameter(self.policy_decoder.detach().clone())
-            new_agent.value_decoder = torch.nn.Parameter(self.value_decoder.detach().clone())
-            new_agent.input_encoder = torch.nn.Parameter(self.input_encoder.detach().clone())
-            new_agent.policy_decoder_bias = torch.nn.Parameter(self.policy_decoder_bias.detach().clone())
-            new_agent.value_decoder_bias = torch.nn.Parameter(self.value_decoder_bias.detach().clone())
-            new_agent.input_encoder_bias = torch.nn.Parameter(self.input_encoder_bias.detach().clone())
-        return new_agent
-
-    def instantiate(self):
-        new_agent = FCWaterworldAgent(num_nodes=self.core_model.num_nodes,
-                                    channels=self.channels, spatial=self.spatial, sensors=self.num_sensors,
-                                    action_dim=self.action_dim,
-                                    device=self.device, input_channels=self.input_channels, decode_node=self.decode_node)
-        new_core = self.core_model.instantiate()
-        new_agent.core_model = new_core
-        new_agent.policy_decoder = self.policy_decoder.clone()
-        new_agent.value_decoder = self.value_decoder.clone()
-        new_agent.input_encoder = self.input_encoder.clone()
-        new_agent.policy_decoder_bias = self.policy_decoder_bias.clone()
-        new_agent.value_decoder_bias = self.value_decoder_bias.clone()
-        new_agent.input_encoder_bias = self.input_encoder_bias.clone()
-        new_agent.epsilon = self.epsilon
-        new_agent.id = self.id
-        return new_agent
-
     def pretrain_agent_input(self, epochs, obs_data, use_channels=True):
         batch_size = 250
         channels = self.input_channels
@@ -2,7 +2,6 @@ import math
 import os.path
 import pickle
 import random
-import networkx
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -10,13 +9,12 @@ import randomname
 
 import numpy as np
 import torch
-torch.set_default_dtype(torch.float64)
 from torch.multiprocessing import Queue, Process, Pipe
 from collections import deque
 
 from agent.agents import WaterworldAgent, DisjointWaterWorldAgent, FCWaterworldAgent
 from agent.reward_functions import Reinforce, ActorCritic
-from agent.exist import local_evolve, episode
+from agent.exist import local_evolve, episode, WorkerPool, ParameterArena
 from scipy.ndimage import uniform_filter1d
 
 
@@ -60,12 +58,266 @@ class _pseudo_queue(deque):
         pass
 
 
+class PopulationAdam:
+    """
+    Adam over a population of flattened agents. The parameters, gradients and moments of every agent are rows of
+    (capacity, size) matrices and each agent is flattened onto its rows, so one step updates all agents with fresh
+    gradients in a handful of batched ops, whatever the population size. Every agent has its own learning rate and
+    step count. Rows are handed out from a free list, adding and removing agents is O(1), and the matrices double
+    when they are full.
+    """
+
+    def __init__(self, template, capacity=8, betas=(.9, .999), eps=1e-8):
+        """
+        :param template: flattened agent with the parameter layout of the population.
+        :param capacity: initial number of rows.
+        :param betas: Adam decay rates of the gradient moments.
+        :param eps: Adam denominator term.
+        """
+        self.size = template.flat.numel()
+        self.dtype = template.flat.dtype
+        self.device = template.flat.device
+        self.betas = betas
+        self.eps = eps
+        self.rows = {}
+        self.agents = {}
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        kwargs = {"dtype": self.dtype, "device": self.device}
+        self.params = torch.zeros((capacity, self.size), **kwargs)
+        self.grads = torch.zeros((capacity, self.size), **kwargs)
+        self.exp_avg = torch.zeros((capacity, self.size), **kwargs)
+        self.exp_avg_sq = torch.zeros((capacity, self.size), **kwargs)
+        self.lr = torch.zeros((capacity,), **kwargs)
+        self.steps = torch.zeros((capacity,), **kwargs)
+        self.free = list(reversed(range(capacity)))
+
+    def _grow(self):
+        old = (self.params, self.grads, self.exp_avg, self.exp_avg_sq, self.lr, self.steps)
+        capacity = len(self.lr)
+        self._allocate(2 * capacity)
+        for new, prev in zip((self.params, self.grads, self.exp_avg, self.exp_avg_sq, self.lr, self.steps), old):
+            new[:capacity] = prev
+        self.free = [r for r in self.free if r >= capacity]
+        for aid, row in self.rows.items():
+            # keep the gradients, flatten zeroes its storage.
+            grad = self.grads[row].clone()
+            self.agents[aid].flatten(self.params[row], self.grads[row])
+            self.grads[row] = grad
+
+    def __contains__(self, agent_id):
+        return agent_id in self.rows
+
+    def add(self, agent, lr):
+        """
+        Moves the agent onto a free row with fresh moments.
+        :param agent: flattened agent, its parameters and gradients become views of the population matrices.
+        :param lr: learning rate of the agent.
+        """
+        if agent.id in self.rows:
+            raise ValueError("Agent " + str(agent.id) + " is already in the population.")
+        if len(self.free) == 0:
+            self._grow()
+        row = self.free.pop()
+        with torch.no_grad():
+            self.params[row] = agent.flat
+            self.exp_avg[row] = 0.
+            self.exp_avg_sq[row] = 0.
+            self.lr[row] = lr
+            self.steps[row] = 0.
+        agent.flatten(self.params[row], self.grads[row])
+        self.rows[agent.id] = row
+        self.agents[agent.id] = agent
+
+    def remove(self, agent_id):
+        """
+        Frees the agent's row. The agent keeps views of the row, so it should no longer be used.
+        """
+        self.free.append(self.rows.pop(agent_id))
+        self.agents.pop(agent_id)
+
+    def smooth_grad(self, agent_ids, grads, keep=.4):
+        """
+        Sets each agent's gradient to an exponential average of the gradients it was given.
+        :param agent_ids: ids of the agents.
+        :param grads: (agents, size) new gradients.
+        :param keep: weight of the previous gradient.
+        """
+        rows = torch.tensor([self.rows[aid] for aid in agent_ids], device=self.device)
+        with torch.no_grad():
+            self.grads[rows] = keep * self.grads[rows] + (1 - keep) * grads.to(self.dtype)
+
+    def step(self, agent_ids):
+        """
+        One Adam step of the given agents, with the gradients in their rows.
+        :param agent_ids: ids of the agents with fresh gradients.
+        """
+        if len(agent_ids) == 0:
+            return
+        beta1, beta2 = self.betas
+        rows = torch.tensor([self.rows[aid] for aid in agent_ids], device=self.device)
+        with torch.no_grad():
+            grad = self.grads[rows]
+            exp_avg = self.exp_avg[rows].mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq = self.exp_avg_sq[rows].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            steps = self.steps[rows] + 1
+            step_size = (self.lr[rows] / (1 - beta1 ** steps)).unsqueeze(1)
+            denom = (exp_avg_sq.sqrt() / torch.sqrt(1 - beta2 ** steps).unsqueeze(1)).add_(self.eps)
+            self.params[rows] = self.params[rows] - step_size * exp_avg / denom
+            self.exp_avg[rows] = exp_avg
+            self.exp_avg_sq[rows] = exp_avg_sq
+            self.steps[rows] = steps
+
+
+class LineageStore:
+    """
+    Append only record of every agent of a run, its parents and its metric history, kept in a few NumPy columns that
+    pickle quickly however long the run. Agents get integer indices in order of registration. Each agent keeps its
+    last `window` entries of each metric in a ring buffer along with running sums of the copy weighted values, so the
+    windowed score of _compute_loss_values costs O(1) per agent.
+    """
+    metrics = ("fitness", "vloss", "ploss")
+
+    def __init__(self, window=30, capacity=64):
+        """
+        :param window: number of entries a score is computed over.
+        :param capacity: initial number of agents, the columns double when full.
+        """
+        self.window = window
+        # agent id -> index of its latest registration, and index -> agent id.
+        self.index = {}
+        self.ids = []
+        # (child, parent) index pairs.
+        self.edges = np.zeros((2 * capacity, 2), dtype=np.int64)
+        self.num_edges = 0
+        self.values = np.zeros((capacity, len(self.metrics), window))
+        self.copies = np.zeros((capacity, window))
+        # number of entries ever appended and total copies over the whole history.
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.copy_total = np.zeros(capacity)
+        # sums over the window of copies * value, NaN values left out, and of copies.
+        self.weighted = np.zeros((capacity, len(self.metrics)))
+        self.copy_sum = np.zeros(capacity)
+
+    def __contains__(self, agent_id):
+        return agent_id in self.index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _grow(self, columns, size):
+        for name in columns:
+            old = getattr(self, name)
+            new = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, agent_id, parents=()):
+        """
+        Registers an agent with an empty history. An id that was seen before starts over under a new index.
+        :param agent_id: id of the agent.
+        :param parents: ids of its parents.
+        :return: integer index of the agent.
+        """
+        idx = len(self.ids)
+        if idx == len(self.count):
+            self._grow(("values", "copies", "count", "copy_total", "weighted", "copy_sum"), max(2 * idx, 1))
+        for p in set(parents):
+            self._link(idx, self.index[p])
+        self.ids.append(agent_id)
+        self.index[agent_id] = idx
+        return idx
+
+    def _link(self, child, parent):
+        if self.num_edges == len(self.edges):
+            self._grow(("edges",), max(2 * len(self.edges), 1))
+        self.edges[self.num_edges] = (child, parent)
+        self.num_edges += 1
+
+    def append(self, agent_id, copies, **metrics):
+        """
+        Adds one entry to the agent's history, the oldest entry of a full window drops out of its sums.
+        :param agent_id: id of the agent.
+        :param copies: weight of the entry, the number of copies it was measured over.
+        :param metrics: value of each metric in LineageStore.metrics, None is recorded as NaN.
+        """
+        idx = self.index[agent_id]
+        pos = self.count[idx] % self.window
+        value = np.array([np.nan if metrics[m] is None else metrics[m] for m in self.metrics], dtype=float)
+        if self.count[idx] >= self.window:
+            # the entry overwritten at pos drops out of the window.
+            self.weighted[idx] -= np.nan_to_num(self.values[idx, :, pos] * self.copies[idx, pos])
+            self.copy_sum[idx] -= self.copies[idx, pos]
+        self.values[idx, :, pos] = value
+        self.copies[idx, pos] = copies
+        self.weighted[idx] += np.nan_to_num(value * copies)
+        self.copy_sum[idx] += copies
+        self.count[idx] += 1
+        self.copy_total[idx] += copies
+        if pos == self.window - 1:
+            # once per pass over the ring the sums are recomputed, so rounding error does not build up.
+            self.weighted[idx] = np.nansum(self.values[idx] * self.copies[idx], axis=1)
+            self.copy_sum[idx] = np.sum(self.copies[idx])
+
+    def score(self, agent_id, metric):
+        """
+        Copy weighted sum over the last window entries of a metric, scaled down while the window is filling. Same
+        value as _compute_loss_values(history, copies, window).
+        """
+        idx = self.index[agent_id]
+        start = min(self.count[idx], self.window)
+        if start == 0 or self.copy_sum[idx] == 0:
+            return 0.
+        return self.weighted[idx, self.metrics.index(metric)] / self.copy_sum[idx] * (start / self.window)
+
+    def mean_copies(self, agent_id):
+        """
+        :return: mean copies over the agent's whole history.
+        """
+        idx = self.index[agent_id]
+        if self.count[idx] == 0:
+            return np.nan
+        return self.copy_total[idx] / self.count[idx]
+
+    def parents(self, agent_id):
+        """
+        :return: ids of the agent's parents.
+        """
+        edges = self.edges[:self.num_edges]
+        return [self.ids[p] for p in edges[edges[:, 0] == self.index[agent_id], 1]]
+
+    def children(self, agent_id):
+        """
+        :return: ids of the agent's children.
+        """
+        edges = self.edges[:self.num_edges]
+        return [self.ids[c] for c in edges[edges[:, 1] == self.index[agent_id], 0]]
+
+    @classmethod
+    def from_tree(cls, tree, window=30):
+        """
+        Converts the networkx evo tree of older snapshots.
+        """
+        store = cls(window=window, capacity=max(len(tree.nodes), 1))
+        for aid, data in tree.nodes(data=True):
+            store.add(aid)
+            for i in range(len(data["fitness"])):
+                store.append(aid, data["copies"][i], fitness=data["fitness"][i], vloss=data["vloss"][i],
+                             ploss=data["ploss"][i])
+        for parent, child in tree.edges:
+            store._link(store.index[child], store.index[parent])
+        return store
+
+
 class EvoController:
     def __init__(self, seed_agent, epochs=10, num_base=4,
                  min_gen=10, max_gen=30, min_agents=3, max_agents=8,
                  log_min_lr=-13., log_max_lr=-8., num_workers=6, worker_device="cpu", viz=True,
-                 algo="a3c", start_epsilon=1.0, inverse_eps_decay=4000):
+                 algo="a3c", start_epsilon=1.0, inverse_eps_decay=4000, debug=False):
         self.num_base = num_base
+        # whether to report per update diagnostics that read tensors back from the device.
+        self.debug = debug
         self.start_base = num_base
         self.log_min_lr = log_min_lr
         self.log_max_lr = log_max_lr
@@ -94,15 +346,16 @@ class EvoController:
 
         self.num_workers = num_workers
         self.sensors = seed_agent[0].num_sensors
-        self.base_agent = [a.clone(fuzzy=False) for a in seed_agent]
-        self.optimizers = {}
-        self.last_grad = {a.id: [0. for _ in a.parameters()] for a in self.base_agent}
+        # base agents keep their parameters and gradients in one vector each.
+        self.base_agent = [a.clone(fuzzy=False).flatten() for a in seed_agent]
+        # one optimizer for the whole population, agents are added with their own learning rate.
+        self.optimizer = PopulationAdam(self.base_agent[0], capacity=2 * max(num_base, len(self.base_agent)))
         self.worker_device = worker_device
         self.device = seed_agent[0].device
         self.num_integrations = 0
-        self.evo_tree = networkx.DiGraph()
+        self.lineage = LineageStore()
         for a in self.base_agent:
-            self.evo_tree.add_node(a.id, fitness=[], vloss=[], ploss=[], copies=[], entropy=[])
+            self.lineage.add(a.id)
         self.value_loss_hist = []
         self.policy_loss_hist = []
         self.fitness_hist = []
@@ -120,7 +373,15 @@ class EvoController:
             self.axs[2].set_ylim((-.05, .2))
             plt.show()
 
-    def spawn_worker(self, integration_q, pid, mp=True):
+    def _worker_job(self, arena=None):
+        """
+        Prepares one epoch of work: copies of the chosen base agents with their exploration epsilon, the number of
+        copies and generations, and the reward function with its running statistics.
+        :param arena: optional ParameterArena, the base agents are then checked out of it as metadata instead of
+                      copied, and a gradient slot is reserved for the job.
+        :return: local_evolve arguments from generations to critic_random_only, with an arena preceded by the
+                 gradient slot.
+        """
         for i in range(len(self.base_agent)):
             self._add_optimizer_set(self.base_agent[i])
         num_gens = random.randint(self.min_gen, self.max_gen)
@@ -136,12 +397,16 @@ class EvoController:
         # set max base agents, will lose 1 every (decay / 3) epochs
         self.num_base = max(math.ceil(2 * self.decay * self.full_count + self.start_base), 2)
         for i in use_base_idx:
-            a = self.base_agent[i].clone(fuzzy=False)
             force_explore = random.random()
             if random.random() < 0.0 and force_explore > local_eps:
-                a.epsilon = force_explore * .8
+                epsilon = force_explore * .8
+            else:
+                epsilon = local_eps + (random.random() * .02)
+            if arena is None:
+                a = self.base_agent[i].clone(fuzzy=False)
+                a.epsilon = epsilon
             else:
-                a.epsilon = local_eps + (random.random() * .02)
+                a = arena.checkout(self.base_agent[i], epsilon)
             use_base.append(a)
         if self.algo == "a3c" and (self.full_count < 0):
             train_critic = True
@@ -151,56 +416,44 @@ class EvoController:
             train_actor = True
 
 
-        print("OPTIM:", num_gens, "generations,", num_agents, "agents of types:", [a.id for a in use_base])
+        print("OPTIM:", num_gens, "generations,", num_agents, "agents of types:",
+              [self.base_agent[i].id for i in use_base_idx])
         train_critic_random_only = False
+        job = (num_gens, use_base, copies.tolist(), self.reward_function, train_actor, train_critic,
+               train_critic_random_only)
+        if arena is not None:
+            job = (arena.gradient_slot(),) + job
+        return job
+
+    def spawn_worker(self, integration_q, pid, mp=True):
+        job = self._worker_job()
         if mp:
             recv, sender = Pipe(duplex=False)
-            p = Process(target=local_evolve,
-                        args=(integration_q, recv, num_gens, use_base, copies.tolist(), self.reward_function, train_actor,
-                              train_critic, train_critic_random_only, pid, self.worker_device))
+            p = Process(target=local_evolve, args=(integration_q, recv) + job + (pid, self.worker_device))
 
             return p, sender
         else:
-            local_evolve(integration_q, None, num_gens, use_base, copies.tolist(), self.reward_function, train_actor,
-                         train_critic, train_critic_random_only, pid, self.worker_device)
+            local_evolve(integration_q, None, *job, pid, self.worker_device)
             return None, None
 
     def multiclone(self, agent1, agent2, equal=False):
-        try:
-            decode_node = agent1.decode_node
-        except AttributeError:
-            decode_node = 2
-        new_agent = self.agent_class(num_nodes=agent1.core_model.num_nodes,
-                                    channels=agent1.channels, spatial=agent1.spatial,
-                                    kernel=agent1.core_model.edge.kernel_size, sensors=agent1.num_sensors,
-                                    action_dim=agent1.action_dim,
-                                    device=agent1.device, input_channels=agent1.input_channels, decode_node=decode_node)
+        # the child is built from agent1 without initializing a model, its heads are agent1's until flattened below.
+        new_agent = agent1.empty_like()
+        new_agent.epsilon = 0
         with torch.no_grad():
             if equal:
-                new_core_1 = agent1.core_model.clone(fuzzy=True)
+                new_agent.core_model = agent1.core_model.clone(fuzzy=True)
                 lincomb = .5
             else:
-                new_core_1 = agent1.core_model.clone(fuzzy=False)
+                new_agent.core_model = agent1.core_model.clone(fuzzy=False)
                 lincomb = random.random() * 2
-            new_core_1.edge.chan_map = torch.nn.Parameter((1 - lincomb) * new_core_1.edge.chan_map.detach() +
-                                                          lincomb * agent2.core_model.edge.chan_map.detach())
-            new_core_1.edge.init_weight = torch.nn.Parameter((1 - lincomb) * new_core_1.edge.init_weight.detach() +
-                                                             lincomb * agent2.core_model.edge.init_weight.detach())
-            new_core_1.edge.plasticity = torch.nn.Parameter((1 - lincomb) * new_core_1.edge.plasticity.detach() +
-                                                            lincomb * agent2.core_model.edge.plasticity.detach())
-            new_core_1.resistance = torch.nn.Parameter((1 - lincomb) * new_core_1.resistance.detach() +
-                                                            lincomb * agent2.core_model.resistance.detach())
-
-            new_agent.core_model = new_core_1
-
-            new_agent.policy_decoder = torch.nn.Parameter((1 - lincomb) * agent1.policy_decoder.detach().clone()
-                                                          + (lincomb) * agent2.policy_decoder.detach().clone())
-            new_agent.value_decoder = torch.nn.Parameter((1 - lincomb) * agent1.value_decoder.detach().clone()
-                                                         + (lincomb) * agent2.value_decoder.detach().clone())
-            new_agent.input_encoder = torch.nn.Parameter((1 - lincomb) * agent1.input_encoder.detach().clone()
-                                                         + (lincomb) * agent2.input_encoder.detach().clone())
-        new_agent.id = randomname.get_name()
-        new_agent.version = 0
+            # copies agent1's heads and the new core into the child's own vector, then blends in agent2 at once.
+            new_agent.flatten()
+            new_agent.flat.mul_(1 - lincomb).add_(agent2.flat, alpha=lincomb)
+            # biases start over, as in a freshly constructed agent.
+            new_agent.policy_decoder_bias.fill_(.001)
+            new_agent.value_decoder_bias.fill_(.001)
+            new_agent.input_encoder_bias.fill_(.001)
         return new_agent
 
     def survival(self):
@@ -219,12 +472,9 @@ class EvoController:
         def _val(a):
             aid = a.id
             version = a.version
-            all_ = self.evo_tree.nodes[aid]["fitness"]
-            all_v = self.evo_tree.nodes[aid]["vloss"]
-            all_p = self.evo_tree.nodes[aid]["ploss"]
-            fit = _compute_loss_values(all_, self.evo_tree.nodes[aid]["copies"])
-            v = _compute_loss_values(all_v, self.evo_tree.nodes[aid]["copies"])
-            p = _compute_loss_values(all_p, self.evo_tree.nodes[aid]["copies"])
+            fit = self.lineage.score(aid, "fitness")
+            v = self.lineage.score(aid, "vloss")
+            p = self.lineage.score(aid, "ploss")
             score = fit
             print(aid, version, "S:", score, "F:", fit, "V:", v, "P:", p)
             return score
@@ -233,9 +483,8 @@ class EvoController:
         killed = self.base_agent[num_survivors:]
         print("")
         for k in killed:
-            if k.id in self.optimizers:
-                self.optimizers.pop(k.id)
-                self.last_grad.pop(k.id)
+            if k.id in self.optimizer:
+                self.optimizer.remove(k.id)
         self.base_agent = self.base_agent[:num_survivors]
 
     def integrate(self, stats):
@@ -250,36 +499,31 @@ class EvoController:
                 print("FAILURE DETECTED: ", id)
                 if len(self.base_agent) > 1:
                     alive.remove(a)
-                    self.optimizers.pop(a.id)
-                    self.last_grad.pop(a.id)
+                    self.optimizer.remove(a.id)
                     self.base_agent = list(alive)
-            self.evo_tree.nodes[id]["fitness"].append(stats[id]["fitness"])
-            self.evo_tree.nodes[id]["vloss"].append(stats[id]["value_loss"])
-            self.evo_tree.nodes[id]["ploss"].append(stats[id]["policy_loss"])
-            self.evo_tree.nodes[id]["copies"].append(stats[id]["copies"])
+            self.lineage.append(id, stats[id]["copies"], fitness=stats[id]["fitness"], vloss=stats[id]["value_loss"],
+                                ploss=stats[id]["policy_loss"])
         self.survival()
         # apply gradients
         survivor_fitness = []
         survivor_v_loss = []
         survivor_p_loss = []
 
-        for i in range(len(self.base_agent)):
-            id = self.base_agent[i].id
-            if id not in stats:
-                continue
-            # apply gradients
-            self.optimizers[id].zero_grad()
-            grads = stats[id]["gradient"]
-            for j, g in enumerate(grads):
-                # send gradient back to gpu from cpu
-                self.last_grad[id][j] = .4 * self.last_grad[id][j] + .6 * g.to(self.device)
-            self.base_agent[i].set_grad(self.last_grad[id])  # sets parameter gradient attributes
-            before_plast = self.base_agent[i].core_model.edge.beta.detach().clone()
-            self.optimizers[id].step()
-            self.base_agent[i].version += 1
-            after_plast = self.base_agent[i].core_model.edge.beta.detach().clone()
-            change = torch.sum(torch.abs(after_plast - before_plast))
-            print(id, self.base_agent[i].version, "change: ", change)
+        fresh = [a for a in self.base_agent if a.id in stats]
+        ids = [a.id for a in fresh]
+        if len(fresh) > 0:
+            # send gradient back to gpu from cpu, each agent's gradient is .4 its last one and .6 the new one.
+            grads = torch.stack([stats[id]["gradient"] for id in ids]).to(self.device)
+            self.optimizer.smooth_grad(ids, grads, keep=.4)
+            if self.debug:
+                before_plast = [a.core_model.edge.beta.detach().clone() for a in fresh]
+            self.optimizer.step(ids)
+            for i, a in enumerate(fresh):
+                a.version += 1
+                if self.debug:
+                    change = torch.sum(torch.abs(a.core_model.edge.beta.detach() - before_plast[i]))
+                    print(a.id, a.version, "change: ", change)
+        for id in ids:
             survivor_fitness.append(stats[id]["fitness"])
             survivor_v_loss.append(stats[id]["value_loss"])
             survivor_p_loss.append(stats[id]["policy_loss"])
@@ -302,26 +546,15 @@ class EvoController:
             else:
                 child = self.multiclone(parent1, parent2)
             child.epsilon = random.random() * .1
-            if self.evo_tree.has_node(child.id):
-                self.evo_tree.remove_node(child.id)
+            # the child starts with one entry, half of each parent's scores and mean copies.
+            fit, v, pl, cp = 0., 0., 0., 0.
             for p in [parent1, parent2]:
-                hist_size = len(self.evo_tree.nodes[parent1.id]["fitness"])
-                # adjust weight by number of copies used
-                cp = self.evo_tree.nodes[p.id]["copies"]
-                fit = _compute_loss_values(self.evo_tree.nodes[p.id]["fitness"], cp) / 2
-                v = _compute_loss_values(self.evo_tree.nodes[p.id]["vloss"], cp) / 2
-                pl = _compute_loss_values(self.evo_tree.nodes[p.id]["ploss"], cp) / 2
-                fit = fit - .002
-                v = v * 1.0
-                if child.id in self.evo_tree.nodes:
-                    self.evo_tree.nodes[child.id]["fitness"][-1] += fit
-                    self.evo_tree.nodes[child.id]["vloss"][-1] += v
-                    self.evo_tree.nodes[child.id]["ploss"][-1] += pl
-                    self.evo_tree.nodes[child.id]["copies"][-1] += np.mean(cp) / 2
-                else:
-                    self.evo_tree.add_node(child.id, fitness=[fit], vloss=[v], ploss=[pl],
-                                           copies=[np.mean(cp) / 2])
-                self.evo_tree.add_edge(p.id, child.id)
+                fit += self.lineage.score(p.id, "fitness") / 2 - .002
+                v += self.lineage.score(p.id, "vloss") / 2
+                pl += self.lineage.score(p.id, "ploss") / 2
+                cp += self.lineage.mean_copies(p.id) / 2
+            self.lineage.add(child.id, parents=[parent1.id, parent2.id])
+            self.lineage.append(child.id, cp, fitness=fit, vloss=v, ploss=pl)
             self._add_optimizer_set(child)
             next_gen.append(child)
         self.base_agent.extend(next_gen)
@@ -330,12 +563,9 @@ class EvoController:
         aid = a.id
         log_min_lr = max(self.log_min_lr - (self.full_count / 1500), -10)
         log_max_lr = max(self.log_max_lr - (self.full_count / 1500), -8)
-        if aid not in self.optimizers:
+        if aid not in self.optimizer:
             lr = float(np.power(10, random.random() * (log_max_lr - log_min_lr) + log_min_lr))
-            self.optimizers[a.id] = torch.optim.Adam(a.core_model.parameters() + [a.policy_decoder, a.input_encoder,
-                                                                                  a.value_decoder, a.policy_decoder_bias,
-                                                                                  a.value_decoder_bias, a.input_encoder_bias], lr=lr)
-            self.last_grad[aid] = [0. for _ in a.parameters()]
+            self.optimizer.add(a, lr)
 
     def spawn_visualization_worker(self, mp=True):
         # select current best base agent on last survival
@@ -355,8 +585,8 @@ class EvoController:
         v = np.log2(_compute_loss_values(self.value_loss_hist))
         v = round(float(v), 2)
         package = {"agents": self.base_agent,
-                   "optim": self.optimizers,
-                   "tree": self.evo_tree,
+                   "optim": self.optimizer,
+                   "tree": self.lineage,
                    "fit_hist": self.fitness_hist,
                    "val_hist": self.value_loss_hist,
                    "p_hist": self.policy_loss_hist,
@@ -370,8 +600,14 @@ class EvoController:
         # depackage
         with open(fpath, "rb") as f:
             p = pickle.load(f)
-        self.evo_tree = p["tree"]
-        self.base_agent = p["agents"]
+        self.lineage = p["tree"]
+        if not isinstance(self.lineage, LineageStore):
+            # snapshots from before the lineage store hold a networkx evo tree.
+            self.lineage = LineageStore.from_tree(self.lineage)
+        # snapshots from before agents were flattened are flattened on load.
+        self.base_agent = [a if a.flat is not None else a.flatten() for a in p["agents"]]
+        # the loaded agents are added with new learning rates as they are next used.
+        self.optimizer = PopulationAdam(self.base_agent[0], capacity=2 * max(self.num_base, len(self.base_agent)))
         self.fitness_hist = p["fit_hist"]
         self.value_loss_hist = p["val_hist"]
         self.policy_loss_hist = p["p_hist"]
@@ -388,28 +624,27 @@ class EvoController:
 
     def controller(self, mp=True, disp_iter=500, fbase="/users/jkim116/epavlick/jkim116/ReIntAI/models/testOscar"):
         num_workers = self.num_workers
-        workers = {}
         epoch = 0
         fail = False
-        to_kill = set()
         if mp:
             integration_q = Queue(maxsize=100)
+            # workers live for the whole run and take one epoch at a time. Parameters and gradients are exchanged
+            # through shared memory, so each worker is sent a template agent once and jobs only carry metadata.
+            per_job = max(self.start_base, len(self.base_agent))
+            arena = ParameterArena(self.base_agent[0], num_slots=per_job * (num_workers + 2), num_jobs=num_workers,
+                                   agents_per_job=per_job)
+            template = self.base_agent[0].clone(fuzzy=False, set_dev=self.worker_device)
+            pool = WorkerPool(num_workers, integration_q, self.worker_device, arena=arena, template=template)
+            workers = pool.pending
+            # pid -> (base agent metadata, gradient slot) of jobs in flight.
+            held = {}
         else:
             integration_q = _pseudo_queue()
+            workers = set()
         while (epoch <= self.epochs and not fail) or len(workers) > 0:
             # time.sleep(.05)
             # to_remove = []
             if mp:
-                for k in to_kill:
-                    try:
-                        # send termination signal down pipe
-                        pipe = workers[k][1]
-                        pipe.send(True)
-                        workers[k][0].join()
-                        workers.pop(k)
-                    except KeyError:
-                        print("Worker to kill DNE - possible zombie")
-                to_kill = set()
                 if len(workers) < num_workers and epoch <= self.epochs:
                     pid = "".join(random.choices("ABCDEFG1234567", k=5))
                     if (epoch ) % disp_iter == 0:
@@ -420,9 +655,9 @@ class EvoController:
                             p = self.spawn_visualization_worker(mp=False)
                     else:
                         print("Worker", pid, "handling epoch", epoch)
-                        p, pipe = self.spawn_worker(integration_q, pid)
-                        workers[pid] = (p, pipe)  # worker gets piped yay
-                        p.start()
+                        job = self._worker_job(arena)
+                        held[pid] = (job[2], job[0])
+                        pool.submit(pid, job)
                     epoch += 1
                     self.full_count += 1
             else:
@@ -434,16 +669,28 @@ class EvoController:
                 self.full_count += 1
             if not integration_q.empty():
                 stats, rf, pid = integration_q.get(block=True)  # , v_optims, p_optims
-                to_kill.add(pid)
+                if mp:
+                    pool.done(pid)
+                    metas, grad_slot = held.pop(pid)
                 if stats is None:
                     print("Worker", pid, "FAILED")
+                    if mp:
+                        arena.release(metas, grad_slot)
                     continue
+                if mp:
+                    for i, meta in enumerate(metas):
+                        stats[meta["id"]]["gradient"] = arena.gradients(grad_slot, i)
                 self.reward_function = self.reward_function + rf
                 self.integrate(stats)
+                if mp:
+                    # integrate has copied the gradients out. Updated agents and new children are published when a
+                    # job next checks them out.
+                    arena.release(metas, grad_slot)
+                    arena.retain({a.id for a in self.base_agent})
                 if self.viz and (epoch + 1) % (disp_iter // 10) == 0:
                     self.visualize()
-        for k in workers.keys():
-            workers[k][0].join()
+        if mp:
+            pool.close()
         print("DONE: one last visualization...")
 
         if self.viz:
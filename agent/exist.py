@@ -1,13 +1,212 @@
 import random
 import time
+from collections import Counter, OrderedDict
 
 import numpy as np
 import torch
+from torch.multiprocessing import Queue, Process
 
 from pettingzoo.sisl import waterworld_v4
 
+# host synchronization points by site, for instrumentation. Each worker process counts its own.
+sync_counts = Counter()
+
+
+def to_host(tensor, site):
+    """
+    Copies a tensor to a numpy array on the host. The copy waits for the device to finish, so every call is counted
+    in sync_counts under site.
+    """
+    sync_counts[site] += 1
+    return tensor.detach().cpu().numpy()
+
+
+# headless environments by configuration, kept between episodes so a long lived worker builds each one once. The
+# episode length is drawn per episode, so it is not part of the key and is set on the cached environment instead.
+_env_cache = OrderedDict()
+_env_cache_size = 4
+
+
+def _environment(num_agents, sensors, cycles, max_acc, human):
+    if human:
+        return waterworld_v4.parallel_env(render_mode="human", n_pursuers=num_agents, n_coop=1,
+                                          n_sensors=sensors, max_cycles=cycles, speed_features=False,
+                                          pursuer_max_accel=max_acc, encounter_reward=0.1, food_reward=6.0,
+                                          poison_reward=-3.5, thrust_penalty=-.001)
+    key = (num_agents, sensors, max_acc)
+    if key in _env_cache:
+        _env_cache.move_to_end(key)
+        env = _env_cache[key]
+        # the waterworld simulation truncates once its frame count reaches max_cycles, reset sets frames back to 0.
+        env.unwrapped.env.max_cycles = cycles
+        return env
+    env = waterworld_v4.parallel_env(n_pursuers=num_agents, n_coop=1, n_sensors=sensors,
+                                     n_evaders=10, n_poisons=20, max_cycles=cycles, speed_features=False, pursuer_max_accel=max_acc,
+                                     encounter_reward=0.1, food_reward=6.0, poison_reward=-3.5,
+                                     thrust_penalty=-.001)
+    _env_cache[key] = env
+    if len(_env_cache) > _env_cache_size:
+        _env_cache.popitem(last=False)[1].close()
+    return env
+
+
+class PolicyStep:
+    """
+    Steps the policies of every agent in an episode together. The copies of a base agent are one batched instance of
+    it, so each step runs one forward per base agent, and the actions of all agents are drawn from a single batched
+    Beta distribution. Agents are ordered by base agent, then copy.
+    NaN outputs are flagged on the device and only read back by check. Until then the outputs of flagged agents are
+    replaced with a uniform policy, once a check finds every copy of a base agent failed, it is no longer run.
+    """
+
+    def __init__(self, base_agents, copies, device="cpu", max_acc=.3):
+        """
+        :param base_agents: Agent species that are present in this environment (e.g. unique parameter set)
+        :param copies: Number of copies of each base type
+        :param device: device ot use for gradient computation
+        :param max_acc: maximum agent acceleration in environment
+        """
+        self.models = [base.instantiate(instances=c) for base, c in zip(base_agents, copies)]
+        bounds = np.cumsum([0] + list(copies))
+        self.slices = [slice(int(bounds[i]), int(bounds[i + 1])) for i in range(len(copies))]
+        self.epsilon = torch.tensor(np.repeat([m.epsilon for m in self.models], copies), device=device)
+        self.num_agents = int(bounds[-1])
+        self.device = device
+        self.max_acc = max_acc
+        self.failed = torch.zeros((self.num_agents,), dtype=torch.bool, device=device)
+        self.active = [True] * len(self.models)
+
+    def __call__(self, observations, rewards):
+        """
+        :param observations: (agents, sensors) array with the observation of every agent.
+        :param rewards: (agents,) array with the last instant reward of every agent.
+        :return: actions, a (agents, 2) numpy array for the environment, and tensors with the log likelihood,
+                 entropy and value estimate of each agent and whether it acted randomly.
+        """
+        X = torch.from_numpy(observations).to(self.device) + .00001
+        r = torch.from_numpy(rewards).to(self.device) + .00001
+        outputs = []
+        for model, s, active in zip(self.models, self.slices, self.active):
+            if active:
+                outputs.append(model.forward(X[s], r[s]))
+            else:
+                copies = s.stop - s.start
+                outputs.append((X.new_ones((copies, 2)), X.new_ones((copies, 2)), X.new_zeros((copies, 1))))
+        c1, c2, v_hat = (torch.cat(out, dim=0) for out in zip(*outputs))
+        with torch.no_grad():
+            # updated out of place, earlier flags are saved for backward by torch.where.
+            self.failed = self.failed | torch.isnan(c1.sum(dim=1) + c2.sum(dim=1) + v_hat.sum(dim=1))
+            failed = self.failed.unsqueeze(1)
+        c1 = torch.where(failed, 1., c1)
+        c2 = torch.where(failed, 1., c2)
+        v_hat = torch.where(failed, 0., v_hat)
+        # x and y concentrations of every agent, (agents, 2)
+        dist = torch.distributions.Beta(concentration0=torch.stack([c1[:, 0], c2[:, 0]], dim=1),
+                                        concentration1=torch.stack([c1[:, 1], c2[:, 1]], dim=1))
+        with torch.no_grad():
+            is_random = torch.rand((self.num_agents,), device=self.device) < self.epsilon
+            action = torch.where(is_random.unsqueeze(1), torch.rand((self.num_agents, 2), device=self.device),
+                                 dist.sample())
+        likelihood = dist.log_prob(action).sum(dim=1)
+        entropy = dist.entropy().sum(dim=1)
+        actions = to_host(action * 2 * self.max_acc - self.max_acc, "actions")
+        return actions, likelihood, entropy, v_hat, is_random
+
+    def check(self):
+        """
+        Reads the failure flags accumulated since the episode started, one synchronization with the device. Base
+        agents whose copies all failed are masked out of later steps.
+        :return: (agents,) boolean numpy array, True for agents with NaN outputs.
+        """
+        failed = to_host(self.failed, "nan_check")
+        self.active = [not failed[s].all() for s in self.slices]
+        return failed
+
+
+class TrajectoryBuffer:
+    """
+    Preallocated (max_cycles, agents) record of an episode. Each cycle writes one row by index instead of appending
+    small tensors per agent, and the loss functions get views of each agent's column up to its length, so nothing is
+    stacked when the episode ends. Agents that leave the environment stop growing, rows past their length are never
+    read. An episode that runs past max_cycles, e.g. the single step of a zero cycle episode, doubles the rows.
+    """
+
+    def __init__(self, max_cycles, num_agents, device="cpu"):
+        """
+        :param max_cycles: maximum number of cycles in the episode.
+        :param num_agents: number of agents in the episode.
+        :param device: device ot use for gradient computation
+        """
+        self.max_cycles = max_cycles
+        self.num_agents = num_agents
+        self.device = device
+        # policy outputs are allocated on the first record, in the dtype of the policy.
+        self.likelihood = None
+        self.entropy = None
+        self.value = None
+        self.is_random = torch.zeros((max_cycles, num_agents), dtype=torch.bool, device=device)
+        self.rewards = torch.zeros((max_cycles, num_agents), dtype=torch.float64, device=device)
+        self.lengths = np.zeros(num_agents, dtype=int)
+        self.cycle = 0
+
+    def record(self, likelihood, entropy, value, is_random):
+        """
+        Writes the policy outputs of every agent for the current cycle.
+        :param likelihood: (agents,) log likelihood of each action.
+        :param entropy: (agents,) entropy of each action distribution.
+        :param value: (agents, 1) value estimates.
+        :param is_random: (agents,) boolean, whether each action was random.
+        """
+        if self.cycle == self.max_cycles:
+            self._grow()
+        if self.likelihood is None:
+            shape = (self.max_cycles, self.num_agents)
+            self.likelihood = torch.zeros(shape, dtype=likelihood.dtype, device=self.device)
+            self.entropy = torch.zeros(shape, dtype=entropy.dtype, device=self.device)
+            self.value = torch.zeros(shape, dtype=value.dtype, device=self.device)
+        self.likelihood[self.cycle] = likelihood
+        self.entropy[self.cycle] = entropy
+        self.value[self.cycle] = value.view(-1)
+        self.is_random[self.cycle] = is_random
+
+    def _grow(self):
+        size = max(2 * self.max_cycles, 1)
+        for name in ("likelihood", "entropy", "value", "is_random", "rewards"):
+            old = getattr(self, name)
+            if old is None:
+                continue
+            new = old.new_zeros((size, self.num_agents))
+            new[:self.max_cycles] = old
+            setattr(self, name, new)
+        self.max_cycles = size
+
+    def reward(self, rewards, valid):
+        """
+        Writes the rewards of the current cycle and moves to the next one.
+        :param rewards: (agents,) numpy array of instant rewards.
+        :param valid: (agents,) boolean numpy array, agents whose trajectory continues through this cycle.
+        """
+        self.rewards[self.cycle] = torch.from_numpy(rewards)
+        self.lengths += valid
+        self.cycle += 1
+
+    def trajectory(self, index):
+        """
+        :param index: index of the agent.
+        :return: dict of views of the agent's instant rewards, value estimates, action log likelihoods, entropies and
+                 random action flags, with the number of cycles in them.
+        """
+        length = int(self.lengths[index])
+        return {"inst_r": self.rewards[:length, index],
+                "value": self.value[:length, index],
+                "action_likelihood": self.likelihood[:length, index],
+                "entropy": self.entropy[:length, index],
+                "is_random": self.is_random[:length, index],
+                "counts": length}
+
+
 def episode(base_agents, copies, min_cycles=600, max_cycles=600, sensors=20, human=False, device="cpu", max_acc=.3,
-            action_dist="weighted_dist"):
+            action_dist="weighted_dist", check_every=50):
     """
     Function to run launch and take action in the waterworld environment
     :param base_agents: Agent species that are present in this environment (e.g. unique parameter set)
@@ -18,81 +217,41 @@ def episode(base_agents, copies, min_cycles=600, max_cycles=600, sensors=20, hum
     :param human: whether to display environment runtime on screen (slow, locks process)
     :param device: device ot use for gradient computation
     :param max_acc: maximum agent acceleration in environment
-    :return:
+    :param check_every: cycles between reads of the NaN failure flags, they are also read when the episode ends.
+    :return: dict of agent info, scores of each base agent and the episode's TrajectoryBuffer.
     """
     num_base = len(base_agents)
-    agents = [[base_agents[i].detach()] for i in range(num_base)]
     scores = [0.] * num_base
     cycles = random.randint(min_cycles, max_cycles)
-    num_agents = num_base
-    for j in range(num_base):
-        for i in range(copies[j] - 1):
-            num_agents += 1
-            agents[j].append(base_agents[j].instantiate())
-    if human:
-        env = waterworld_v4.parallel_env(render_mode="human", n_pursuers=num_agents, n_coop=1,
-                                         n_sensors=sensors, max_cycles=cycles, speed_features=False,
-                                         pursuer_max_accel=max_acc, encounter_reward=0.1, food_reward=6.0,
-                                         poison_reward=-3.5, thrust_penalty=-.001)
-    else:
-        env = waterworld_v4.parallel_env(n_pursuers=num_agents, n_coop=1, n_sensors=sensors,
-                                         n_evaders=10, n_poisons=20, max_cycles=cycles, speed_features=False, pursuer_max_accel=max_acc,
-                                         encounter_reward=0.1, food_reward=6.0, poison_reward=-3.5,
-                                         thrust_penalty=-.001)
+    policy = PolicyStep(base_agents, copies, device=device, max_acc=max_acc)
+    num_agents = policy.num_agents
+    env = _environment(num_agents, sensors, cycles, max_acc, human)
     env.reset()
     agent_dict = {}
     env_agent_index = 0
-    for i, base in enumerate(agents):
-        for j, agent in enumerate(base):
+    for i, model in enumerate(policy.models):
+        for j in range(copies[i]):
             agent_name = env.agents[env_agent_index]
             agent_dict[agent_name] = {"base_index": i,
-                                      "base_name": agent.id,
-                                      "model": agents[i][j],
-                                      "action_likelihood": [],
-                                      "is_random": [],
-                                      "entropy": [],
-                                      "inst_r": [],
-                                      "counts": 0,
-                                      "value": [],
+                                      "index": env_agent_index,
+                                      "base_name": model.id,
+                                      "model": model,
                                       "terminate": False,
                                       "failure": False}
             env_agent_index += 1
 
     observations, infos = env.reset()
+    names = list(agent_dict.keys())
+    # observations of agents that left the environment are kept at their last value.
+    obs = np.stack([observations[agent] for agent in names])
+    last_r = np.zeros(num_agents)
+    trajectories = TrajectoryBuffer(cycles, num_agents, device=device)
 
     while env.agents:
-        # this is where you would insert your policy
-        actions = {}
-        for agent in env.agents:
-            inst_r = 0
-            if len(agent_dict[agent]["inst_r"]) > 0:
-                inst_r = agent_dict[agent]["inst_r"][-1]
-            c1, c2, v_hat = agent_dict[agent]["model"].forward(torch.from_numpy(observations[agent]) + .00001, inst_r + .00001)
-            # c1, c2, v_hat = agent_dict[agent]["model"](torch.from_numpy(observations[agent]) + .0001)
-            with torch.no_grad():
-                if torch.isnan(c1 + c2 + v_hat).any():
-                    agent_dict[agent]["failure"] = True
-            x_dist = torch.distributions.Beta(concentration0=c1[0], concentration1=c1[1])
-            y_dist = torch.distributions.Beta(concentration0=c2[0], concentration1=c2[1])
-            if random.random() < agent_dict[agent]["model"].epsilon:
-                agent_dict[agent]["is_random"].append(True)
-                action = torch.rand((2,), device=device)
-                action_x = action[0]
-                action_y = action[1]
-                action = action * 2 * max_acc - max_acc
-            else:
-                agent_dict[agent]["is_random"].append(False)
-                action_x = x_dist.sample()
-                action_y = y_dist.sample()
-                action = torch.stack([action_x, action_y]) * 2 * max_acc - max_acc
-            likelihood_x = x_dist.log_prob(action_x)
-            likelihood_y = y_dist.log_prob(action_y)
-            entropy = x_dist.entropy() + y_dist.entropy()
-
-            agent_dict[agent]["action_likelihood"].append(likelihood_x + likelihood_y)
-            agent_dict[agent]["entropy"].append(entropy)
-            agent_dict[agent]["value"].append(v_hat.clone())
-            actions[agent] = action.detach().cpu().numpy()
+        live = set(env.agents)
+        action, likelihood, entropy, v_hat, is_random = policy(obs, last_r)
+        trajectories.record(likelihood, entropy, v_hat, is_random)
+        actions = {agent: action[i] for i, agent in enumerate(names) if agent in live}
         try:
             observations, rewards, terminations, truncations, infos = env.step(actions)
         except ValueError:
@@ -100,29 +259,51 @@ def episode(base_agents, copies, min_cycles=600, max_cycles=600, sensors=20, hum
                 agent_dict[agent]["failure"] = True
                 base = agent_dict[agent]["base_index"]
                 scores[base] = None
-        for i, agent in enumerate(agent_dict.keys()):
+        step_r = np.zeros(num_agents)
+        valid = np.zeros(num_agents, dtype=bool)
+        for i, agent in enumerate(names):
             base = agent_dict[agent]["base_index"]
+            if agent in observations:
+                obs[i] = observations[agent]
             if terminations[agent]:
                 scores[base] = None
                 agent_dict[agent]["terminate"] = True
             if not agent_dict[agent]["terminate"]:
                 reward = rewards[agent]
-                agent_dict[agent]["inst_r"].append(reward)
-                agent_dict[agent]["counts"] += 1
+                step_r[i] = reward
+                valid[i] = True
                 scores[base] += float(reward)
+        trajectories.reward(step_r, valid)
+        last_r = np.where(valid, step_r, last_r)
+        if trajectories.cycle % check_every == 0:
+            # failed base agents are masked out of the following cycles.
+            policy.check()
+    failed = policy.check()
+    for i, agent in enumerate(names):
+        agent_dict[agent].update(trajectories.trajectory(i))
+        if failed[i]:
+            agent_dict[agent]["failure"] = True
     for agent in agent_dict.keys():
         if scores[agent_dict[agent]["base_index"]] is not None:
             scores[agent_dict[agent]["base_index"]] /= agent_dict[agent]["counts"]
-    env.close()
-    return agent_dict, scores
+    if human:
+        # headless environments stay open in the cache.
+        env.close()
+    return agent_dict, scores, trajectories
 
 
-def local_evolve(q, pipe, generations, base_agents, copies, reward_function, train_act=True, train_critic=True, critic_random_only=False, proc=0, device="cpu"):
+def local_evolve(q, pipe, generations, base_agents, copies, reward_function, train_act=True, train_critic=True,
+                 critic_random_only=False, proc=0, device="cpu", arena=None, grad_slot=None):
     try:
         num_base = len(base_agents)
         device = base_agents[0].device
         fail_tracker = [False for _ in range(num_base)]
-        stat_tracker = {a.id: {"gradient": [0. for _ in a.parameters()],
+        sync_counts.clear()
+        for a in base_agents:
+            if a.flat is None:
+                a.flatten()
+        # gradients are accumulated as one vector per base agent.
+        stat_tracker = {a.id: {"gradient": torch.zeros_like(a.flat, device="cpu"),
                                "value_loss": [],
                                "policy_loss": [],
                                "entropy": [],
@@ -132,51 +313,23 @@ def local_evolve(q, pipe, generations, base_agents, copies, reward_function, tra
         for gen in range(generations):
             h_int = False
             total_loss = [torch.tensor([0.], device=device) for _ in range(num_base)]
-            gen_info, base_scores = episode(base_agents, copies, h_int, device=device)
+            gen_info, base_scores, trajectories = episode(base_agents, copies, h_int, device=device)
             for a in stat_tracker.keys():
                 stat_tracker[a]["value_loss"].append([])
                 stat_tracker[a]["policy_loss"].append([])
                 stat_tracker[a]["entropy"].append([])
 
+            # the losses of every trained agent are computed in one batched call and read back together.
+            train = []
             for agent in gen_info.keys():
                 agent_info = gen_info[agent]
                 if agent_info["terminate"]:
                     stat_tracker["skip"] = True
                     continue
                 if not (agent_info["failure"]) and not stat_tracker[agent_info["base_name"]]["failure"]:
-                    # whether to train critic only when random action is taken.
-                    is_random = torch.tensor(agent_info["is_random"], device=device)
-
-                    if reward_function.__name__ == "ActorCritic":
-                        val_loss, policy_loss = reward_function.loss(torch.tensor(agent_info["inst_r"], device=device),
-                                                                               torch.concat(agent_info["value"], dim=0),
-                                                                               torch.stack(agent_info["action_likelihood"], dim=0),
-                                                                               torch.stack(agent_info["entropy"], dim=0))
-                    elif reward_function.__name__ == "Reinforce":
-                        policy_loss = reward_function.loss(torch.tensor(agent_info["inst_r"], device=device),
-                                                                               torch.stack(agent_info["action_likelihood"], dim=0),
-                                                                               torch.stack(agent_info["entropy"], dim=0))
-                        val_loss = torch.tensor([2.], device=device)
-                    else:
-                        raise ValueError("undefined reward function")
-
-                   # val_loss = torch.Tensor([8.])
+                    train.append(agent_info)
                     weight = max(len(agent_info["inst_r"]) - 15, 0) / 400
-                    if torch.isnan(val_loss + policy_loss):
-                        print("NaN is gradient!", agent_info["base_name"])
-                        stat_tracker[agent_info["base_name"]]["failure"] = True
-                        fail_tracker[agent_info["base_index"]] = True
-                    stat_tracker[agent_info["base_name"]]["value_loss"][-1].append((val_loss / len(is_random)).detach().cpu().item())
-                    stat_tracker[agent_info["base_name"]]["policy_loss"][-1].append((policy_loss / len(is_random)).detach().cpu().item())
                     stat_tracker[agent_info["base_name"]]["copies"] += weight
-                    a = .05
-                    b = .1
-                    if not train_act:
-                        b = 0.0
-                    if not train_critic:
-                        a = 0.0
-                    total_loss[agent_info["base_index"]] = (total_loss[agent_info["base_index"]] + a * val_loss
-                                                            + b * policy_loss)
                 else:
                     agent_info["failure"] = True
                     stat_tracker[agent_info["base_name"]]["Failure"] = True
@@ -186,6 +339,42 @@ def local_evolve(q, pipe, generations, base_agents, copies, reward_function, tra
                     stat_tracker[agent_info["base_name"]]["entropy"][-1].append(None)
                     stat_tracker[agent_info["base_name"]]["failure"] = True
                     fail_tracker[agent_info["base_index"]] = True
+            if len(train) > 0:
+                index = [agent_info["index"] for agent_info in train]
+                columns = torch.tensor(index, device=device)
+                # padded (cycles, agents) trajectories of the trained agents.
+                rewards = trajectories.rewards[:, columns]
+                likelihood = trajectories.likelihood[:, columns]
+                entropy = trajectories.entropy[:, columns]
+                lengths = trajectories.lengths[index]
+                if reward_function.__name__ == "ActorCritic":
+                    val_loss, policy_loss = reward_function.loss_batch(rewards, trajectories.value[:, columns],
+                                                                       likelihood, entropy, lengths)
+                elif reward_function.__name__ == "Reinforce":
+                    policy_loss = reward_function.loss_batch(rewards, likelihood, entropy, lengths)
+                    val_loss = torch.full_like(policy_loss, 2.)
+                else:
+                    raise ValueError("undefined reward function")
+                a = .05
+                b = .1
+                if not train_act:
+                    b = 0.0
+                if not train_critic:
+                    a = 0.0
+                bases = torch.tensor([agent_info["base_index"] for agent_info in train], device=device)
+                base_loss = torch.zeros((num_base,), device=device, dtype=policy_loss.dtype).index_add(
+                    0, bases, a * val_loss + b * policy_loss)
+                for i in range(num_base):
+                    total_loss[i] = total_loss[i] + base_loss[i]
+                read = to_host(torch.stack([val_loss, policy_loss], dim=1), "losses")
+                for agent_info, (val_loss, policy_loss) in zip(train, read):
+                    if np.isnan(val_loss + policy_loss):
+                        print("NaN is gradient!", agent_info["base_name"])
+                        stat_tracker[agent_info["base_name"]]["failure"] = True
+                        fail_tracker[agent_info["base_index"]] = True
+                    steps = len(agent_info["is_random"])
+                    stat_tracker[agent_info["base_name"]]["value_loss"][-1].append(float(val_loss) / steps)
+                    stat_tracker[agent_info["base_name"]]["policy_loss"][-1].append(float(policy_loss) / steps)
             for j, score in enumerate(base_scores):
                 a = base_agents[j]
                 if stat_tracker[a.id]["fitness"] is None:
@@ -194,38 +383,50 @@ def local_evolve(q, pipe, generations, base_agents, copies, reward_function, tra
                     stat_tracker[a.id]["fitness"] = None
                 else:
                     stat_tracker[a.id]["fitness"].append(score)
-            for i in range(num_base):
-                if not fail_tracker[i]:
+            # the losses of all base agents share the episode graph, so they go through one backward. Base agents
+            # have disjoint parameters, each flat_grad only receives the gradient of its own loss.
+            trained = [i for i in range(num_base) if not fail_tracker[i]]
+            loss = torch.zeros((), device=device)
+            for i in trained:
+                a = base_agents[i]
+                reg = torch.sum(torch.square(a.input_encoder))
+                reg = reg + torch.sum(torch.square(a.core_model.edge.init_weight))
+                reg = reg + torch.sum(torch.square(a.core_model.edge.chan_map))
+                if train_critic:
+                    reg = reg + torch.sum(torch.square(a.value_decoder))
+                if train_act:
+                    reg = reg + torch.sum(torch.square(a.policy_decoder))
+                loss = loss + torch.sum(total_loss[i] + .0001 * reg)
+            if len(trained) > 0:
+                loss.backward()
+                # one read decides which base agents have a NaN gradient.
+                nan_grad = to_host(torch.stack([torch.isnan(base_agents[i].flat_grad).any() for i in trained]),
+                                   "nan_grad")
+                for i, nan in zip(trained, nan_grad):
                     a = base_agents[i]
-                    reg = torch.sum(torch.square(a.input_encoder))
-                    reg = reg + torch.sum(torch.square(a.core_model.edge.init_weight))
-                    reg = reg + torch.sum(torch.square(a.core_model.edge.chan_map))
-                    if train_critic:
-                        reg = reg + torch.sum(torch.square(a.value_decoder))
-                    if train_act:
-                        reg = reg + torch.sum(torch.square(a.policy_decoder))
-                    total_loss[i] = total_loss[i] + .0001 * reg
-                    total_loss[i].backward()
-                    for j, p in enumerate(a.parameters()):
-                        if p.grad is None:
-                            stat_tracker[a.id]["gradient"][j] += torch.zeros_like(p.data)
-                        elif not torch.isnan(p.grad).any():
-                            # send gradient to cpu
-                            stat_tracker[a.id]["gradient"][j] += p.grad.detach().cpu()
-                        else:
-                            print("NaN grad", a.id)
-                            stat_tracker[a.id]["failure"] = True
-                            stat_tracker[a.id]["gradient"][j] += torch.zeros_like(p.data)
-                            fail_tracker[i] = True
+                    if nan:
+                        print("NaN grad", a.id)
+                        stat_tracker[a.id]["failure"] = True
+                        fail_tracker[i] = True
+                        continue
+                    sync_counts["gradient"] += 1
+                    # send gradient to cpu
+                    stat_tracker[a.id]["gradient"] += a.flat_grad.detach().cpu()
         # average and cast to numpy
         for k in stat_tracker.keys():
             if not stat_tracker[k]["failure"]:
-                for pid in range(len(stat_tracker[k]["gradient"])):
-                    stat_tracker[k]["gradient"][pid] *= 1e-1
+                stat_tracker[k]["gradient"] *= 1e-1
                 stat_tracker[k]["value_loss"] = np.nanmean(np.array(stat_tracker[k]["value_loss"], dtype=float))
                 stat_tracker[k]["policy_loss"] = np.nanmean(np.array(stat_tracker[k]["policy_loss"], dtype=float))
                 if stat_tracker[k]["fitness"] is not None:
                     stat_tracker[k]["fitness"] = np.mean(stat_tracker[k]["fitness"])
+        if arena is not None:
+            # gradients go back through shared memory, the queue only carries where to find them.
+            for i, a in enumerate(base_agents):
+                arena.write_gradients(grad_slot, i, stat_tracker[a.id]["gradient"])
+                stat_tracker[a.id]["gradient"] = (grad_slot, i)
+        # synchronization points of this worker, by site.
+        stat_tracker["syncs"] = dict(sync_counts)
         q.put((stat_tracker, reward_function, proc))
     except IndexError as e:
         # on any exception we return the pid so proc can be killed
@@ -238,3 +439,180 @@ def local_evolve(q, pipe, generations, base_agents, copies, reward_function, tra
         return
     raise RuntimeError("Worker", proc, "was never signalled to die.")
 
+
+class ParameterArena:
+    """
+    Flat shared memory holding the parameters of the base agents and the gradients workers send back. Each slot of
+    the parameter buffer holds one version of one agent, laid out like agent.flat. The controller publishes a new slot
+    whenever an agent changes and workers flatten their copy of the agent onto the slot a job names, without copying.
+    A slot is reused once it is neither an agent's latest version nor named by a job in flight, so workers never read
+    a slot being written. Each job writes its gradients into its own gradient slot, the queues
+    then only carry ids, versions and statistics.
+    """
+
+    def __init__(self, template, num_slots, num_jobs, agents_per_job):
+        """
+        :param template: agent with the parameter shapes of every agent the arena will hold.
+        :param num_slots: number of parameter slots, enough for the latest version of every base agent plus the
+                          versions held by jobs in flight.
+        :param num_jobs: number of jobs that may be in flight at once.
+        :param agents_per_job: max number of base agents in one job.
+        """
+        params = template.parameters()
+        self.size = sum(p.numel() for p in params)
+        self.dtype = params[0].dtype
+        self.params = torch.zeros((num_slots, self.size), dtype=self.dtype).share_memory_()
+        self.grads = torch.zeros((num_jobs, agents_per_job, self.size), dtype=self.dtype).share_memory_()
+        # controller side bookkeeping, agent id -> (slot, version) and the number of jobs holding each slot.
+        self.latest = {}
+        self.holds = np.zeros(num_slots, dtype=int)
+        self.free_grads = list(range(num_jobs))
+
+    def __getstate__(self):
+        # workers only need the shared buffers and the layout.
+        state = self.__dict__.copy()
+        state["latest"] = {}
+        state["free_grads"] = []
+        return state
+
+    def publish(self, agent):
+        """
+        Writes the agent's current parameters to a free slot, unless its version is already published.
+        :param agent: base agent.
+        :return: slot index.
+        """
+        if agent.id in self.latest and self.latest[agent.id][1] == agent.version:
+            return self.latest[agent.id][0]
+        used = {slot for slot, _ in self.latest.values()}
+        free = [s for s in range(len(self.holds)) if self.holds[s] == 0 and s not in used]
+        if len(free) == 0:
+            raise RuntimeError("Parameter arena is full.")
+        slot = free[0]
+        if agent.flat is None:
+            raise ValueError("Only flattened agents can be published.")
+        with torch.no_grad():
+            self.params[slot].copy_(agent.flat)
+        self.latest[agent.id] = (slot, agent.version)
+        return slot
+
+    def retain(self, alive):
+        """
+        Forgets the agents that are no longer base agents, their slots are reused once no job holds them.
+        :param alive: ids of the current base agents.
+        """
+        for aid in list(self.latest.keys()):
+            if aid not in alive:
+                self.latest.pop(aid)
+
+    def checkout(self, agent, epsilon):
+        """
+        Publishes the agent if needed and holds its slot for a job.
+        :return: job metadata of the agent, id, version, epsilon and slot.
+        """
+        slot = self.publish(agent)
+        self.holds[slot] += 1
+        return {"id": agent.id, "version": agent.version, "epsilon": epsilon, "slot": slot}
+
+    def gradient_slot(self):
+        if len(self.free_grads) == 0:
+            raise RuntimeError("No free gradient slot, more jobs in flight than the arena was built for.")
+        return self.free_grads.pop()
+
+    def release(self, metas, grad_slot):
+        """
+        Returns the slots held by a finished job.
+        """
+        for meta in metas:
+            self.holds[meta["slot"]] -= 1
+        self.free_grads.append(grad_slot)
+
+    def agent(self, template, meta, device="cpu"):
+        """
+        Worker side, builds a base agent flattened onto its slot. On another device the slot is copied there instead.
+        :param template: agent with the same configuration, its parameters are not used.
+        :param meta: job metadata from checkout.
+        """
+        flat = self.params[meta["slot"]]
+        if torch.device(device) != flat.device:
+            flat = flat.to(device)
+        agent = template.empty_like()
+        agent.id = meta["id"]
+        agent.version = meta["version"]
+        agent.epsilon = meta["epsilon"]
+        agent.core_model = template.core_model.instantiate()
+        return agent.flatten(flat)
+
+    def write_gradients(self, grad_slot, index, grad):
+        """
+        Worker side, stores one agent's gradient vector, as accumulated by local_evolve, in the job's gradient slot.
+        """
+        self.grads[grad_slot, index].copy_(grad)
+
+    def gradients(self, grad_slot, index):
+        """
+        :return: gradient vector like agent.flat, valid until the job is released.
+        """
+        return self.grads[grad_slot, index]
+
+
+def _pool_worker(jobs, integration_q, device, arena=None, template=None):
+    # runs local_evolve jobs until the None sentinel arrives, imports and environments are set up once per process.
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        pid, args = job
+        if arena is not None:
+            # base agents arrive as metadata and are rebuilt around their parameter slots.
+            grad_slot, metas = args[0], args[2]
+            base_agents = [arena.agent(template, meta, device) for meta in metas]
+            args = (args[1], base_agents) + args[3:]
+            local_evolve(integration_q, None, *args, proc=pid, device=device, arena=arena, grad_slot=grad_slot)
+        else:
+            local_evolve(integration_q, None, *args, proc=pid, device=device)
+
+
+class WorkerPool:
+    """
+    Long lived worker processes for EvoController.controller. Workers import and build their environments once, then
+    take one job per epoch (base agents, copies, generations, reward function with its running statistics...) from a
+    shared job queue, and put their results on the integration queue like local_evolve. With a ParameterArena, jobs
+    and results carry no tensors, parameters and gradients are exchanged through the arena's shared memory.
+    """
+
+    def __init__(self, num_workers, integration_q, device="cpu", arena=None, template=None):
+        """
+        :param num_workers: number of worker processes.
+        :param integration_q: queue results are put on.
+        :param device: device the workers compute on.
+        :param arena: optional ParameterArena, jobs then name their base agents by metadata from
+                      ParameterArena.checkout and gradients are returned in the arena.
+        :param template: agent the workers rebuild base agents from, required with an arena. Sent once per worker.
+        """
+        if arena is not None and template is None:
+            raise ValueError("A template agent is required to use a parameter arena.")
+        self.jobs = Queue()
+        self.pending = set()
+        self.processes = [Process(target=_pool_worker, args=(self.jobs, integration_q, device, arena, template))
+                          for _ in range(num_workers)]
+        for p in self.processes:
+            p.start()
+
+    def submit(self, pid, args):
+        """
+        :param pid: id of the job, returned with its result.
+        :param args: local_evolve arguments from generations to critic_random_only. With an arena, the gradient slot
+                     of the job followed by those arguments with the base agents replaced by their metadata.
+        """
+        self.pending.add(pid)
+        self.jobs.put((pid, args))
+
+    def done(self, pid):
+        self.pending.discard(pid)
+
+    def close(self):
+        for _ in self.processes:
+            self.jobs.put(None)
+        for p in self.processes:
+            p.join()
+        self.jobs.close()
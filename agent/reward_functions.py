@@ -1,38 +1,122 @@
+import math
+
 import torch
 
 
-def return_from_reward(rewards, gamma):
+def _discount_matrix(steps, gamma, device=None, dtype=None):
+    """
+    (steps, steps) upper triangular matrix with gamma ** (k - t) in row t, column k >= t. Multiplying it with a
+    (steps, ...) tensor sums the discounted future values of every step at once.
+    """
+    if dtype is None:
+        dtype = torch.get_default_dtype()
+    t = torch.arange(steps, device=device)
+    offset = t.view(1, -1) - t.view(-1, 1)
+    discount = torch.pow(torch.tensor(gamma, device=device, dtype=dtype), offset.clamp(min=0).to(dtype))
+    return discount * (offset >= 0)
+
+
+def length_mask(lengths, steps, device=None):
+    """
+    :param lengths: (agents,) number of valid steps of each agent.
+    :param steps: padded number of steps.
+    :return: (steps, agents) boolean mask, True at the valid steps of each agent.
+    """
+    lengths = torch.as_tensor(lengths, device=device)
+    return torch.arange(steps, device=device).view(-1, 1) < lengths.view(1, -1)
+
+
+def return_from_reward(rewards, gamma, lengths=None):
     """
     Compute the discounted returns for each timestep from a tensor of rewards.
 
     Parameters:
-    - rewards (torch.Tensor): Tensor containing the instantaneous rewards.
+    - rewards (torch.Tensor): Tensor containing the instantaneous rewards, (T,) or (T, agents) padded to a common T.
     - gamma (float): Discount factor (0 < gamma <= 1).
+    - lengths (optional): (agents,) number of valid steps of each agent. Rewards past them are ignored and their
+      returns are 0.
 
     Returns:
-    - torch.Tensor: Tensor containing the discounted returns.
+    - torch.Tensor: Tensor containing the discounted returns, with the shape of rewards.
     """
-    # Initialize an empty tensor to store the returns
-    returns = torch.zeros_like(rewards)
+    steps = rewards.shape[0]
+    if lengths is not None:
+        rewards = torch.where(length_mask(lengths, steps, rewards.device), rewards, 0.)
+    return _discount_matrix(steps, gamma, rewards.device, rewards.dtype) @ rewards
 
-    # Variable to store the accumulated return, initialized to 0
-    G = 0
 
-    # Iterate through the rewards in reverse (from future to past)
-    for t in reversed(range(len(rewards))):
-        # Update the return: G_t = r_t + gamma * G_{t+1}
-        G = rewards[t] + gamma * G
-        returns[t] = G
+def generalized_advantages(rewards, values, gamma, lam, lengths=None):
+    """
+    Generalized advantage estimates, the (gamma * lam) discounted sum of the td errors
+    delta_t = r_t + gamma * V_{t+1} - V_t. The value after the last step of a trajectory is 0.
 
-    return returns
+    Parameters:
+    - rewards (torch.Tensor): (T,) or (T, agents) instantaneous rewards.
+    - values (torch.Tensor): value estimates with the shape of rewards.
+    - gamma (float): Discount factor (0 < gamma <= 1).
+    - lam (float): GAE lambda, 0 gives the one step td error and 1 the discounted return minus the value.
+    - lengths (optional): (agents,) number of valid steps of each agent.
+
+    Returns:
+    - torch.Tensor: Tensor containing the advantages, with the shape of rewards.
+    """
+    steps = rewards.shape[0]
+    if lengths is not None:
+        mask = length_mask(lengths, steps, rewards.device)
+        rewards = torch.where(mask, rewards, 0.)
+        values = torch.where(mask, values, 0.)
+    next_values = torch.cat([values[1:], torch.zeros_like(values[:1])], dim=0)
+    deltas = rewards + gamma * next_values - values
+    return _discount_matrix(steps, gamma * lam, deltas.device, deltas.dtype) @ deltas
 
 
+def _used_steps(lengths):
+    # the last 15 steps of a trajectory only contribute to the returns of earlier steps.
+    return torch.minimum(lengths, torch.clamp(lengths - 15, min=16))
+
+
+def _normalize_returns(stats, returns, mask):
+    """
+    Updates the running return statistics of a loss with each agent in turn, like one loss call per agent, and
+    normalizes every agent's returns with the statistics after its own update. The moments of all agents are read
+    back at once.
+    :param stats: ActorCritic or Reinforce, holds mean, std, count and _stat_gamma.
+    :param returns: (T, agents) returns.
+    :param mask: (T, agents) boolean, the steps that enter the statistics.
+    :return: normalized returns, (agents,) means and (agents,) stds used for each agent.
+    """
+    counts = mask.sum(dim=0)
+    mean = torch.where(mask, returns, 0.).sum(dim=0) / counts
+    var = torch.where(mask, torch.square(returns - mean), 0.).sum(dim=0) / (counts - 1)
+    means = []
+    stds = []
+    for mean, std in torch.stack([mean, torch.sqrt(var)], dim=1).tolist():
+        sg = stats._stat_gamma
+        stats.count += 1
+        sg = sg * (1 - 1 / stats.count)
+        if not math.isnan(mean + std):
+            stats.mean = stats.mean * sg + (1 - sg) * mean
+            stats.std = stats.std * sg + (1 - sg) * std
+        means.append(stats.mean)
+        stds.append(stats.std)
+    means = torch.tensor(means, device=returns.device, dtype=returns.dtype)
+    stds = torch.tensor(stds, device=returns.device, dtype=returns.dtype)
+    return (returns - means) / (stds + 1e-8), means, stds
+
 
 class ActorCritic:
 
-    def __init__(self, gamma, alpha, stat_gamma=.98):
+    def __init__(self, gamma, alpha, stat_gamma=.98, lam=None):
+        """
+        :param gamma: discount factor.
+        :param alpha: weight of the entropy bonus.
+        :param stat_gamma: decay of the running return statistics.
+        :param lam: optional GAE lambda. If set, the actor uses generalized advantage estimates instead of the
+                    normalized return minus the value estimate.
+        """
         self.gamma = gamma
         self.alpha = alpha
+        self.lam = lam
         self.mean = 0.
         self.std = 1.
         self._stat_gamma = stat_gamma
@@ -41,35 +125,48 @@ class ActorCritic:
         self.__name__ = "ActorCritic"
 
     def loss(self, rewards, value_estimates, log_probs, entropies, is_random=None):
-        cutoff = max(16, len(rewards) - 15)
+        if is_random is not None:
+            is_random = is_random.unsqueeze(1)
+        critic_loss, actor_loss = self.loss_batch(rewards.unsqueeze(1), value_estimates.unsqueeze(1),
+                                                  log_probs.unsqueeze(1), entropies.unsqueeze(1), [len(rewards)],
+                                                  is_random)
+        return critic_loss[0], actor_loss[0]
+
+    def loss_batch(self, rewards, value_estimates, log_probs, entropies, lengths, is_random=None):
+        """
+        Critic and actor losses of several agents in one call.
+        :param rewards: (T, agents) instant rewards, padded past each agent's length.
+        :param value_estimates: (T, agents) value estimates.
+        :param log_probs: (T, agents) log likelihoods of the actions taken.
+        :param entropies: (T, agents) entropies of the action distributions.
+        :param lengths: (agents,) number of valid steps of each agent.
+        :param is_random: optional (T, agents) boolean, if given the critic only trains on random actions.
+        :return: (agents,) critic losses and (agents,) actor losses.
+        """
         if self.debug:
             entropies.register_hook(lambda grad: print("Grad H ", torch.abs(grad).sum()))
             log_probs.register_hook(lambda grad: print("Grad LogProb ", torch.abs(grad).sum()))
-        returns = return_from_reward(rewards, self.gamma)[:cutoff]
-        sg = self._stat_gamma
-        self.count += 1
-        sg = sg * (1 - 1 / self.count)
-        mean = returns.mean().detach()
-        std = returns.std().detach()
-        if not torch.isnan(mean + std):
-            self.mean = self.mean * sg + (1 - sg) * mean.item()
-            self.std = self.std * sg + (1 - sg) * (std.item())
-        returns = (returns - self.mean) / (self.std + 1e-8)
+        steps = rewards.shape[0]
+        lengths = torch.as_tensor(lengths, device=rewards.device)
+        mask = length_mask(_used_steps(lengths), steps, rewards.device)
+        returns = return_from_reward(rewards, self.gamma, lengths)
+        returns, means, stds = _normalize_returns(self, returns, mask)
         # compute advantages
-        advantages = returns - value_estimates[:cutoff]
+        advantages = returns - value_estimates
+        if self.lam is None:
+            actor_advantages = advantages
+        else:
+            # values estimate normalized returns, so they are mapped back to the scale of the rewards.
+            values = value_estimates * (stds + 1e-8) + means
+            actor_advantages = generalized_advantages(rewards, values, self.gamma, self.lam, lengths) / (stds + 1e-8)
         # Calculate the critic loss, only where actions are random
         if is_random is not None:
-            masked_td = advantages * is_random[:cutoff].float()
+            masked_td = advantages * is_random.float()
         else:
             masked_td = advantages
-        critic_loss = torch.pow(masked_td, 2).sum()
-        # critic_loss.register_hook(lambda grad: print("Grad C Loss", torch.abs(grad).sum()))
+        critic_loss = torch.where(mask, torch.pow(masked_td, 2), 0.).sum(dim=0)
         # Calculate the actor loss incorporating the entropy term
-        actor_loss = -(log_probs[:cutoff] * advantages.detach() + self.alpha * entropies[:cutoff]).sum()
-        if torch.isnan(critic_loss + actor_loss):
-            print("NAN, returns", returns)
-            print("NAN, V", value_estimates)
-            print("NAN, Prob", log_probs)
+        actor_loss = -torch.where(mask, log_probs * actor_advantages.detach() + self.alpha * entropies, 0.).sum(dim=0)
         return critic_loss, actor_loss
 
     def __add__(self, other):
@@ -94,22 +191,26 @@ class Reinforce:
         self. __name__ = "Reinforce"
 
     def loss(self, rewards, log_probs, entropies):
-        cutoff = max(16, len(rewards) - 15)
-        returns = return_from_reward(rewards, self.gamma)[:cutoff]
-        sg = self._stat_gamma
-        self.count += 1
-        sg = sg * (1 - 1 / self.count)
-        mean = returns.mean().detach()
-        std = returns.std().detach()
-        if not torch.isnan(mean + std):
-            self.mean = self.mean * sg + (1 - sg) * mean.item()
-            self.std = self.std * sg + (1 - sg) * (std.item())
-        returns = (returns - self.mean) / (self.std + 1e-8)
+        return self.loss_batch(rewards.unsqueeze(1), log_probs.unsqueeze(1), entropies.unsqueeze(1),
+                               [len(rewards)])[0]
+
+    def loss_batch(self, rewards, log_probs, entropies, lengths):
+        """
+        Policy losses of several agents in one call.
+        :param rewards: (T, agents) instant rewards, padded past each agent's length.
+        :param log_probs: (T, agents) log likelihoods of the actions taken.
+        :param entropies: (T, agents) entropies of the action distributions.
+        :param lengths: (agents,) number of valid steps of each agent.
+        :return: (agents,) policy losses.
+        """
+        steps = rewards.shape[0]
+        lengths = torch.as_tensor(lengths, device=rewards.device)
+        used = _used_steps(lengths)
+        mask = length_mask(used, steps, rewards.device)
+        returns = return_from_reward(rewards, self.gamma, lengths)
+        returns, _, _ = _normalize_returns(self, returns, mask)
         # Calculate the actor loss incorporating the entropy term
-        policy_loss = -(log_probs[:cutoff] * returns + self.alpha * entropies[:cutoff]).mean()
-        if torch.isnan(policy_loss):
-            print("NAN, returns", returns)
-            print("NAN, Prob", log_probs)
+        policy_loss = -torch.where(mask, log_probs * returns + self.alpha * entropies, 0.).sum(dim=0) / used
         return policy_loss
 
     def __add__(self, other):
@@ -1,6 +1,53 @@
+import copy
+
 import torch
 import numpy as np
+from torch.utils.checkpoint import checkpoint
 from intrinsic.module import PlasticEdges, FCPlasticEdges
+from intrinsic.noise import NoisePool
+
+
+def _init_states(state_shape, instances, device):
+    """
+    Xavier initialized graph states, instances are initialized independently so they match an unbatched model.
+    :param state_shape: shape of the states of a single instance, e.g. (n, c, s, s)
+    :param instances: number of instances on the leading dimension, or None for unbatched states.
+    """
+    if instances is None:
+        return torch.nn.init.xavier_normal_(torch.empty(size=tuple(state_shape), device=device))
+    states = [torch.nn.init.xavier_normal_(torch.empty(size=tuple(state_shape), device=device))
+              for _ in range(instances)]
+    return torch.stack(states)
+
+
+def _instance_states(states, instances, new_instances):
+    """
+    Starting states for an instantiated model. Unbatched states are broadcast to every new instance, batches of a
+    different size can not be mapped and are freshly initialized.
+    """
+    if instances == new_instances:
+        return states
+    if instances is None:
+        return states.unsqueeze(0).expand((new_instances,) + tuple(states.shape))
+    return _init_states(states.shape[1:], new_instances, states.device).to(states.dtype)
+
+
+def _model_like(model, edge, states, device):
+    """
+    Model with the configuration of model built around the given edge and states, without initializing anything.
+    Parameters other than the edge's are still model's, the history and noise streams are fresh. Used by instantiate
+    and clone in place of the constructor.
+    """
+    new_model = copy.copy(model)
+    new_model.instances = edge.instances
+    new_model.device = device
+    new_model.states = states
+    new_model.noise_pool = NoisePool(states.shape, device=device, dtype=model.noise_pool.dtype)
+    new_model.edge = edge.reseed(new_model.noise_pool.seed)
+    if model.past_states is not None:
+        new_model.past_states = []
+    new_model._noise = None
+    return new_model
 
 
 class Intrinsic:
@@ -11,7 +58,8 @@ class Intrinsic:
     def __init__(self, num_nodes, node_shape: tuple = (1, 3, 64, 64), inject_noise=False,
                  edge_module=PlasticEdges, device='cpu', track_activation_history=False,
                  mask=None, kernel_size=3, is_resistive=True, input_mode="overwrite",
-                 optimize_weights=True):
+                 optimize_weights=True, instances=None, edge_list=False, symmetric=False, precision=None,
+                 seed=None):
         """
         :param num_nodes: Number of nodes in the graph.
         :param node_shape: Shape (channels and spatial of each node in the graph.
@@ -20,9 +68,16 @@ class Intrinsic:
         :param device: Hardware device to use for computation.
         :param input_mode: How inputs should be injected into the graph.
         :param track_activation_history: Whether to store the state history
+        :param instances: Number of independent graph instances to step together. If set, states and inputs have a
+                          leading instance dimension. Parameters are shared by all instances.
+        :param edge_list: Whether the edges should only store and compute the node pairs active in the mask.
+        :param symmetric: Whether the graph is undirected, edges only store the upper triangle of node pairs.
+        :param precision: optional intrinsic.precision.PrecisionPolicy, if None the torch default dtype is used.
+        :param seed: seed of the model's noise streams, drawn from the global torch RNG if None.
         """
         super().__init__()
         self.num_nodes = num_nodes
+        self.instances = instances
         self.resistive = is_resistive
         if input_mode not in ["additive", "overwrite"]:
             raise ValueError
@@ -31,21 +86,28 @@ class Intrinsic:
         # how much of previous state to mix into next input.
         # TODO: Perhaps there should be a "resting" state value that is exponentially returned to with time constant
         #  resistance? (tried and seems to make optimization less stable, mb worth revisiting.)
-        self.resistance = torch.nn.Parameter(torch.zeros((num_nodes, node_shape[1], 1, 1), device=device))
+        self.resistance = torch.nn.Parameter(torch.zeros((num_nodes, node_shape[1]) + (1,) * len(node_shape[2:]),
+                                                         device=device))
         # Initialize (n, c, s, s) state matrix using xavier method.
-        states = torch.empty(size=(self.num_nodes, node_shape[1], node_shape[2], node_shape[3]), device=device)
-        self.states = torch.nn.init.xavier_normal_(states)
+        self.states = _init_states((self.num_nodes,) + tuple(node_shape[1:]), instances, device)
+        # state noise is drawn from the model's own stream, the edge uses the same seed on another stream.
+        self.noise_pool = NoisePool(self.states.shape, seed=seed, device=device)
         # (n,n) adjacent matrix mask sets immutable modifier on each edge.
         if mask is None:
             mask = torch.ones((num_nodes, num_nodes), device=device)
 
         self.edge_module = edge_module
-        # edge module takes n x c x s1 x s2 input and returns output of the same shape.
-        self.edge = edge_module(self.num_nodes, node_shape[2], node_shape[3], kernel_size=kernel_size,
+        # edge module takes n x c x s1 x s2 input and returns output of the same shape. Nodes with other than two
+        # spatial dims need an edge_module that takes any number of them, like PlasticEdgesND.
+        self.edge = edge_module(self.num_nodes, *node_shape[2:], kernel_size=kernel_size,
                                 channels=node_shape[1],
                                 device=device, mask=mask, inject_noise=inject_noise, normalize_conv=False,
                                 init_plasticity=.2,
-                                optimize_weights=optimize_weights)
+                                optimize_weights=optimize_weights,
+                                instances=instances,
+                                edge_list=edge_list,
+                                symmetric=symmetric,
+                                seed=self.noise_pool.seed)
 
         # whether to add random gaussian noise at each forward step
         self.inject_noise = inject_noise
@@ -58,18 +120,19 @@ class Intrinsic:
             self.past_states = None
         # hardware device to run stuff on.
         self.device = device
+        # noise buffer, only allocated in inference mode.
+        self._noise = None
+        self.precision = None
+        self.set_precision(precision)
 
-    def instantiate(self):
-        new_model = Intrinsic(self.num_nodes, (1, self.edge.channels, self.edge.spatial1, self.edge.spatial2),
-                              inject_noise=self.inject_noise, edge_module=PlasticEdges, device=self.device,
-                              track_activation_history=self.past_states is not None, mask=self.edge.mask,
-                              kernel_size=self.edge.kernel_size, is_resistive=self.resistive,
-                              input_mode=self.input_mode,
-                              optimize_weights=self.edge.optimize_weights)
-        new_model.states = self.states
-        new_model.edge = self.edge.instantiate()
-        new_model.resistance = self.resistance.clone()
-        return new_model
+    def instantiate(self, instances=None):
+        """
+        Instance of the model sharing its parameters, e.g. one copy of an agent in an episode. It only owns its
+        dynamic state: graph states, plastic weights, activation memory, history and noise streams.
+        :param instances: Number of independent instances to batch in the returned model, None for an unbatched model.
+        """
+        return _model_like(self, self.edge.instantiate(instances=instances),
+                           _instance_states(self.states, self.instances, instances), self.device)
 
     def __call__(self, x=None, mask=None):
         return self.forward(x, mask)
@@ -80,9 +143,11 @@ class Intrinsic:
         :param mask: boolean, optional, required with x. Which state indexes are updatable by x
         :return:
         """
-        h = self.states -1 + torch.normal(0, self.noise, self.states.shape)  # inject noise (and subtract 1?)
-        self.edge.update(h)  # send current activation do local weight update
-        out_activ = self.edge(h).clone()  # get output from all edges.
+        if self._noise is not None:
+            return self._forward_inference(x, mask)
+        noise = self.noise_pool.draw() * self.noise
+        h = self.states -1 + noise  # inject noise (and subtract 1?)
+        out_activ = self.edge.step(h)  # local weight update, then output from all edges.
 
         if x is not None:
             if x.shape == self.states.shape:
@@ -99,17 +164,115 @@ class Intrinsic:
             self.past_states.append(self.states.clone())
         return self.states
 
+    def set_precision(self, precision):
+        """
+        Casts states, parameters and plastic weights to a PrecisionPolicy.
+        :param precision: intrinsic.precision.PrecisionPolicy, or None to keep the current dtypes.
+        :return: self
+        """
+        if precision is None:
+            return self
+        self.precision = precision
+        self.states = self.states.detach().to(precision.compute)
+        self.resistance = torch.nn.Parameter(self.resistance.detach().to(precision.compute))
+        self.edge.set_precision(precision)
+        self.noise_pool.to(dtype=precision.compute)
+        if self._noise is not None:
+            self._noise = torch.empty_like(self.states)
+        return self
+
+    def reseed(self, seed):
+        """
+        Restarts the state and edge noise on new streams, e.g. to give agent copies reproducible noise.
+        :param seed: int
+        :return: self
+        """
+        self.noise_pool.reseed(seed)
+        self.edge.reseed(seed)
+        return self
+
+    def inference(self, enabled=True):
+        """
+        Switches the model in or out of an allocation free inference mode, for rollouts that do not need gradients.
+        State, plastic weight and scratch buffers are allocated once and every tick updates them in place. The returned
+        states are the model's state buffer, so they are overwritten by the next tick.
+        :param enabled: whether to enter or leave inference mode.
+        :return: self
+        """
+        self.edge.inference(enabled)
+        if enabled:
+            self.states = self.states.detach().clone()
+            self._noise = torch.empty_like(self.states)
+        else:
+            self._noise = None
+        return self
+
+    def _forward_inference(self, x=None, mask=None):
+        """
+        forward, with every intermediate written to preallocated buffers.
+        """
+        with torch.no_grad():
+            h = torch.mul(self.noise_pool.draw(), self.noise, out=self._noise).add_(self.states).sub_(1)
+            out_activ = self.edge.step(h)  # view of the edge output buffer.
+            if x is not None:
+                if x.shape != self.states.shape:
+                    raise IndexError
+                if self.input_mode == "overwrite":
+                    out_activ.masked_fill_(mask.bool(), 0.)
+                out_activ.add_(x)
+            self.states.mul_(self.resistance).add_(out_activ)
+        if self.past_states is not None:
+            self.past_states.append(self.states.clone())
+        return self.states
+
+    def rollout(self, inputs=None, masks=None, steps=None, ticks_per_input=1):
+        """
+        Runs several ticks in one call and records the states into a preallocated history.
+        :param inputs: optional. Tensor (T, ...) of inputs, each with the same shape as the states.
+        :param masks: boolean (T, ...), required with inputs. Which state indexes are updatable by each input.
+        :param steps: number of inputs T to run when no inputs are given.
+        :param ticks_per_input: ticks run for each input, the input is injected on the first and the rest let the
+                                states settle.
+        :return: Tensor (T, ...) of the states after each input has settled.
+        """
+        if inputs is not None:
+            steps = inputs.shape[0]
+        elif steps is None:
+            raise ValueError("steps is required when no inputs are given.")
+        history = torch.empty((steps,) + tuple(self.states.shape), device=self.states.device,
+                              dtype=self.states.dtype)
+        # the history replaces per tick appends to past_states.
+        past_states = self.past_states
+        self.past_states = None
+        for t in range(steps):
+            for tick in range(ticks_per_input):
+                if inputs is not None and tick == 0:
+                    self.forward(inputs[t], masks[t])
+                else:
+                    self.forward()
+            history[t] = self.states
+        if past_states is not None:
+            past_states.extend(history.unbind(0))
+        self.past_states = past_states
+        return history
+
     def detach(self, reset_intrinsic=False):
         # detach computational graph
         self.edge.detach(reset_weight=reset_intrinsic)
         if reset_intrinsic:
-            states = torch.zeros_like(self.states)
-            self.states = torch.nn.init.xavier_normal_(states)
-        else:
+            self.states = _init_states(self.states.shape[-(2 + len(self.edge.spatial_shape)):], self.instances,
+                                       self.states.device).to(self.states.dtype)
+        elif self._noise is None:
             self.states = self.states.detach().clone()
         self.past_states = []
         return self
 
+    def named_parameters(self):
+        """
+        :return: list of (name, parameter) in the order of parameters.
+        """
+        return [("edge." + name, p) for name, p in self.edge.named_parameters()] + [("resistance", self.resistance)]
+
     def parameters(self, recurse: bool = True):
         """
         :return: list of parameters that can be optimized by gradient descent.
@@ -121,6 +284,12 @@ class Intrinsic:
         self.resistance.grad = grads[-1]
         self.edge.set_grad(grads[:-1])
 
+    def set_parameters(self, params):
+        # same order as parameters.
+        self.resistance = params[-1]
+        self.edge.set_parameters(params[:-1])
+        return self
+
     def l1(self):
         ps = self.parameters()
         penalty = torch.sum(torch.stack([torch.sum(torch.abs(p)) for p in ps]))
@@ -129,14 +298,8 @@ class Intrinsic:
     def clone(self, fuzzy=False, device=None):
         if device is None:
             device = self.device
-        new_model = Intrinsic(self.num_nodes, (1, self.edge.channels, self.edge.spatial1, self.edge.spatial2),
-                              inject_noise=self.inject_noise, edge_module=PlasticEdges, device=device,
-                              track_activation_history=self.past_states is not None, mask=self.edge.mask,
-                              kernel_size=self.edge.kernel_size, is_resistive=self.resistive,
-                              input_mode=self.input_mode,
-                              optimize_weights=self.edge.optimize_weights)
-        new_model.states = self.states.detach().to(device)
-        new_model.edge = self.edge.clone(fuzzy=fuzzy).to(device)
+        new_model = _model_like(self, self.edge.clone(fuzzy=fuzzy).to(device), self.states.detach().to(device),
+                                device)
         new_model.resistance = torch.nn.Parameter(self.resistance.detach().clone().to(device))
         return new_model
 
@@ -153,7 +316,8 @@ class FCIntrinsic:
     def __init__(self, num_nodes, node_shape: tuple = (1, 3, 64), inject_noise=False,
                  edge_module=FCPlasticEdges, device='cpu', track_activation_history=False,
                  mask=None, is_resistive=True, input_mode="overwrite",
-                 through_time=False, optimize_weights=True, *args, **kwargs):
+                 through_time=False, optimize_weights=True, instances=None, edge_list=False, bptt_window=None,
+                 checkpoint_segment=None, precision=None, seed=None, *args, **kwargs):
         """
         :param num_nodes: Number of nodes in the graph.
         :param node_shape: Shape (channels and spatial of each node in the graph.
@@ -162,8 +326,17 @@ class FCIntrinsic:
         :param device: Hardware device to use for computation.
         :param input_mode: How inputs should be injected into the graph.
         :param track_activation_history: Whether to store the state history
+        :param instances: Number of independent graph instances to step together. If set, states and inputs have a
+                          leading instance dimension. Parameters are shared by all instances.
+        :param edge_list: Whether the edges should only store and compute the node pairs active in the mask.
+        :param bptt_window: With through_time, truncate backpropagation through time every bptt_window ticks.
+        :param checkpoint_segment: With through_time, rollout only keeps the graph state at the start of every
+                                   checkpoint_segment inputs and recomputes the ticks in between during backward.
+        :param precision: optional intrinsic.precision.PrecisionPolicy, if None the torch default dtype is used.
+        :param seed: seed of the model's noise stream, drawn from the global torch RNG if None.
         """
         self.resistive = is_resistive
+        self.instances = instances
         if input_mode not in ["additive", "overwrite"]:
             raise ValueError
         self.input_mode = input_mode
@@ -173,8 +346,9 @@ class FCIntrinsic:
         self.num_nodes = num_nodes
         self.resistance = torch.nn.Parameter(torch.zeros((num_nodes, node_shape[1], 1), device=device) + .5)
         # Initialize (n, c, s, s) state matrix using xavier method.
-        states = torch.empty(size=(self.num_nodes, node_shape[1], node_shape[2]), device=device)
-        self.states = torch.nn.init.xavier_normal_(states)
+        self.states = _init_states((self.num_nodes, node_shape[1], node_shape[2]), instances, device)
+        # state noise is drawn from the model's own stream.
+        self.noise_pool = NoisePool(self.states.shape, seed=seed, device=device)
         # (n,n) adjacent matrix mask sets immutable modifier on each edge.
         if mask is None:
             mask = torch.ones((num_nodes, num_nodes), device=device)
@@ -186,11 +360,17 @@ class FCIntrinsic:
                                 device=device, mask=mask, inject_noise=inject_noise, normalize_conv=False,
                                 init_plasticity=.2,
                                 optimize_weights=optimize_weights,
-                                through_time=through_time)
+                                through_time=through_time,
+                                instances=instances,
+                                edge_list=edge_list)
 
         # whether to add random gaussian noise at each forward step
         self.inject_noise = inject_noise
         self.through_time = through_time
+        self.bptt_window = bptt_window
+        self.checkpoint_segment = checkpoint_segment
+        # ticks since the model was created or reset, used to place truncation points.
+        self._ticks = 0
         if inject_noise:
             self.noise = 0.01  # std deviations of injected noise.
         else:
@@ -203,18 +383,20 @@ class FCIntrinsic:
             self.past_states = None
         # hardware device to run stuff on.
         self.device = device
+        # noise buffer, only allocated in inference mode.
+        self._noise = None
+        self.precision = None
+        self.set_precision(precision)
 
-    def instantiate(self):
-        new_model = FCIntrinsic(self.num_nodes, (1, self.edge.channels, self.edge.spatial),
-                                inject_noise=self.inject_noise, edge_module=FCPlasticEdges, device=self.device,
-                                track_activation_history=self.past_states is not None, mask=self.edge.mask,
-                                is_resistive=self.resistive,
-                                input_mode=self.input_mode,
-                                optimize_weights=self.edge.optimize_weights,
-                                through_time=self.through_time)
-        new_model.states = self.states
-        new_model.edge = self.edge.instantiate()
-        new_model.resistance = self.resistance.clone()
+    def instantiate(self, instances=None):
+        """
+        Instance of the model sharing its parameters, e.g. one copy of an agent in an episode. It only owns its
+        dynamic state: graph states, plastic weights, activation memory, history and noise streams.
+        :param instances: Number of independent instances to batch in the returned model, None for an unbatched model.
+        """
+        new_model = _model_like(self, self.edge.instantiate(instances=instances),
+                                _instance_states(self.states, self.instances, instances), self.device)
+        new_model._ticks = 0
         return new_model
 
     def __call__(self, x=None, mask=None):
@@ -226,9 +408,11 @@ class FCIntrinsic:
         :param mask: boolean, optional, required with x. Which state indexes are updatable by x
         :return:
         """
-        h = self.states + torch.normal(0, self.noise, self.states.shape, device=self.device)  # inject noise (and subtract 1?)
-        self.edge.update(h)  # do local weight update
-        out_activ = self.edge(h).clone()  # get output from all edges.
+        if self._noise is not None:
+            return self._forward_inference(x, mask)
+        noise = self.noise_pool.draw() * self.noise
+        h = self.states + noise  # inject noise (and subtract 1?)
+        out_activ = self.edge.step(h)  # local weight update, then output from all edges.
 
         if x is not None:
             if x.shape == self.states.shape:
@@ -245,18 +429,192 @@ class FCIntrinsic:
         else:
             states = self.states.detach()
         self.states = states * self.resistance + out_activ
+        self._ticks += 1
+        if self.bptt_window is not None and self._ticks % self.bptt_window == 0:
+            self.truncate()
+        if self.past_states is not None:
+            self.past_states.append(self.states.clone())
+        return self.states
+
+    def truncate(self):
+        """
+        Cuts the autograd graph through time without resetting states or plastic weights.
+        """
+        self.states = self.states.detach()
+        self.edge.truncate()
+        return self
+
+    def set_precision(self, precision):
+        """
+        Casts states, parameters and plastic weights to a PrecisionPolicy.
+        :param precision: intrinsic.precision.PrecisionPolicy, or None to keep the current dtypes.
+        :return: self
+        """
+        if precision is None:
+            return self
+        self.precision = precision
+        self.states = self.states.detach().to(precision.compute)
+        self.resistance = torch.nn.Parameter(self.resistance.detach().to(precision.compute))
+        self.edge.set_precision(precision)
+        self.noise_pool.to(dtype=precision.compute)
+        if self._noise is not None:
+            self._noise = torch.empty_like(self.states)
+        return self
+
+    def reseed(self, seed):
+        """
+        Restarts the state and edge noise on new streams, e.g. to give agent copies reproducible noise.
+        :param seed: int
+        :return: self
+        """
+        self.noise_pool.reseed(seed)
+        self.edge.reseed(seed)
+        return self
+
+    def inference(self, enabled=True):
+        """
+        Switches the model in or out of an allocation free inference mode, for rollouts that do not need gradients.
+        State, plastic weight and scratch buffers are allocated once and every tick updates them in place. The returned
+        states are the model's state buffer, so they are overwritten by the next tick.
+        :param enabled: whether to enter or leave inference mode.
+        :return: self
+        """
+        self.edge.inference(enabled)
+        if enabled:
+            self.states = self.states.detach().clone()
+            self._noise = torch.empty_like(self.states)
+        else:
+            self._noise = None
+        return self
+
+    def _forward_inference(self, x=None, mask=None):
+        """
+        forward, with every intermediate written to preallocated buffers.
+        """
+        with torch.no_grad():
+            h = torch.mul(self.noise_pool.draw(), self.noise, out=self._noise).add_(self.states)
+            out_activ = self.edge.step(h)  # view of the edge output buffer.
+            if x is not None:
+                if x.shape != self.states.shape:
+                    raise IndexError
+                if self.input_mode == "overwrite":
+                    out_activ.masked_fill_(mask.bool(), 0.)
+                out_activ.add_(x)
+            self.states.mul_(self.resistance).add_(out_activ)
         if self.past_states is not None:
             self.past_states.append(self.states.clone())
         return self.states
 
+    def rollout(self, inputs=None, masks=None, steps=None, ticks_per_input=1):
+        """
+        Runs several ticks in one call and records the states into a preallocated history.
+        :param inputs: optional. Tensor (T, ...) of inputs, each with the same shape as the states.
+        :param masks: boolean (T, ...), required with inputs. Which state indexes are updatable by each input.
+        :param steps: number of inputs T to run when no inputs are given.
+        :param ticks_per_input: ticks run for each input, the input is injected on the first and the rest let the
+                                states settle.
+        :return: Tensor (T, ...) of the states after each input has settled.
+        """
+        if inputs is not None:
+            steps = inputs.shape[0]
+        elif steps is None:
+            raise ValueError("steps is required when no inputs are given.")
+        history = torch.empty((steps,) + tuple(self.states.shape), device=self.states.device,
+                              dtype=self.states.dtype)
+        # the history replaces per tick appends to past_states.
+        past_states = self.past_states
+        self.past_states = None
+        if self.checkpoint_segment is not None and self.through_time and torch.is_grad_enabled() \
+                and self._noise is None:
+            for start in range(0, steps, self.checkpoint_segment):
+                stop = min(start + self.checkpoint_segment, steps)
+                seg_inputs = None if inputs is None else inputs[start:stop]
+                seg_masks = None if masks is None else masks[start:stop]
+                history[start:stop], self.states, edge_state = checkpoint(
+                    self._rollout_segment, seg_inputs, seg_masks, stop - start, ticks_per_input, self._ticks,
+                    self.states, self.edge._get_plastic_state(), self.noise_pool.position, use_reentrant=False)
+                self.edge._set_plastic_state(edge_state)
+                self._ticks += (stop - start) * ticks_per_input
+                self.noise_pool.position += (stop - start) * ticks_per_input
+        else:
+            for t in range(steps):
+                for tick in range(ticks_per_input):
+                    if inputs is not None and tick == 0:
+                        self.forward(inputs[t], masks[t])
+                    else:
+                        self.forward()
+                history[t] = self.states
+        if past_states is not None:
+            past_states.extend(history.unbind(0))
+        self.past_states = past_states
+        return history
+
+    def _rollout_segment(self, inputs, masks, steps, ticks_per_input, ticks, states, edge_state, noise_position):
+        """
+        One checkpointed rollout segment. It runs from the given graph state and restores the model afterwards, so it
+        can be recomputed during the backward pass without touching the live model. The noise stream is rewound to
+        noise_position, so the recomputation sees the same noise.
+        :return: history of the segment, and the final states and plastic state of the edge.
+        """
+        saved = (self.states, self.edge._get_plastic_state(), self._ticks, self.noise_pool.position)
+        self.states, self._ticks, self.noise_pool.position = states, ticks, noise_position
+        self.edge._set_plastic_state(edge_state)
+        history = []
+        for t in range(steps):
+            for tick in range(ticks_per_input):
+                if inputs is not None and tick == 0:
+                    self.forward(inputs[t], masks[t])
+                else:
+                    self.forward()
+            history.append(self.states)
+        out = (torch.stack(history), self.states, self.edge._get_plastic_state())
+        self.states, edge_state, self._ticks, self.noise_pool.position = saved
+        self.edge._set_plastic_state(edge_state)
+        return out
+
+    def memory_plan(self, steps, ticks_per_input=1):
+        """
+        Estimates what the autograd graph of a rollout holds under the current through_time, bptt_window and
+        checkpoint_segment settings. Only the (N, N) sized tensors saved by each tick of the edge are counted, with
+        N = nodes * spatial * channels.
+        :param steps: number of inputs in the rollout.
+        :param ticks_per_input: ticks run for each input.
+        :return: dict with the ticks held in the graph, ticks recomputed during backward, and the peak saved elements
+                 and bytes.
+        """
+        ticks = steps * ticks_per_input
+        size = self.num_nodes * self.edge.spatial * self.edge.channels
+        batch = 1 if self.instances is None else self.instances
+        # plastic weight, permuted update weight, gated outer product and composed forward weight.
+        tick_elements = 4 * batch * size ** 2
+        stored = ticks if self.through_time else 1
+        if self.bptt_window is not None:
+            stored = min(stored, self.bptt_window)
+        recomputed = 0
+        peak = stored * tick_elements
+        if self.checkpoint_segment is not None and self.through_time:
+            # each segment keeps its starting plastic weights, only one segment is live at a time.
+            segments = -(-steps // self.checkpoint_segment)
+            stored = min(stored, self.checkpoint_segment * ticks_per_input)
+            peak = segments * batch * size ** 2 + stored * tick_elements
+            recomputed = ticks
+        return {"ticks": ticks, "stored_ticks": stored, "recomputed_ticks": recomputed, "peak_elements": peak,
+                "peak_bytes": peak * self.states.element_size()}
+
     def detach(self, reset_intrinsic=False):
         # detach computational graph
         self.edge.detach(reset_weight=reset_intrinsic)
-        states = torch.zeros_like(self.states)
-        self.states = torch.nn.init.xavier_normal_(states)
+        self.states = _init_states(self.states.shape[-3:], self.instances, self.states.device).to(self.states.dtype)
+        self._ticks = 0
         self.past_states = []
         return self
 
+    def named_parameters(self):
+        """
+        :return: list of (name, parameter) in the order of parameters.
+        """
+        return [("edge." + name, p) for name, p in self.edge.named_parameters()] + [("resistance", self.resistance)]
+
     def parameters(self, recurse: bool = True):
         """
         :return: list of parameters that can be optimized by gradient descent.
@@ -268,6 +626,12 @@ class FCIntrinsic:
         self.resistance.grad = grads[-1]
         self.edge.set_grad(grads[:-1])
 
+    def set_parameters(self, params):
+        # same order as parameters.
+        self.resistance = params[-1]
+        self.edge.set_parameters(params[:-1])
+        return self
+
     def l1(self):
         ps = self.parameters()
         penalty = torch.sum(torch.stack([torch.sum(torch.abs(p)) for p in ps]))
@@ -276,14 +640,10 @@ class FCIntrinsic:
     def clone(self, fuzzy=False, device=None):
         if device is None:
             device = self.device
-        new_model = FCIntrinsic(self.num_nodes, (1, self.edge.channels, self.edge.spatial),
-                              inject_noise=self.inject_noise, edge_module=FCPlasticEdges, device=device,
-                              track_activation_history=self.past_states is not None, mask=self.edge.mask,
-                              is_resistive=self.resistive, input_mode=self.input_mode, optimize_weights=self.edge.optimize_weights,
-                              through_time=self.through_time)
-        new_model.states = self.states.detach().to(device)
-        new_model.edge = self.edge.clone(fuzzy=fuzzy).to(device)
+        new_model = _model_like(self, self.edge.clone(fuzzy=fuzzy).to(device), self.states.detach().to(device),
+                                device)
         new_model.resistance = torch.nn.Parameter(self.resistance.detach().clone().to(device))
+        new_model._ticks = 0
         return new_model
 
     def to(self, device):
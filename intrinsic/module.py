@@ -1,12 +1,30 @@
+import copy
+import itertools
+import math
 import random
 
 import torch
 from intrinsic import util
+from intrinsic.noise import NoisePool
+
+
+def _perturbed(param, fuzzy, like=None):
+    """
+    Detached copy of a parameter, used by clone. With fuzzy, gaussian noise with a random fraction (.1 to .6) of the
+    std of like (param if None) is added.
+    """
+    param = param.detach().clone()
+    if fuzzy:
+        if like is None:
+            like = param
+        param += torch.randn_like(param) * float(like.std()) * (.5 * random.random() + .1)
+    return torch.nn.Parameter(param)
 
 
 class PlasticEdges():
     def __init__(self, num_nodes, spatial1, spatial2, kernel_size, channels, device='cpu',
-                 mask=None, optimize_weights=True, debug=False, **kwargs):
+                 mask=None, optimize_weights=True, debug=False, instances=None, contraction_plan="auto",
+                 plan_budget=2 ** 22, edge_list=False, symmetric=False, precision=None, **kwargs):
         """
         Designed to operate on a (n, c, s, s) intrinsic graph. Defines a convolutional edge with a Hebbian-like
         local update function between each node and each channel on the graph.
@@ -19,6 +37,18 @@ class PlasticEdges():
         :param mask: A user defined mask as a (n, n) adj matrix to modify node to node weights.
         :param optimize_weights: Whether to fit the initial convolutional weights using gradient decent.
         :param debug: Whether to print info about gradients and current states at runtime
+        :param instances: Number of independent instances to step together. If None, states are (n, c, s, s),
+                          otherwise states are (instances, n, c, s, s) and each instance has its own plastic weights.
+        :param contraction_plan: Order of the forward contraction, one of "auto", "compose", "reduce" or "stream".
+        :param plan_budget: Max per-step intermediate size (elements) before "auto" switches to the streamed plan.
+        :param edge_list: If True, the mask is compiled into a list of active (source, target) edges and plastic
+                          weights are only stored and computed for those edges, so cost scales with the number of
+                          edges rather than num_nodes ** 2. The mask is fixed once compiled.
+        :param symmetric: If True, the graph is undirected. Weights, channel map and plasticity are only stored for
+                          the upper triangle of node pairs and each stored edge (u, v) is used in both directions, its
+                          hebbian update is the mean of the u -> v and v -> u coactivations. Implies edge_list and
+                          needs a symmetric mask.
+        :param precision: optional PrecisionPolicy, if None everything uses the torch default dtype.
         :param kwargs: addition keyword arguments.
         """
         # The activation memory tracks the last state of the model. It is necessary for computing the intrinsic edge
@@ -26,62 +56,224 @@ class PlasticEdges():
         self.activation_memory = None
         self.optimize_weights = optimize_weights
         self.num_nodes = num_nodes
-        self.kernel_size, self.pad = util.conv_identity_params(in_spatial=spatial1, desired_kernel=kernel_size)
-        self.channels = channels
+        self.instances = instances
+        if contraction_plan not in ["auto", "compose", "reduce", "stream"]:
+            raise ValueError("Unknown contraction plan", contraction_plan)
+        self.contraction_plan = contraction_plan
+        self.plan_budget = plan_budget
+        # contraction plans chosen for each input shape, and the plan used on the last forward pass.
+        self._plans = {}
+        self.plan = None
+        # preallocated buffers used in inference mode, None otherwise.
+        self._scratch = None
+        # whether steps track gradients, edge lists have no preallocated step and run the ordinary one in inference.
+        self._inference = False
         self.spatial1 = spatial1
         self.spatial2 = spatial2
+        self.kernel_size, self.pad = util.conv_identity_params(in_spatial=min(self.spatial_shape),
+                                                               desired_kernel=kernel_size)
+        self.channels = channels
 
         # mask has shape (nodes, nodes) and allows us to predefine a graph structure besides fully connected.
         if mask is None:
             mask = torch.ones((num_nodes, num_nodes), device=device)
         self.mask = mask.to(device)
+        if symmetric and not torch.equal(self.mask, self.mask.T):
+            raise ValueError("Symmetric edges need a symmetric mask.")
+        self.symmetric = symmetric
+        self.edge_list = edge_list or symmetric
+        self._compile_edges()
 
         # initial weight parameter
-        self.init_weight = torch.zeros((num_nodes, num_nodes,
-                                        1, 1,
-                                        self.channels, self.channels, self.kernel_size, self.kernel_size),
-                                       device=device)  # 8D Tensor.
+        self.init_weight = torch.zeros(self._pair_dims() + (1,) * len(self.spatial_shape) +
+                                       (self.channels, self.channels) + self._kernel_shape(),
+                                       device=device)  # 8D Tensor for 2D nodes.
         self.init_weight = torch.nn.init.xavier_normal_(self.init_weight * .1)
         if optimize_weights:
             self.init_weight = torch.nn.Parameter(self.init_weight)
 
         # Non-Parametric Weights used for intrinsic update
-        self.weight = None  # (n, n, s, s, c, c, k, k)
+        self.weight = None  # (n, n, s, s, c, c, k, k), or (e, s, s, c, c, k, k) in edge list mode
+        # (n, n, c, c, k * k) base of the weights while they are still spatially uniform, else None.
+        self._weight_base = None
 
         # Channel Mapping
-        chan_map = torch.empty((num_nodes, num_nodes, channels, channels), device=device)
+        chan_map = torch.empty(self._pair_dims() + (channels, channels), device=device)
         self.chan_map = torch.nn.Parameter(torch.nn.init.xavier_normal_(chan_map * .01))
         self.chan_mod = torch.tensor([0.], device=device)
+        # the channel map noise is drawn from the edge's own stream, scaled like xavier_normal_ on the channel map.
+        self._chan_noise_std = .001 * util.xavier_std(self.chan_map.shape)
+        self.noise_pool = NoisePool(self.chan_map.shape, seed=kwargs.get("seed"), stream=1, device=device)
 
         if "init_plasticity" in kwargs:
             init_plasticity = kwargs["init_plasticity"]
         else:
             init_plasticity = .1
         self.plasticity = torch.nn.Parameter(
-            torch.ones((num_nodes, num_nodes, channels, channels), device=device) * init_plasticity)
+            torch.ones(self._pair_dims() + (channels, channels), device=device) * init_plasticity)
         self.device = device
+        self._init_folding()
+        self.debug = False
+        self.precision = None
+        self.set_precision(precision)
+
+    @property
+    def spatial_shape(self):
+        # spatial dims of each node.
+        return (self.spatial1, self.spatial2)
+
+    def _kernel_shape(self):
+        return (self.kernel_size,) * len(self.spatial_shape)
+
+    def _flat_sizes(self):
+        # number of spatial locations and of kernel offsets, the contraction runs on both flattened.
+        return math.prod(self.spatial_shape), self.kernel_size ** len(self.spatial_shape)
+
+    def _init_folding(self):
         self.unfolder = torch.nn.Unfold(kernel_size=self.kernel_size, padding=self.pad)
         self.folder = torch.nn.Fold(kernel_size=self.kernel_size,
-                                    output_size=(spatial1, spatial2),
+                                    output_size=self.spatial_shape,
                                     padding=self.pad)
-        self.debug = False
+
+    def _unfold(self, x):
+        # (b, c, s1, s2) -> (b, c * k * k, s1 * s2) receptive fields
+        return self.unfolder(x)
+
+    def _fold(self, x):
+        # (b, c * k * k, s1 * s2) -> (b, c, s1, s2), overlapping receptive fields are summed.
+        return self.folder(x)
 
     def _expand_base_weights(self, in_weight):
-        # adds explicit spatial dims to weights
+        # adds explicit spatial dims to weights. The expanded weights are a broadcast view of the spatially uniform
+        # base weights, memory for each location is only allocated once the hebbian update makes them diverge.
+        base_shape = self._pair_dims() + (1,) * len(self.spatial_shape) + \
+                     (self.channels, self.channels) + self._kernel_shape()
         if len(self.init_weight.shape) == 1:
-            expanded_weights = torch.ones((self.num_nodes, self.num_nodes, self.spatial1, self.spatial2, self.channels,
-                                           self.channels, self.kernel_size,
-                                           self.kernel_size)) * self.init_weight.clone()
-        elif self.init_weight.shape[4] == 1:
-            expanded_weights = torch.sigmoid(
-                torch.tile(in_weight.clone(), (1, 1, self.spatial1, self.spatial2, self.channels, self.channels, 1, 1)))
+            base = self._compute(self.init_weight).expand(base_shape)
         else:
-            expanded_weights = torch.sigmoid(
-                torch.tile(in_weight.clone(), (1, 1, self.spatial1, self.spatial2, 1, 1, 1, 1)))
+            base = torch.sigmoid(self._compute(in_weight)).expand(base_shape)
+        if self.edge_list:
+            base = self._edge_params(base)
+        self._weight_base = base.reshape(self._edge_dims() + (self.channels, self.channels, self._flat_sizes()[1]))
+        expanded_weights = base.expand(self._edge_dims() + self.spatial_shape + (self.channels, self.channels) +
+                                       self._kernel_shape())
+        if self.instances is not None:
+            # every instance starts from the same weights, they only diverge once updated.
+            expanded_weights = expanded_weights.unsqueeze(0).expand((self.instances,) + tuple(expanded_weights.shape))
         return expanded_weights
 
+    def _compile_edges(self):
+        # active (source, target) node pairs of the mask, only used in edge list mode.
+        self._pairs = None
+        if self.symmetric:
+            # upper triangle only, and the index of each edge into the packed (n * (n + 1) / 2) node pair params.
+            self._src, self._dst = util.mask_to_edges(torch.triu(self.mask))
+            self._pairs = self._src * self.num_nodes - self._src * (self._src - 1) // 2 + self._dst - self._src
+        elif self.edge_list:
+            self._src, self._dst = util.mask_to_edges(self.mask)
+        else:
+            self._src = self._dst = None
+
+    def _pair_dims(self):
+        # leading dims of the node pair parameters, packed upper triangle pairs in symmetric mode.
+        if self.symmetric:
+            return (self.num_nodes * (self.num_nodes + 1) // 2,)
+        return (self.num_nodes, self.num_nodes)
+
+    def _edge_params(self, params):
+        # rows of a node pair tensor for each stored edge.
+        if self.symmetric:
+            return params[self._pairs]
+        return params[self._src, self._dst]
+
+    def _square(self, params):
+        # full (n, n, ...) node pair tensor, the packed triangle is mirrored in symmetric mode.
+        if self.symmetric:
+            return util.triu_to_square(params, self.num_nodes, includes_diag=True)
+        return params
+
+    def _directions(self):
+        """
+        (source nodes, target nodes, mask scale) of the messages sent along the stored edges. Symmetric edges also send
+        from target to source, diagonal edges are only sent once.
+        """
+        directions = [(self._src, self._dst, self.mask[self._src, self._dst])]
+        if self.symmetric:
+            directions.append((self._dst, self._src, self.mask[self._dst, self._src] * (self._src != self._dst)))
+        return directions
+
+    def _edge_dims(self):
+        # leading weight dims indexing node -> node maps.
+        if self.edge_list:
+            return (len(self._src),)
+        return (self.num_nodes, self.num_nodes)
+
+    def _compute(self, tensor):
+        # cast to the compute dtype of the precision policy.
+        if self.precision is None:
+            return tensor
+        return tensor.to(self.precision.compute)
+
+    def _accumulate(self, weight):
+        # plastic weights are updated in the accumulate dtype of the precision policy.
+        if self.precision is None:
+            return weight
+        return weight.to(self.precision.accumulate)
+
+    def set_precision(self, precision):
+        """
+        Casts parameters and plastic weights to a PrecisionPolicy.
+        :param precision: PrecisionPolicy, or None to keep the current dtypes.
+        :return: self
+        """
+        if precision is None:
+            return self
+        self.precision = precision
+        if self.optimize_weights:
+            self.init_weight = torch.nn.Parameter(self.init_weight.detach().to(precision.compute))
+        else:
+            self.init_weight = self.init_weight.to(precision.init_storage)
+        self.chan_map = torch.nn.Parameter(self.chan_map.detach().to(precision.compute))
+        self.plasticity = torch.nn.Parameter(self.plasticity.detach().to(precision.compute))
+        self.chan_mod = self.chan_mod.to(precision.compute)
+        self.mask = self.mask.to(precision.compute)
+        self.noise_pool.to(dtype=precision.compute)
+        if self._weight_base is not None:
+            self.weight = self._expand_base_weights(self.init_weight)
+        elif self.weight is not None:
+            self.weight = self._accumulate(self.weight.detach())
+        return self
+
+    def _num_instances(self):
+        # an unbatched edge is computed as a batch with a single instance.
+        if self.instances is None:
+            return 1
+        return self.instances
+
+    def _weight_shape(self):
+        shape = self._edge_dims() + self.spatial_shape + (self.channels, self.channels) + self._kernel_shape()
+        if self.instances is not None:
+            shape = (self.instances,) + shape
+        return shape
+
+    def _check_input(self, x):
+        dims = 2 + len(self.spatial_shape)
+        if self.instances is None:
+            if len(x.shape) != dims:
+                raise ValueError("Input Tensor Must Be " + str(dims) + "D, not shape", x.shape)
+            if x.shape[0] != self.num_nodes:
+                raise ValueError("Input Tensor must have number of nodes on batch dimension.")
+        else:
+            if len(x.shape) != dims + 1:
+                raise ValueError("Batched Input Tensor Must Be " + str(dims + 1) + "D, not shape", x.shape)
+            if x.shape[0] != self.instances or x.shape[1] != self.num_nodes:
+                raise ValueError("Batched Input Tensor must have instances then nodes on leading dimensions.")
+
+    def named_parameters(self):
+        return [("chan_map", self.chan_map), ("plasticity", self.plasticity), ("init_weight", self.init_weight)]
+
     def parameters(self):
-        params = [self.chan_map, self.plasticity, self.init_weight]
+        params = [p for _, p in self.named_parameters()]
         return params
 
     def set_grad(self, grads):
@@ -89,72 +281,243 @@ class PlasticEdges():
         self.plasticity.grad = grads[1]
         self.init_weight.grad = grads[2]
 
+    def set_parameters(self, params):
+        """
+        Replaces the parameters, in the order of parameters(), e.g. with views of shared memory. The plastic weights
+        are reset to the new initial weights.
+        """
+        for (name, _), param in zip(self.named_parameters(), params):
+            setattr(self, name, param)
+        return self.detach(reset_weight=True)
+
     def __call__(self, x):
         return self.forward(x)
 
-    def forward(self, x):
+    def _select_plan(self, batch):
         """
-        The forward pass on all edges. Takes (n, c, s, s) state as input, computes activation function on it, and sends
-        through the current weight matrix and channel map matrix. Returns a state update matrix with the same shape ad
-        the input, i.e. (n, c, s, s).
-        :param x: Tensor, Input intrinsic graph states (n, c, s, s)
-        :return: Tensor, update in the same space as x - (n, c, s, s)
+        Chooses the order of the forward contraction for the current shapes. Plans are estimated once per shape and
+        cached, the chosen plan is reported in self.plan. Sizes are counted in tensor elements.
+          compose - composes weight and channel map first, materializing a (z, n, n, s, c, c, k) weight every step.
+          reduce - reduces the source node and channel dims of the weight first, then maps channels on the reduced
+                   activations. One einsum, but it still copies the weight into matmul layout internally.
+          stream - accumulates the reduction one (source node, channel) slice at a time in place, so the only
+                   per-step tensors are the size of the output. Costs n * c kernel launches.
+          edges - used in edge list mode, each active edge maps its source activations and the messages are summed
+                  into their target nodes.
+        :param batch: number of instances in the batch
+        :return: dict describing the chosen plan.
         """
-        if self.weight is None:
-            self.weight = self._expand_base_weights(self.init_weight)
-        x = x.to(self.device)  # nodes, channels, spatial1, spatial2
+        spatial, k = self._flat_sizes()
+        key = (batch, spatial, self.channels, k, self.mask.data_ptr())
+        if key in self._plans:
+            self.plan = self._plans[key]
+            return self.plan
+        n, c = self.num_nodes, self.channels
+        weight_size = batch * n * n * spatial * c * c * k
+        reduced_size = batch * n * spatial * c * k
+        unit_mask = bool(torch.all(self.mask == 1))
+        masked_size = 0 if unit_mask else batch * n * n * spatial * c * k
+        map_flops = reduced_size * n * c
+        edge_weight_size = batch * len(self.mask.nonzero()) * spatial * c * c * k
+        costs = {"compose": {"peak": 3 * weight_size, "flops": weight_size * n * c + 2 * weight_size},
+                 "reduce": {"peak": weight_size + masked_size + reduced_size, "flops": 2 * weight_size + map_flops},
+                 "stream": {"peak": 2 * reduced_size, "flops": 2 * weight_size + map_flops},
+                 "edges": {"peak": edge_weight_size // c + reduced_size, "flops": 2 * edge_weight_size + map_flops}}
+        if self.edge_list:
+            name = "edges"
+        elif self.contraction_plan != "auto":
+            name = self.contraction_plan
+        elif costs["reduce"]["peak"] <= self.plan_budget:
+            # fits in budget, fewer launches wins.
+            name = "reduce"
+        else:
+            name = "stream"
+        plan = {"name": name, "peak": costs[name]["peak"], "flops": costs[name]["flops"], "unit_mask": unit_mask,
+                "costs": costs}
+        if self.debug:
+            print("Using", name, "contraction plan for", key[:4], plan)
+        self._plans[key] = plan
+        self.plan = plan
+        return plan
+
+    def _contract(self, xufld, batch):
+        """
+        Contracts unfolded activations with the masked plastic weights and channel map, following the plan chosen by
+        _select_plan.
+        :param xufld: unfolded activations (z, u, 1, s, c, k)
+        :param batch: number of instances in the batch
+        :return: Tensor (z, v, s, o, k) of mapped activations for each target node.
+        """
+        plan = self._select_plan(batch)
+        spatial, k = self._flat_sizes()
+        weight = self._compute(self.weight).reshape((batch,) + self._edge_dims() + (spatial, self.channels,
+                                                                                    self.channels, k))
+
+        # add random noise to chan map to prevent it from becoming nonsingular
+        self.chan_mod = (self.noise_pool.draw() * self._chan_noise_std -
+                         torch.eye(self.channels, self.channels, device=self.device, dtype=self.chan_map.dtype) * .001)
+        chan_map = self._square(self.chan_map + self.chan_mod)
+
+        if plan["name"] == "compose":
+            # weights are zeroed for node -> node maps that are masked.
+            combined_weight = weight * self.mask.view(1, self.num_nodes, self.num_nodes, 1, 1, 1, 1)
+            # Compose plastic weights and channel map
+            iterrule = "zuvscok, vbop -> zubscpk"
+            combined_weight = torch.einsum(iterrule, combined_weight, chan_map)
+
+            # instance (z), src_nodes (u), target_node (v), flat_spatial (s), channels (c), flat_kernel (k)
+            # instance (z), src_nodes (u), target_node (v), flat_spatial (s), in_channels (c), out_channels (o), flat_kernel (k)
+            # this einsum will sum across source node dimension and map channels in parallel.
+            iter_rule = "zuvsck, zuvscok -> zvsok"
+            return torch.einsum(iter_rule, xufld, combined_weight)
+
+        xufld = xufld.view((batch, self.num_nodes, spatial, self.channels, k))
+        if plan["name"] == "edges":
+            # messages are only computed for active edges, then summed into their target nodes. Symmetric edges
+            # contract both directions against the same packed weights.
+            reduced = torch.zeros((batch, self.num_nodes, spatial, self.channels, k), device=xufld.device,
+                                  dtype=xufld.dtype)
+            for src, dst, scale in self._directions():
+                if self._weight_base is not None:
+                    message = torch.einsum("zesck, ecok -> zesok", xufld[:, src],
+                                           self._weight_base * scale.view(-1, 1, 1, 1))
+                else:
+                    message = torch.einsum("zesck, zescok -> zesok", xufld[:, src] * scale.view(1, -1, 1, 1, 1),
+                                           weight)
+                reduced = reduced.index_add(1, dst, message)
+        elif self._weight_base is not None:
+            # weights are still the uniform init, so contract against the small (n, n, c, c, k) base directly.
+            base = self._weight_base * self.mask.view(self.num_nodes, self.num_nodes, 1, 1, 1)
+            reduced = torch.einsum("zusck, uvcok -> zvsok", xufld, base)
+        elif plan["name"] == "reduce":
+            if plan["unit_mask"]:
+                reduced = torch.einsum("zusck, zuvscok -> zvsok", xufld, weight)
+            else:
+                # the mask is applied to the (smaller) activations instead of the weights.
+                reduced = torch.einsum("zusck, uv, zuvscok -> zvsok", xufld, self.mask, weight)
+        elif plan["name"] == "stream":
+            reduced = torch.zeros((batch, self.num_nodes, spatial, self.channels, k), device=xufld.device,
+                                  dtype=xufld.dtype)
+            for u in range(self.num_nodes):
+                for c in range(self.channels):
+                    src = xufld[:, u, :, c, :].unsqueeze(1).unsqueeze(3)  # z, 1, s, 1, k
+                    if not plan["unit_mask"]:
+                        src = src * self.mask[u].view(1, self.num_nodes, 1, 1, 1)
+                    reduced = reduced.addcmul_(src, weight[:, u, :, :, c])  # z, v, s, o, k
+        else:
+            raise ValueError("Unknown contraction plan", plan["name"])
+        # channel map is applied after the source nodes are reduced, so the composed weight is never formed.
+        return torch.einsum("zvsok, vbop -> zbspk", reduced, chan_map)
+
+    def _activate(self, x):
+        """
+        Computes the sigmoid activation of a state and unfolds it into receptive fields. The unfolded activation is
+        what the contraction, the hebbian update and the activation memory all operate on.
+        :param x: Tensor, intrinsic graph states ((z), n, c, s, s)
+        :return: Tensor, unfolded activations (z, n, 1, s * s, c, k * k)
+        """
+        x = x.to(self.device)  # (instances), nodes, channels, spatial...
         x = torch.sigmoid(x)  # compute sigmoid activation on range [0, 1]
-        if len(x.shape) != 4:
-            raise ValueError("Input Tensor Must Be 4D, not shape", x.shape)
-        if x.shape[0] != self.num_nodes:
-            raise ValueError("Input Tensor must have number of nodes on batch dimension.")
+        self._check_input(x)
         if (torch.max(x) > 1 or torch.min(x) < 0) and self.debug:
             print("WARN: Reverb  input activations are expected to have range 0 to 1")
-        xufld = self.unfolder(x).transpose(1, 2)  # nodes, spatial1 * spatial2, channels * kernel * kernel
-        xufld = xufld.view((self.num_nodes, 1, self.spatial1 * self.spatial2, self.channels, self.kernel_size ** 2))
+        batch = self._num_instances()
+        spatial, k = self._flat_sizes()
+        xufld = self._unfold(x.reshape((batch * self.num_nodes, self.channels) + self.spatial_shape))
+        xufld = xufld.transpose(1, 2)  # instances * nodes, spatial1 * spatial2, channels * kernel * kernel
         # unfolded states will broadcast over input node dim.
+        xufld = xufld.view((batch, self.num_nodes, 1, spatial, self.channels, k))
+        return xufld
 
-        self.activation_memory = xufld.clone()
-
-        # weights are zeroed for node -> node maps that are masked.
-        combined_weight = self.weight * self.mask.view(self.num_nodes, self.num_nodes, 1, 1, 1, 1, 1, 1)
-        combined_weight = combined_weight.view(
-            (self.num_nodes, self.num_nodes, self.spatial1 * self.spatial2, self.channels, self.channels,
-             self.kernel_size ** 2))
-
-        # add random noise to chan map to prevent it from becoming nonsingular
-        chan_mod = torch.empty_like(self.chan_map)
-        self.chan_mod = (torch.nn.init.xavier_normal_(chan_mod) * .001 -
-                         torch.eye(self.channels, self.channels,
-                                   device=self.device).view((1, 1, self.channels, self.channels)) * .001)
-        # self.chan_map = self.chan_map + chan_mod
-
-        # Compose plastic weights and channel map
-        # uvscok,
-        # combined_weight = combined_weight * self.chan_map.view((self.num_nodes, self.num_nodes, 1, self.channels, self.channels, 1))
-        iterrule = "uvscok, vbop -> ubscpk"
-        combined_weight = torch.einsum(iterrule, combined_weight, (self.chan_map + chan_mod))
-
-        # src_nodes (u), target_node (v), flat_spatial (s), channels (c), flat_kernel (k)
-        # src_nodes (u), target_node (v), flat_spatial (s), in_channels (c), out_channels (o), flat_kernel (k)
-        # this einsum will sum across source node dimension and map channels in parallel.
-        iter_rule = "uvsck, uvscok -> vsok"
-        mapped_meta = torch.einsum(iter_rule, xufld, combined_weight)
+    def _propagate(self, xufld, out_shape):
+        """
+        Sends unfolded activations through the plastic weights and channel map and folds the result back to state
+        space.
+        :param xufld: unfolded activations from _activate
+        :param out_shape: shape of the state space
+        :return: Tensor, update in state space
+        """
+        if self.weight is None:
+            self.weight = self._expand_base_weights(self.init_weight)
+        batch = self._num_instances()
+        mapped_meta = self._contract(xufld, batch)
         if self.debug:
             mapped_meta.register_hook(lambda grad: print("post_einsum", grad.reshape(grad.shape[0], -1).sum(dim=-1)))
 
-        ufld_meta = mapped_meta.transpose(2,
-                                          3)  # switch the ordering of kernels and channels to original so we can take the correct view on them
+        ufld_meta = mapped_meta.transpose(3,
+                                          4)  # switch the ordering of kernels and channels to original so we can take the correct view on them
+        spatial, k = self._flat_sizes()
         ufld_meta = ufld_meta.reshape(
-            (self.num_nodes, self.spatial1 * self.spatial2, self.kernel_size ** 2 * self.channels)
+            (batch * self.num_nodes, spatial, k * self.channels)
         ).transpose(1, 2)  # finish returning to original unfolded
 
         # fold up to state space (sum unit receptive fields)
-        out = self.folder(ufld_meta)  # nodes, channels, spatial, spatial
+        out = self._fold(ufld_meta)  # instances * nodes, channels, spatial, spatial
+        out = out.view(out_shape)
         if self.debug:
             out.register_hook(lambda grad: print("out", grad.reshape(grad.shape[0], -1).sum(dim=-1)))
         return out
 
+    def _hebbian(self, ufld_target):
+        """
+        Applies the hebbian update between the activation memory and the current unfolded activations.
+        :param ufld_target: unfolded activations from _activate
+        :return: None
+        """
+        if self.activation_memory is None:
+            return
+        if self.weight is None:
+            self.weight = self._expand_base_weights(self.init_weight)
+        batch = self._num_instances()
+        spatial, k = self._flat_sizes()
+        ufld_target = ufld_target.view((batch, self.num_nodes, spatial, self.channels, k))
+        activ_mem = self.activation_memory.view((batch, self.num_nodes, spatial, self.channels, k))
+        # plasticity broadcasts over the spatial and kernel dims of the weights.
+        spatial_ones = (1,) * len(self.spatial_shape)
+
+        if self.edge_list:
+            # coactivation is only needed between the source and target of each active edge.
+            coactivation = torch.einsum("zesck, zesok -> zescok", activ_mem[:, self._src], ufld_target[:, self._dst])
+            if self.symmetric:
+                # each stored edge moves toward the mean coactivation of its two directions.
+                coactivation = .5 * (coactivation + torch.einsum("zesck, zesok -> zescok", activ_mem[:, self._dst],
+                                                                 ufld_target[:, self._src]))
+            plasticity = self._edge_params(self.plasticity).view((-1,) + spatial_ones +
+                                                                 (self.channels, self.channels) + spatial_ones)
+        else:
+            # This is an outer product on the channel dimension and elementwise on all others.
+            iterrule = "zusck, zvsok -> zuvscok"
+            # coactivation = torch.exp(torch.einsum(iterrule, activ_mem, ufld_target))
+            coactivation = torch.einsum(iterrule, activ_mem, ufld_target)
+            plasticity = self.plasticity.view((self.num_nodes, self.num_nodes) + spatial_ones +
+                                              (self.channels, self.channels) + spatial_ones).clone()
+
+        if self.debug:
+            plasticity.register_hook(lambda grad: print("plast", grad.reshape(grad.shape[0], -1).sum(dim=-1)))
+        # self.weight = torch.log(
+        #     (1 - plasticity) * torch.exp(self.weight) + plasticity * coactivation.view((self.num_nodes, self.num_nodes,
+        #                                                                                 self.spatial1, self.spatial2,
+        #                                                                                 self.channels, self.channels,
+        #                                                                                 self.kernel_size,
+        #                                                                                 self.kernel_size)))
+        weight_shape = self._weight_shape()
+        self.weight = (1 - plasticity) * self._accumulate(self.weight).reshape(weight_shape) + \
+            plasticity * coactivation.reshape(weight_shape)
+        self._weight_base = None
+
+    def forward(self, x):
+        """
+        The forward pass on all edges. Takes (n, c, s, s) state as input, computes activation function on it, and sends
+        through the current weight matrix and channel map matrix. Returns a state update matrix with the same shape ad
+        the input, i.e. (n, c, s, s).
+        :param x: Tensor, Input intrinsic graph states (n, c, s, s)
+        :return: Tensor, update in the same space as x - (n, c, s, s)
+        """
+        xufld = self._activate(x)
+        # nothing modifies the unfolded activations in place, so they are kept without a copy.
+        self.activation_memory = xufld
+        return self._propagate(xufld, x.shape)
+
     def update(self, target_activation):
         """
         Compute and apply the local hebbian like update for the weight matrix. At a high level, weights that connect
@@ -163,78 +526,188 @@ class PlasticEdges():
         :param target_activation: the value of each state after forward pass before activation (nodes, channel, spatial, spatial)
         :return: None
         """
-
-        if len(target_activation.shape) != 4:
-            raise ValueError("Input Tensor Must Be 4D, not shape", target_activation.shape)
-        if target_activation.shape[0] != self.num_nodes:
-            raise ValueError("Input Tensor must have number of nodes on batch dimension.")
-        if self.debug and (torch.max(target_activation) > 1 or torch.min(target_activation) < 0):
-            print("WARN: Reverb  input activations are expected to have range 0 to 1")
+        self._check_input(target_activation)
         if self.activation_memory is None:
             return
+        self._hebbian(self._activate(target_activation))
 
-        # shape of chanel view of synaptic unfolded space
-        # channel_view = (self.kernel_size ** 2, self.in_channels, self.spatial1, self.spatial2)
+    def step(self, x):
+        """
+        One tick of the edge, equivalent to update(x) followed by forward(x). The activation and its unfolded view are
+        computed once and shared by the hebbian update, the forward contraction and the next tick's memory.
+        :param x: Tensor, Input intrinsic graph states (n, c, s, s)
+        :return: Tensor, update in the same space as x - (n, c, s, s)
+        """
+        if self._scratch is not None:
+            with torch.no_grad():
+                return self._step_inference(x)
+        if self._inference:
+            with torch.no_grad():
+                return self._step(x)
+        return self._step(x)
 
-        # reverse the channel mapping so source channels receive information about their targets
-        # target_activations = target_activation.view(self.num_nodes * self.channels,
-        #                                             self.spatial1 * self.spatial2, 1).transpose(0, 1)  # (_, s, nc)
-        #
-        # chan_map = (self.chan_map + self.chan_mod).permute((0, 2, 1, 3)).reshape(
-        #     (1, self.num_nodes * self.channels, self.num_nodes * self.channels))
+    def _step(self, x):
+        xufld = self._activate(x)
+        self._hebbian(xufld)
+        self.activation_memory = xufld
+        return self._propagate(xufld, x.shape)
 
-        # This is a fast and  numerically stable equivalent to (chan_map ^ -1) (target_activations)
-        # inv, info = torch.linalg.solve_ex(chan_map, target_activations)
-        # target_meta_activations = torch.sigmoid(inv)
-        # target_meta_activations = target_meta_activations.transpose(0, 1).reshape(self.num_nodes, self.channels,
-        #                                                                           self.spatial1,
-        #                                                                           self.spatial2)  # u, c, s, s
-        target_meta_activations = torch.sigmoid(target_activation)
+    def inference(self, enabled=True):
+        """
+        Switches the edge in or out of an allocation free inference mode. On entry the plastic weights are materialized
+        and every buffer step needs is allocated once, later steps update them in place without tracking gradients.
+        Parameters are assumed to be fixed while in inference mode. Edge lists have no preallocated step, they keep
+        the ordinary step and only stop tracking gradients.
+        :param enabled: whether to enter or leave inference mode.
+        :return: self
+        """
+        self._inference = enabled
+        if not enabled:
+            if self._scratch is not None and self.activation_memory is not None:
+                self.activation_memory = self.activation_memory.clone()
+            self._scratch = None
+            return self
+        if self.edge_list:
+            return self
+        batch = self._num_instances()
+        n, c, pad = self.num_nodes, self.channels, self.pad
+        spatial, k = self._flat_sizes()
+        padded_shape = tuple(s + 2 * pad for s in self.spatial_shape)
+        opts = {"device": self.device, "dtype": self.chan_map.dtype}
+        with torch.no_grad():
+            if self.weight is None:
+                self.weight = self._expand_base_weights(self.init_weight)
+            weight = torch.empty(self._weight_shape(), **opts)
+            self.weight = weight.copy_(self.weight.detach())
+            self._weight_base = None
+            ufld = [torch.empty((batch, n, spatial, c, k), **opts) for _ in range(2)]
+            if self.activation_memory is not None:
+                ufld[1].copy_(self.activation_memory.view(ufld[1].shape))
+                self.activation_memory = ufld[1]
+            self._scratch = {
+                "ufld": ufld,
+                "weight": self.weight.view((batch, n, n, spatial, c, c, k)),
+                "plasticity": self.plasticity.detach().view((1, n, n, 1, c, c, 1)),
+                "unit_mask": bool(torch.all(self.mask == 1)),
+                "masked": torch.empty((batch, n, spatial, c, k), **opts),
+                "padded": torch.zeros((batch * n, c) + padded_shape, **opts),
+                "reduced": torch.empty((batch, spatial, k, n, c), **opts),
+                "chan_mod": torch.empty((n, n, c, c), **opts),
+                "chan_eye": torch.eye(c, **opts).view((1, 1, c, c)) * .001,
+                "chan_map": torch.empty((n, n, c, c), **opts),
+                "map_mat": torch.empty((n, c, n, c), **opts),
+                "mapped": torch.empty((batch * spatial * k, n * c), **opts),
+                "fold_src": torch.empty((batch, n, spatial, k, c), **opts),
+                "out": torch.empty((batch, n, c) + padded_shape, **opts),
+                "coact": torch.empty((batch, n, n, spatial, c, c, k), **opts)
+            }
+        return self
 
-        # unfold the current remapped activations
-        ufld_target = self.unfolder(target_meta_activations).transpose(1,
-                                                                       2)  # nodes, spatial1 * spatial2, channels * kernel * kernel
-        ufld_target = ufld_target.view((self.num_nodes, self.spatial1 ** 2, self.channels,
-                                        self.kernel_size ** 2))
+    def _step_inference(self, x):
+        """
+        In place version of step used in inference mode, only writes to the buffers allocated by inference.
+        :param x: Tensor, Input intrinsic graph states ((z), n, c, s, s)
+        :return: Tensor, view of the output buffer, overwritten by the next step.
+        """
+        scratch = self._scratch
+        batch = self._num_instances()
+        n, c, ks, pad = self.num_nodes, self.channels, self.kernel_size, self.pad
+        shape, dims = self.spatial_shape, len(self.spatial_shape)
+        spatial, k = self._flat_sizes()
+        # slices of the padded buffers holding the unpadded states.
+        interior = (slice(None), slice(None)) + tuple(slice(pad, pad + s) for s in shape)
+        self._check_input(x)
+        weight = scratch["weight"]
 
-        activ_mem = self.activation_memory.view((self.num_nodes, self.spatial1 ** 2, self.channels,
-                                                 self.kernel_size ** 2))
+        # sigmoid activation written into the padded buffer, receptive fields are strided views of it.
+        padded = scratch["padded"]
+        padded[interior].copy_(x.reshape((batch * n, c) + shape)).sigmoid_()
+        windows = padded
+        for d in range(dims):
+            windows = windows.unfold(2 + d, ks, 1)
+        windows = windows.view((batch, n, c) + shape + self._kernel_shape())
+        # the unfolded buffer not holding the activation memory is reused.
+        xufld = scratch["ufld"][0] if self.activation_memory is not scratch["ufld"][0] else scratch["ufld"][1]
+        xufld.view((batch, n) + shape + (c,) + self._kernel_shape()).copy_(
+            windows.permute((0, 1) + tuple(range(3, 3 + dims)) + (2,) + tuple(range(3 + dims, 3 + 2 * dims))))
 
-        # This is an outer product on the channel dimension and elementwise on all others.
-        iterrule = "usck, vsok -> uvscok"
-        # coactivation = torch.exp(torch.einsum(iterrule, activ_mem, ufld_target))
-        coactivation = torch.einsum(iterrule, activ_mem, ufld_target)
-        plasticity = self.plasticity.view(self.num_nodes, self.num_nodes, 1, 1, self.channels, self.channels, 1,
-                                          1).clone()
+        if self.activation_memory is not None:
+            coact = torch.mul(self.activation_memory.view((batch, n, 1, spatial, c, 1, k)),
+                              xufld.view((batch, 1, n, spatial, 1, c, k)), out=scratch["coact"])
+            weight.lerp_(coact, scratch["plasticity"])
+        self.activation_memory = xufld
 
-        if self.debug:
-            plasticity.register_hook(lambda grad: print("plast", grad.reshape(grad.shape[0], -1).sum(dim=-1)))
-        # self.weight = torch.log(
-        #     (1 - plasticity) * torch.exp(self.weight) + plasticity * coactivation.view((self.num_nodes, self.num_nodes,
-        #                                                                                 self.spatial1, self.spatial2,
-        #                                                                                 self.channels, self.channels,
-        #                                                                                 self.kernel_size,
-        #                                                                                 self.kernel_size)))
-        self.weight = (1 - plasticity) * self.weight + plasticity * coactivation.view((self.num_nodes, self.num_nodes,
-                                                                                       self.spatial1, self.spatial2,
-                                                                                       self.channels, self.channels,
-                                                                                       self.kernel_size,
-                                                                                       self.kernel_size))
-        return
-
-    def instantiate(self):
-        instance = PlasticEdges(self.num_nodes, self.spatial1, self.spatial2, self.kernel_size, self.channels,
-                                device=self.device, mask=self.mask, optimize_weights=self.optimize_weights,
-                                debug=self.debug)
-        instance.init_weight = self.init_weight.clone()
-        instance.weight = instance._expand_base_weights(instance.init_weight)
-        instance.chan_map = self.chan_map.clone()
-        instance.plasticity = self.plasticity.clone()
-        return instance
+        # streamed reduction over (source node, channel) slices, stored (z, s, k, v, o) for the channel map matmul.
+        reduced = scratch["reduced"].zero_()
+        reduced_view = reduced.permute(0, 3, 1, 4, 2)  # z, v, s, o, k
+        for u in range(n):
+            for ci in range(c):
+                src = xufld[:, u, :, ci, :].unsqueeze(1).unsqueeze(3)  # z, 1, s, 1, k
+                slice_weight = weight[:, u, :, :, ci]  # z, v, s, o, k
+                if not scratch["unit_mask"]:
+                    slice_weight = torch.mul(slice_weight, self.mask[u].view(1, n, 1, 1, 1), out=scratch["masked"])
+                reduced_view.addcmul_(src, slice_weight)
+
+        # same noise on the channel map as the training path.
+        chan_mod = torch.mul(self.noise_pool.draw(), self._chan_noise_std, out=scratch["chan_mod"])
+        chan_mod = chan_mod.sub_(scratch["chan_eye"])
+        self.chan_mod = chan_mod
+        chan_map = torch.add(self.chan_map, chan_mod, out=scratch["chan_map"])
+        map_mat = scratch["map_mat"].copy_(chan_map.permute(0, 2, 1, 3))  # v, o, b, p
+        mapped = torch.mm(reduced.view((-1, n * c)), map_mat.view((n * c, n * c)), out=scratch["mapped"])
+
+        # fold the (kernel, channel) ordered receptive fields back to state space, one kernel offset at a time.
+        fold_src = scratch["fold_src"].copy_(mapped.view((batch, spatial, k, n, c)).permute(0, 3, 1, 2, 4))
+        fold_src = fold_src.view((batch, n) + shape + (c,) + self._kernel_shape())
+        out = scratch["out"].zero_()
+        for offset in itertools.product(range(ks), repeat=dims):
+            window = (slice(None),) * 3 + tuple(slice(o, o + s) for o, s in zip(offset, shape))
+            out[window].add_(fold_src[(Ellipsis,) + offset].movedim(-1, 2))
+        out = out[(slice(None),) + interior]
+        if self.instances is None:
+            out = out[0]
+        return out
+
+    def instantiate(self, instances=None):
+        """
+        Lightweight instance of the edge. Parameters are shared with this edge rather than copied, so gradients flow
+        straight into them, and the instance only owns its dynamic state: plastic weights, activation memory and
+        channel map noise.
+        :param instances: Number of independent instances to batch in the returned edge, None for an unbatched edge.
+        """
+        instance = copy.copy(self)
+        instance.instances = instances
+        instance._scratch = None
+        instance._inference = False
+        instance._plans = {}
+        instance.noise_pool = NoisePool(self.chan_map.shape, stream=1, device=self.device, dtype=self.noise_pool.dtype)
+        return instance.detach(reset_weight=True)
+
+    def reseed(self, seed):
+        """
+        Restarts the channel map noise on a new stream.
+        :param seed: int
+        :return: self
+        """
+        self.noise_pool.reseed(seed)
+        return self
 
     def detach(self, reset_weight=False):
+        if self._scratch is not None:
+            # inference buffers are reset in place.
+            with torch.no_grad():
+                if reset_weight:
+                    self.weight.copy_(self._expand_base_weights(self.init_weight))
+                    self._weight_base = None
+            self.activation_memory = None
+            return self
         if reset_weight:
             self.weight = None
+            self._weight_base = None
+        elif self._weight_base is not None:
+            # still a broadcast view of the base weights, nothing to copy.
+            self._weight_base = self._weight_base.detach()
+            self.weight = self.weight.detach()
         else:
             if self.weight is not None:
                 self.weight = self.weight.detach().clone()
@@ -246,45 +719,69 @@ class PlasticEdges():
             self.init_weight = torch.nn.Parameter(self.init_weight.to(device))
         else:
             self.init_weight = self.init_weight.to(device)
-        self.weight = self.weight.to(device)
         self.chan_map = torch.nn.Parameter(self.chan_map.to(device))
         self.plasticity = torch.nn.Parameter(self.plasticity.to(device))
         self.mask = self.mask.to(device)
         self.device = device
+        self.noise_pool.to(device=device)
+        self._compile_edges()
+        if self._weight_base is not None:
+            self.weight = self._expand_base_weights(self.init_weight)
+        elif self.weight is not None:
+            self.weight = self.weight.to(device)
         return self
 
     def clone(self, fuzzy=False):
-        instance = PlasticEdges(self.num_nodes, self.spatial1, self.spatial2, self.kernel_size, self.channels,
-                                device=self.device, mask=self.mask, optimize_weights=self.optimize_weights,
-                                debug=self.debug)
-        if fuzzy:
-            s1 = float(self.init_weight.std()) * (.5 * random.random() + .1)
-            s2 = float(self.chan_map.std()) * (.5 * random.random() + .1)
-            s3 = float(self.plasticity.std()) * (.5 * random.random() + .1)
-            m1 = m2 = m3 = 0.
-        else:
-            s1 = s2 = s3 = m1 = m2 = m3 = 0.
+        """
+        Independent copy of the edge. It is built from an instance of this edge, so nothing is randomly initialized
+        only to be overwritten, and gets detached copies of the parameters.
+        :param fuzzy: Whether to perturb the copied parameters with gaussian noise.
+        """
+        instance = self.instantiate(self.instances)
+        instance.init_weight = _perturbed(self.init_weight, fuzzy)
+        instance.chan_map = _perturbed(self.chan_map, fuzzy)
+        instance.plasticity = _perturbed(self.plasticity, fuzzy)
+        return instance.set_precision(self.precision)
+
+
+class PlasticEdgesND(PlasticEdges):
+    def __init__(self, num_nodes, *spatial, kernel_size=3, channels=1, **kwargs):
+        """
+        PlasticEdges on nodes with any number of spatial dims, e.g. (n, c, s) sensor rings or (n, c, s, s, s) volumes.
+        Receptive fields are unfolded as strided views of the padded states (util.unfold_nd) and folded back with a
+        scatter-add over the kernel offsets (util.fold_nd). The contraction and the hebbian update are shared with
+        PlasticEdges, they only see flattened locations and kernel offsets.
+        :param num_nodes: The number of nodes in the intrinsic graph.
+        :param spatial: The spatial dims of each node.
+        :param kernel_size: The convolution kernel size along every spatial dim. Must be less than min(spatial)
+        :param channels: The number of channels in the nodes.
+        :param kwargs: keyword arguments of PlasticEdges.
+        """
+        if len(spatial) == 0:
+            raise ValueError("Nodes need at least one spatial dimension.")
+        self._spatial_shape = tuple(spatial)
+        super().__init__(num_nodes, None, None, kernel_size, channels, **kwargs)
+
+    @property
+    def spatial_shape(self):
+        return self._spatial_shape
+
+    def _init_folding(self):
+        self.unfolder = None
+        self.folder = None
 
-        instance.init_weight = torch.nn.Parameter(
-            self.init_weight.detach().clone() + torch.normal(size=self.init_weight.shape,
-                                                             mean=m1,
-                                                             std=s1, device=self.device))
+    def _unfold(self, x):
+        # (b, c, *s) -> (b, c * k ** d, prod(s)) receptive fields
+        return util.unfold_nd(x, self.kernel_size, self.pad, len(self.spatial_shape))
 
-        instance.weight = instance._expand_base_weights(instance.init_weight)
-        instance.chan_map = torch.nn.Parameter(self.chan_map.detach().clone() + torch.normal(size=self.chan_map.shape,
-                                                                                             mean=m2,
-                                                                                             std=s2,
-                                                                                             device=self.device))
-        instance.plasticity = torch.nn.Parameter(
-            self.plasticity.detach().clone() + torch.normal(size=self.chan_map.shape,
-                                                            mean=m3,
-                                                            std=s3, device=self.device))
-        return instance
+    def _fold(self, x):
+        # (b, c * k ** d, prod(s)) -> (b, c, *s), overlapping receptive fields are summed.
+        return util.fold_nd(x, self.spatial_shape, self.kernel_size, self.pad)
 
 
 class FCPlasticEdges():
     def __init__(self, num_nodes, spatial, channels, device='cpu', mask=None, optimize_weights=True, debug=False,
-                 through_time=False, *args, **kwargs):
+                 through_time=False, instances=None, edge_list=False, precision=None, *args, **kwargs):
         """
         Designed to operate on a (n, c, s, s) intrinsic graph. Defines a convolutional edge with a Hebbian-like
         local update function between each node and each channel on the graph.
@@ -294,6 +791,12 @@ class FCPlasticEdges():
         :param mask: A user defined mask as a (n, n) adj matrix to modify node to node weights.
         :param optimize_weights: Whether to fit the initial convolutional weights using gradient decent.
         :param debug: Whether to print info about gradients and current states at runtime
+        :param instances: Number of independent instances to step together. If None, states are (n, c, s),
+                          otherwise states are (instances, n, c, s) and each instance has its own plastic weights.
+        :param edge_list: If True, the mask is compiled into a list of active (source, target) edges and plastic
+                          weights are only stored and computed for those edges. Unlike the dense edges, the weights of
+                          masked out node pairs do not exist, so they do not contribute to the update gate.
+        :param precision: optional PrecisionPolicy, if None everything uses the torch default dtype.
         :param kwargs: addition keyword arguments.
         """
         # The activation memory tracks the last state of the model. It is necessary for computing the intrinsic edge
@@ -301,24 +804,29 @@ class FCPlasticEdges():
         self.activation_memory = None
         self.optimize_weights = optimize_weights
         self.num_nodes = num_nodes
+        self.instances = instances
         self.spatial = spatial
         self.channels = channels
         self.through_time = through_time
+        # preallocated buffers used in inference mode, None otherwise.
+        self._scratch = None
+        # whether steps track gradients, edge lists have no preallocated step and run the ordinary one in inference.
+        self._inference = False
 
         # mask has shape (nodes, nodes) and allows us to predefine a graph structure besides fully connected.
         if mask is None:
             mask = torch.ones((num_nodes, num_nodes), device=device)
         self.mask = mask.to(device)
+        self.edge_list = edge_list
+        self._compile_edges()
 
         # initial weight parameter
-        self.init_weight = torch.zeros((num_nodes, num_nodes, spatial, spatial, channels, channels),
-                                       device=device)  # 8D Tensor.
-        self.init_weight = torch.nn.init.xavier_normal_(self.init_weight * .1)
+        self.init_weight = self._init_base_weight(device)
         if optimize_weights:
             self.init_weight = torch.nn.Parameter(self.init_weight)
 
         # Non-Parametric Weights used for intrinsic update
-        self.weight = None  # (n, n, s, s, c, c)
+        self.weight = None  # (n, n, s, s, c, c), or (e, s, s, c, c) in edge list mode
 
         # Channel Mapping
         chan_map = torch.empty((num_nodes, num_nodes, channels, channels), device=device)
@@ -336,18 +844,145 @@ class FCPlasticEdges():
         self.device = device
         self.debug = False
         self.kernel_size = None
+        self.precision = None
+        self.set_precision(precision)
 
     def _expand_base_weights(self, in_weight):
         # adds explicit spatial dims to weights
         if len(self.init_weight.shape) == 1:
-            expanded_weights = torch.ones((self.num_nodes, self.num_nodes, self.spatial, self.spatial, self.channels,
-                                           self.channels)) * self.init_weight.clone()
+            expanded_weights = self._compute(self.init_weight).expand((self.num_nodes, self.num_nodes, self.spatial, self.spatial,
+                                                        self.channels, self.channels))
         else:
-            expanded_weights = torch.abs(in_weight.clone())
+            expanded_weights = torch.abs(self._compute(in_weight))
+        if self.edge_list:
+            expanded_weights = expanded_weights[self._src, self._dst]
+        if self.instances is not None:
+            # every instance starts from the same weights, they only diverge once updated.
+            expanded_weights = expanded_weights.unsqueeze(0).expand((self.instances,) + tuple(expanded_weights.shape))
         return expanded_weights
 
+    def _init_base_weight(self, device):
+        init_weight = torch.zeros((self.num_nodes, self.num_nodes, self.spatial, self.spatial, self.channels,
+                                   self.channels), device=device)  # 8D Tensor.
+        return torch.nn.init.xavier_normal_(init_weight * .1)
+
+    @property
+    def weight(self):
+        """
+        Plastic weights in the canonical ((z), n, n, s, s, c, c) layout. Once updated this is a permuted view of the
+        stored layout, for inspection and crossover.
+        """
+        if self._weight_l is None:
+            return self._weight
+        return self._weight_l.permute(0, 1, 5, 3, 2, 6, 4).reshape(self._weight_shape())
+
+    @weight.setter
+    def weight(self, weight):
+        self._weight = weight
+        self._weight_l = None
+
+    def _gate_layout(self, weight):
+        # view of canonical weights in the order the update gate flattens them, (z, u, out_s, in_s, out_c, v, in_c).
+        weight = weight.reshape((self._num_instances(),) + self._weight_shape()[-6:])
+        return weight.permute(0, 1, 4, 3, 6, 2, 5)
+
+    def _layout(self):
+        """
+        Dense plastic weights are kept contiguous in the gate layout, so the update gate is a matmul with a view of
+        them. The forward pass reads the same storage with the block scales applied to its outputs, and the hebbian
+        blend is written in this layout, so no step takes a permuted or scaled copy of the weights. A canonical weight
+        that was assigned is converted once, here.
+        :return: gate layout
+        """
+        if self._weight_l is None:
+            self._weight_l = self._gate_layout(self._weight).contiguous()
+            self._weight = None
+        return self._weight_l
+
+    def _compile_edges(self):
+        # active (source, target) node pairs of the mask, only used in edge list mode.
+        if not self.edge_list:
+            self._src = self._dst = self._gate_rows = self._gate_cols = None
+            return
+        self._src, self._dst = util.mask_to_edges(self.mask)
+        # row and column of each edge weight in the (size, size) matrix the update gate is computed with, the same
+        # layout the dense update flattens its weights to.
+        n, s, c = self.num_nodes, self.spatial, self.channels
+        u = self._src.view(-1, 1, 1, 1, 1)
+        v = self._dst.view(-1, 1, 1, 1, 1)
+        s1 = torch.arange(s, device=self.mask.device).view(1, s, 1, 1, 1)
+        s2 = torch.arange(s, device=self.mask.device).view(1, 1, s, 1, 1)
+        c1 = torch.arange(c, device=self.mask.device).view(1, 1, 1, c, 1)
+        c2 = torch.arange(c, device=self.mask.device).view(1, 1, 1, 1, c)
+        flat = ((((u * s + s2) * s + s1) * c + c2) * n + v) * c + c1  # e, s, s, c, c
+        self._gate_rows = (flat // (n * s * c)).flatten()
+        self._gate_cols = (flat % (n * s * c)).flatten()
+
+    def _compute(self, tensor):
+        # cast to the compute dtype of the precision policy.
+        if self.precision is None:
+            return tensor
+        return tensor.to(self.precision.compute)
+
+    def _accumulate(self, weight):
+        # plastic weights are updated in the accumulate dtype of the precision policy.
+        if self.precision is None:
+            return weight
+        return weight.to(self.precision.accumulate)
+
+    def set_precision(self, precision):
+        """
+        Casts parameters and plastic weights to a PrecisionPolicy.
+        :param precision: PrecisionPolicy, or None to keep the current dtypes.
+        :return: self
+        """
+        if precision is None:
+            return self
+        self.precision = precision
+        if self.optimize_weights:
+            self.init_weight = torch.nn.Parameter(self.init_weight.detach().to(precision.compute))
+        else:
+            self.init_weight = self.init_weight.to(precision.init_storage)
+        self.chan_map = torch.nn.Parameter(self.chan_map.detach().to(precision.compute))
+        self.plasticity = torch.nn.Parameter(self.plasticity.detach().to(precision.compute))
+        self.beta = torch.nn.Parameter(self.beta.detach().to(precision.compute))
+        self.mask = self.mask.to(precision.compute)
+        self._cast_weights()
+        return self
+
+    def _cast_weights(self):
+        # plastic weights follow the accumulate dtype of the precision policy.
+        if self.weight is not None:
+            self.weight = self._accumulate(self.weight.detach())
+
+    def _num_instances(self):
+        # an unbatched edge is computed as a batch with a single instance.
+        if self.instances is None:
+            return 1
+        return self.instances
+
+    def _weight_shape(self):
+        if self.edge_list:
+            shape = (len(self._src), self.spatial, self.spatial, self.channels, self.channels)
+        else:
+            shape = (self.num_nodes, self.num_nodes, self.spatial, self.spatial, self.channels, self.channels)
+        if self.instances is not None:
+            shape = (self.instances,) + shape
+        return shape
+
+    def _check_input(self, x):
+        if self.instances is None:
+            if x.shape[0] != self.num_nodes:
+                raise ValueError("Input Tensor must have number of nodes on batch dimension.")
+        elif len(x.shape) != 4 or x.shape[0] != self.instances or x.shape[1] != self.num_nodes:
+            raise ValueError("Batched Input Tensor must have instances then nodes on leading dimensions.")
+
+    def named_parameters(self):
+        return [("chan_map", self.chan_map), ("plasticity", self.plasticity), ("beta", self.beta),
+                ("init_weight", self.init_weight)]
+
     def parameters(self):
-        params = [self.chan_map, self.plasticity, self.beta, self.init_weight]
+        params = [p for _, p in self.named_parameters()]
         return params
 
     def set_grad(self, grads):
@@ -356,61 +991,88 @@ class FCPlasticEdges():
         self.beta.grad = grads[2]
         self.init_weight.grad = grads[3]
 
+    def set_parameters(self, params):
+        """
+        Replaces the parameters, in the order of parameters(), e.g. with views of shared memory. The plastic weights
+        are reset to the new initial weights.
+        """
+        for (name, _), param in zip(self.named_parameters(), params):
+            setattr(self, name, param)
+        return self.detach(reset_weight=True)
+
     def __call__(self, x):
         return self.forward(x)
 
-    def forward(self, x):
+    def _activate(self, x):
         """
-        The forward pass on all edges. Takes (n, c, s) state as input, computes activation function on it, and sends
-        through the current weight matrix and channel map matrix. Returns a state update matrix with the same shape ad
-        the input, i.e. (n, c, s).
-        :param x: Tensor, Input intrinsic graph states (n, c, s)
-        :return: Tensor, update in the same space as x - (n, c, s)
+        Computes the sigmoid activation of a state, shared by the forward pass, the hebbian update and the activation
+        memory.
+        :param x: Tensor, intrinsic graph states ((z), n, c, s)
+        :return: Tensor, activations ((z), n, c, s)
         """
-        if self.weight is None:
-            self.weight = self._expand_base_weights(self.init_weight)
-        x = x.to(self.device)  # nodes, channels, spatial1
+        x = x.to(self.device)  # (instances), nodes, channels, spatial1
         x = torch.sigmoid(x)  # compute sigmoid activation on range [0, 1]
-        if x.shape[0] != self.num_nodes:
-            raise ValueError("Input Tensor must have number of nodes on batch dimension.")
+        self._check_input(x)
         if (torch.max(x) > 1 or torch.min(x) < 0) and self.debug:
             print("WARN: Reverb  input activations are expected to have range 0 to 1")
-        self.activation_memory = x.clone()  # n, c, s
-        xufld = x.view((self.num_nodes, self.channels, self.spatial)).transpose(1, 2)  # n, s, c
-        # unfolded states will broadcast over input node dim.
+        return x
 
-        # weights are zeroed for node -> node maps that are masked.
-        combined_weight = self.weight * self.mask.view(self.num_nodes, self.num_nodes, 1, 1, 1, 1)
-        # Compose plastic weights and channel map
-        combined_weight = combined_weight * self.chan_map.view(self.num_nodes, self.num_nodes, 1, 1, self.channels,
-                                                               self.channels)
-
-        # prepare for matmul
-        combined_weight_mult = torch.permute(combined_weight, (0, 2, 4, 1, 3, 5))  # u, in_s, in_c, v, out_s, out_c
-        combined_weight_mult = combined_weight_mult.reshape(
-            (self.num_nodes * self.spatial * self.channels, self.num_nodes * self.spatial * self.channels))
-        out = xufld.flatten() @ combined_weight_mult  # node, spatial, channel
-        out = out.view((self.num_nodes, self.spatial, self.channels)).transpose(1, 2)  # n, c, s
-        return out
+    def _propagate(self, x):
+        """
+        Sends activations through the masked plastic weights and channel map.
+        :param x: activations from _activate
+        :return: Tensor, update in the same space as x
+        """
+        if self.weight is None:
+            self.weight = self._expand_base_weights(self.init_weight)
+        batch = self._num_instances()
+        if self.edge_list:
+            return self._propagate_edges(x, batch)
+        n, s, c = self.num_nodes, self.spatial, self.channels
+        weight_l = self._compute(self._layout())  # z, u, out_s, in_s, out_c, v, in_c
+        # every input channel of a source node is multiplied with the weights at once, so they are read once as
+        # contiguous (in_s, out_c * v * in_c) blocks, and the products of matching input channels are kept.
+        rows = torch.matmul(x.view((batch, n, 1, c, s)), weight_l.view((batch, n, s, s, c * n * c)))
+        rows = rows.view((batch, n, s, c, c, n, c)).diagonal(dim1=3, dim2=6)  # z, u, out_s, out_c, v, in_c
+        # mask and channel map are applied as block scales to the outputs of each node -> node block.
+        scale = self.mask.view(n, n, 1, 1) * self.chan_map  # u, v, in_c, out_c
+        out = torch.einsum("zutbva, uvab -> zvbt", rows, scale)  # z, n, c, s
+        return out.reshape(x.shape)
 
-    def update(self, target_activation):
+    def _propagate_edges(self, x, batch):
         """
-        Compute and apply the local hebbian like update for the weight matrix. At a high level, weights that connect
-        units that have high (near 1) activations at adjacent time steps should increase, and weights that connect units
-        with low or uneven connections at adjacent time sets should decrease.
-        :param target_activation: the value of each state after forward pass before activation (nodes, channel, spatial, spatial)
+        Edge list version of _propagate, each active edge maps its source activations and the messages are summed
+        into their target nodes.
+        :param x: activations from _activate
+        :param batch: number of instances in the batch
+        :return: Tensor, update in the same space as x
+        """
+        weight = self._compute(self.weight).reshape((batch,) + self._weight_shape()[-5:])
+        scale = self.mask[self._src, self._dst].view(-1, 1, 1, 1, 1) * \
+            self.chan_map[self._src, self._dst].view(-1, 1, 1, self.channels, self.channels)
+        src = x.view((batch, self.num_nodes, self.channels, self.spatial))[:, self._src]  # z, e, c, s
+        message = torch.einsum("zeai, zeijab -> zebj", src, weight * scale)  # z, e, c, s
+        out = torch.zeros((batch, self.num_nodes, self.channels, self.spatial), device=message.device,
+                          dtype=message.dtype)
+        out = out.index_add(1, self._dst, message)
+        return out.reshape(x.shape)
+
+    def _hebbian(self, x):
+        """
+        Applies the hebbian update between the activation memory and the current activations.
+        :param x: activations from _activate
         :return: None
         """
-        if target_activation.shape[0] != self.num_nodes:
-            raise ValueError("Input Tensor must have number of nodes on batch dimension.")
-        if self.debug and (torch.max(target_activation) > 1 or torch.min(target_activation) < 0):
-            print("WARN: Reverb  input activations are expected to have range 0 to 1")
         if self.activation_memory is None:
             return
+        if self.weight is None:
+            self.weight = self._expand_base_weights(self.init_weight)
+        batch = self._num_instances()
+        size = self.num_nodes * self.spatial * self.channels
 
         # reverse the channel mapping so source channels receive information about their targets
-        target_activations = target_activation.reshape(self.num_nodes * self.channels,
-                                                       self.spatial, 1).transpose(0, 1)  # (_, s, nc)
+        target_meta_activations = x.reshape(batch, self.num_nodes * self.channels,
+                                            self.spatial).transpose(1, 2)  # (z, s, nc)
 
         # chan_map = self.chan_map.permute((0, 2, 1, 3)).reshape(
         #     (1, self.num_nodes * self.channels, self.num_nodes * self.channels))
@@ -419,46 +1081,250 @@ class FCPlasticEdges():
         # target_meta_activations = torch.linalg.solve(chan_map, torch.sigmoid(target_activations))
         # target_meta_activations = target_meta_activations.transpose(0, 1).reshape(self.num_nodes, self.channels,
         #                                                                           self.spatial)  # v, c, s
-        target_meta_activations = torch.sigmoid(target_activations)
 
         # unfold the current remapped activations
         # u, c, s
-        activ_mem = self.activation_memory  # u, c, s
-        coactivation = torch.stack((activ_mem.flatten(), target_meta_activations.flatten()))  # 2, mm
+        activ_mem = self.activation_memory  # (z), u, c, s
+        coactivation = torch.stack((activ_mem.reshape(batch, size),
+                                    target_meta_activations.reshape(batch, size)), dim=1)  # z, 2, mm
 
-        if not self.through_time:
-            weight = self.weight.detach()
-        else:
-            weight = self.weight
-        weight_l = torch.permute(weight, (0, 3, 2, 5, 1, 4)).reshape(
-            (self.num_nodes * self.channels * self.spatial, -1))
-        coactivation = torch.flip(coactivation, (0,)).T @ torch.softmax(self.beta * coactivation @ weight_l, dim=0)
+        if self.edge_list:
+            if not self.through_time:
+                weight = self.weight.detach()
+            else:
+                weight = self.weight
+            weight = weight.reshape((batch,) + self._weight_shape()[-5:])
+            # sparse product of the coactivations with the edge weights in their flattened gate layout.
+            gate = coactivation[:, :, self._gate_rows] * self._compute(weight).reshape((batch, 1, -1))
+            gate = torch.zeros_like(coactivation).index_add(2, self._gate_cols, gate)
+            gate = torch.softmax(self.beta * gate, dim=1)
+            # only the outer product entries between each edge's source and target are formed.
+            flipped = torch.flip(coactivation, (1,)).view((batch, 2, self.num_nodes, self.channels, self.spatial))
+            gate = gate.view((batch, 2, self.num_nodes, self.channels, self.spatial))
+            coactivation = torch.einsum("zreai, zrebj -> zeijab", flipped[:, :, self._src],
+                                        gate[:, :, self._dst])  # z, e, s, s, c, c
+            plasticity = self.plasticity[self._src, self._dst].view(-1, 1, 1, self.channels, self.channels)
+            if self.debug:
+                plasticity.register_hook(lambda grad: print("plast", grad.reshape(grad.shape[0], -1).sum(dim=-1)))
+            self.weight = ((1 - plasticity) * self._accumulate(weight) + plasticity * coactivation).reshape(
+                self._weight_shape())
+            return
 
-        coactivation = coactivation.view(
-            (self.num_nodes, self.channels, self.spatial, self.num_nodes, self.channels, self.spatial))
-        coactivation = torch.permute(coactivation, (0, 3, 2, 5, 1, 4))  # u, v, s, s, c, c
+        weight_l = self._layout()
+        if not self.through_time:
+            weight_l = weight_l.detach()
+        gate = torch.softmax(self.beta * torch.bmm(coactivation, self._compute(weight_l).view((batch, size, size))),
+                             dim=1)
+        # outer product of the flipped coactivations, rows (u, c, s), and the gate, columns (v, c, s), formed in the
+        # stored layout.
+        flipped = torch.flip(coactivation, (1,)).view((batch, 2, self.num_nodes, self.channels, self.spatial))
+        gate = gate.view((batch, 2, self.num_nodes, self.channels, self.spatial))
+        coactivation = torch.einsum("zruai, zrvbt -> zutibva", flipped, gate)
 
-        plasticity = self.plasticity.view(self.num_nodes, self.num_nodes, 1, 1, self.channels, self.channels).clone()
+        plasticity = self.plasticity.clone()
         if self.debug:
             plasticity.register_hook(lambda grad: print("plast", grad.reshape(grad.shape[0], -1).sum(dim=-1)))
-        self.weight = (1 - plasticity) * weight + plasticity * coactivation
+        plasticity_l = plasticity.permute(0, 3, 1, 2).reshape(
+            (1, self.num_nodes, 1, 1, self.channels, self.num_nodes, self.channels))
+        # the blend follows the layout of the stored weights, so the next step reads it without a copy.
+        self._weight_l = ((1 - plasticity_l) * self._accumulate(weight_l) + plasticity_l * coactivation).contiguous()
         # self.weight = torch.log((1 - plasticity) * torch.exp(self.weight) + plasticity * coactivation)
-        return
-
-    def instantiate(self):
-        instance = FCPlasticEdges(self.num_nodes, self.spatial, self.channels,
-                                  device=self.device, mask=self.mask, optimize_weights=self.optimize_weights,
-                                  through_time=self.through_time, debug=self.debug)
-        instance.init_weight = self.init_weight.clone()
-        instance.weight = instance._expand_base_weights(instance.init_weight)
-        instance.chan_map = self.chan_map.clone()
-        instance.beta = self.beta.clone()
-        instance.plasticity = self.plasticity.clone()
-        return instance
+
+    def forward(self, x):
+        """
+        The forward pass on all edges. Takes (n, c, s) state as input, computes activation function on it, and sends
+        through the current weight matrix and channel map matrix. Returns a state update matrix with the same shape ad
+        the input, i.e. (n, c, s).
+        :param x: Tensor, Input intrinsic graph states (n, c, s)
+        :return: Tensor, update in the same space as x - (n, c, s)
+        """
+        x = self._activate(x)
+        # nothing modifies the activations in place, so they are kept without a copy.
+        self.activation_memory = x  # (z), n, c, s
+        return self._propagate(x)
+
+    def update(self, target_activation):
+        """
+        Compute and apply the local hebbian like update for the weight matrix. At a high level, weights that connect
+        units that have high (near 1) activations at adjacent time steps should increase, and weights that connect units
+        with low or uneven connections at adjacent time sets should decrease.
+        :param target_activation: the value of each state after forward pass before activation (nodes, channel, spatial, spatial)
+        :return: None
+        """
+        self._check_input(target_activation)
+        if self.activation_memory is None:
+            return
+        self._hebbian(self._activate(target_activation))
+
+    def step(self, x):
+        """
+        One tick of the edge, equivalent to update(x) followed by forward(x) with the sigmoid activation computed once
+        and reused by the hebbian update, the forward pass and the next tick's memory.
+        :param x: Tensor, Input intrinsic graph states (n, c, s)
+        :return: Tensor, update in the same space as x - (n, c, s)
+        """
+        if self._scratch is not None:
+            with torch.no_grad():
+                return self._step_inference(x)
+        if self._inference:
+            with torch.no_grad():
+                return self._step(x)
+        return self._step(x)
+
+    def _step(self, x):
+        x = self._activate(x)
+        self._hebbian(x)
+        self.activation_memory = x
+        return self._propagate(x)
+
+    def inference(self, enabled=True):
+        """
+        Switches the edge in or out of an allocation free inference mode. On entry the plastic weights are materialized
+        and every buffer step needs is allocated once, later steps update them in place without tracking gradients.
+        Parameters are assumed to be fixed while in inference mode. Edge lists have no preallocated step, they keep
+        the ordinary step and only stop tracking gradients.
+        :param enabled: whether to enter or leave inference mode.
+        :return: self
+        """
+        self._inference = enabled
+        if not enabled:
+            if self._scratch is not None and self.activation_memory is not None:
+                self.activation_memory = self.activation_memory.clone()
+            self._scratch = None
+            return self
+        if self.edge_list:
+            return self
+        batch = self._num_instances()
+        n, s, c = self.num_nodes, self.spatial, self.channels
+        size = n * s * c
+        opts = {"device": self.device, "dtype": self.chan_map.dtype}
+        with torch.no_grad():
+            if self.weight is None:
+                self.weight = self._expand_base_weights(self.init_weight)
+            # the weights stay in the gate layout, in a buffer of their own.
+            weight = torch.empty((batch, n, s, s, c, n, c), **opts)
+            weight.copy_(self._layout().detach())
+            self._weight_l = weight
+            activ = [torch.empty((batch, n, c, s), **opts) for _ in range(2)]
+            if self.activation_memory is not None:
+                activ[1].copy_(self.activation_memory.view(activ[1].shape))
+                self.activation_memory = activ[1]
+            # mask and channel map are constant in inference mode, so their product is taken once.
+            scale = self.mask.view(n, n, 1, 1) * self.chan_map.detach()  # u, v, in_c, out_c
+            self._scratch = {
+                "activ": activ,
+                "weight": weight,
+                "plasticity": self.plasticity.detach().permute(0, 3, 1, 2).reshape((1, n, 1, 1, c, n, c)),
+                "beta": self.beta.detach(),
+                "scale": scale.permute(0, 3, 1, 2).reshape((1, n, 1, c, n, c)),
+                "lhs": torch.empty((batch, n, s, c, s), **opts),
+                "rows": torch.empty((batch * n * s, c, c * n * c), **opts),
+                "prod": torch.empty((batch, n, s, c, n, c), **opts),
+                "out": torch.empty((batch, s, c, n), **opts),
+                "pair": torch.empty((batch, 2, size), **opts),
+                "flipped": torch.empty((batch, 2, size), **opts),
+                "gate": torch.empty((batch, 2, size), **opts),
+                "diff": torch.empty((batch, size), **opts),
+                "outer": torch.empty((batch, size, size), **opts)
+            }
+        return self
+
+    def _step_inference(self, x):
+        """
+        In place version of step used in inference mode, only writes to the buffers allocated by inference.
+        :param x: Tensor, Input intrinsic graph states ((z), n, c, s)
+        :return: Tensor, view of the output buffer, overwritten by the next step.
+        """
+        scratch = self._scratch
+        batch = self._num_instances()
+        n, s, c = self.num_nodes, self.spatial, self.channels
+        size = n * s * c
+        self._check_input(x)
+        weight = scratch["weight"]
+        # the activation buffer not holding the activation memory is reused.
+        activ = scratch["activ"][0] if self.activation_memory is not scratch["activ"][0] else scratch["activ"][1]
+        activ.copy_(x.view(activ.shape)).sigmoid_()
+
+        if self.activation_memory is not None:
+            pair = scratch["pair"]
+            pair[:, 0].copy_(self.activation_memory.view((batch, size)))
+            pair[:, 1].view((batch, s, n * c)).copy_(activ.view((batch, n * c, s)).transpose(1, 2))
+            flipped = scratch["flipped"]
+            flipped[:, 0].copy_(pair[:, 1])
+            flipped[:, 1].copy_(pair[:, 0])
+            gate = torch.bmm(pair, weight.view((batch, size, size)), out=scratch["gate"]).mul_(scratch["beta"])
+            # softmax over the two gate rows is the sigmoid of their difference.
+            diff = torch.sub(gate[:, 0], gate[:, 1], out=scratch["diff"]).sigmoid_()
+            gate[:, 0].copy_(diff)
+            gate[:, 1].copy_(diff).neg_().add_(1)
+            outer = torch.bmm(flipped.transpose(1, 2), gate, out=scratch["outer"])
+            # rows (u, c, s) and columns (v, c, s), read in the stored layout by the blend.
+            outer = outer.view((batch, n, c, s, n, c, s)).permute(0, 1, 6, 3, 5, 4, 2)  # z, u, s, s, c, v, c
+            weight.lerp_(outer, scratch["plasticity"])
+        self.activation_memory = activ
+
+        # same contraction as _propagate, see there.
+        lhs = scratch["lhs"]
+        lhs.copy_(activ.view((batch, n, 1, c, s)))
+        rows = torch.bmm(lhs.view((batch * n * s, c, s)), weight.view((batch * n * s, s, c * n * c)),
+                         out=scratch["rows"])
+        rows = rows.view((batch, n, s, c, c, n, c)).diagonal(dim1=3, dim2=6)  # z, u, out_s, out_c, v, in_c
+        prod = torch.mul(rows, scratch["scale"], out=scratch["prod"])
+        out = torch.sum(prod, dim=(1, 5), out=scratch["out"]).permute(0, 3, 2, 1)  # z, n, c, s
+        if self.instances is None:
+            out = out[0]
+        return out
+
+    def instantiate(self, instances=None):
+        """
+        Lightweight instance of the edge. Parameters are shared with this edge rather than copied, so gradients flow
+        straight into them, and the instance only owns its plastic weights and activation memory.
+        :param instances: Number of independent instances to batch in the returned edge, None for an unbatched edge.
+        """
+        instance = copy.copy(self)
+        instance.instances = instances
+        instance._scratch = None
+        instance._inference = False
+        return instance.detach(reset_weight=True)
+
+    def reseed(self, seed):
+        # the FC edges draw no noise.
+        return self
+
+    def _get_plastic_state(self):
+        # tensors carried from tick to tick, used to checkpoint rollouts. Initial weights are derived from init_weight
+        # here, so a checkpointed segment gets them as an explicit input and init_weight receives their gradient.
+        if self.weight is None:
+            self.weight = self._expand_base_weights(self.init_weight)
+        return self.weight, self.activation_memory
+
+    def _set_plastic_state(self, state):
+        self.weight, self.activation_memory = state
+
+    def truncate(self):
+        """
+        Cuts the autograd graph through time, keeping the current plastic weights and activation memory.
+        """
+        if self._weight_l is not None:
+            self._weight_l = self._weight_l.detach()
+        elif self.weight is not None:
+            self.weight = self.weight.detach()
+        if self.activation_memory is not None:
+            self.activation_memory = self.activation_memory.detach()
+        return self
 
     def detach(self, reset_weight=False):
+        if self._scratch is not None:
+            # inference buffers are reset in place.
+            with torch.no_grad():
+                if reset_weight:
+                    self._weight_l.copy_(self._gate_layout(self._expand_base_weights(self.init_weight)))
+            self.activation_memory = None
+            return self
         if reset_weight:
             self.weight = None
+        elif self._weight_l is not None:
+            self._weight_l = self._weight_l.detach().clone()
         else:
             if self.weight is not None:
                 self.weight = self.weight.detach().clone()
@@ -470,43 +1336,243 @@ class FCPlasticEdges():
             self.init_weight = torch.nn.Parameter(self.init_weight.to(device))
         else:
             self.init_weight = self.init_weight.to(device)
-        self.weight = self.weight.to(device)
+        if self.weight is not None:
+            self.weight = self.weight.to(device)
         self.chan_map = torch.nn.Parameter(self.chan_map.to(device))
         self.plasticity = torch.nn.Parameter(self.plasticity.to(device))
         self.beta = torch.nn.Parameter(self.beta.to(device))
         self.mask = self.mask.to(device)
         self.device = device
+        self._compile_edges()
         return self
 
     def clone(self, fuzzy=False):
-        instance = FCPlasticEdges(self.num_nodes, self.spatial, self.channels,
-                                  device=self.device, mask=self.mask, optimize_weights=self.optimize_weights,
-                                  through_time=self.through_time, debug=self.debug)
-        if fuzzy:
-            s1 = float(self.init_weight.std()) * (.5 * random.random() + .1)
-            s2 = float(self.chan_map.std()) * (.5 * random.random() + .1)
-            s3 = float(self.plasticity.std()) * (.5 * random.random() + .1)
-            m1 = m2 = m3 = 0.
+        """
+        Independent copy of the edge. It is built from an instance of this edge, so nothing is randomly initialized
+        only to be overwritten, and gets detached copies of the parameters.
+        :param fuzzy: Whether to perturb the copied parameters with gaussian noise.
+        """
+        instance = self.instantiate(self.instances)
+        instance.init_weight = _perturbed(self.init_weight, fuzzy)
+        instance.chan_map = _perturbed(self.chan_map, fuzzy)
+        instance.plasticity = _perturbed(self.plasticity, fuzzy)
+        # beta is perturbed on the scale of the plasticity.
+        instance.beta = _perturbed(self.beta, fuzzy, like=self.plasticity)
+        return instance.set_precision(self.precision)
+
+
+class LowRankFCPlasticEdges(FCPlasticEdges):
+    def __init__(self, num_nodes, spatial, channels, device='cpu', mask=None, optimize_weights=True, debug=False,
+                 through_time=False, instances=None, rank=16, *args, **kwargs):
+        """
+        Fully connected plastic edges whose weights are never formed as an (N, N) matrix, N = nodes * spatial *
+        channels. The plastic weight is the decayed initial weight, which is constant over the spatial dims, plus a
+        fast weight term made of the rank-1 outer products of the last `rank` hebbian updates. Each term is scaled by
+        the (n, n, c, c) plasticity and decayed by (1 - plasticity) per update it has aged, so with unlimited rank
+        this is the same recurrence as FCPlasticEdges. Memory and per-step cost are linear in N.
+        The update gate reads the weights in the canonical (source, target) order, i.e. with the same product as the
+        forward pass, rather than in the flattened layout of FCPlasticEdges.
+        :param rank: number of rank-1 terms kept, two are added per update.
+        Other parameters are as in FCPlasticEdges, edge lists are not supported.
+        """
+        if kwargs.get("edge_list", False):
+            raise ValueError("Low rank edges do not support edge lists.")
+        kwargs["edge_list"] = False
+        self.rank = rank
+        super().__init__(num_nodes, spatial, channels, device=device, mask=mask, optimize_weights=optimize_weights,
+                         debug=debug, through_time=through_time, instances=instances, **kwargs)
+
+    def _init_base_weight(self, device):
+        # constant over the spatial dims, scaled to match the summed magnitude of the dense initial weights.
+        init_weight = torch.zeros((self.num_nodes, self.num_nodes, self.channels, self.channels), device=device)
+        return torch.nn.init.xavier_normal_(init_weight * .1) / self.spatial
+
+    @property
+    def weight(self):
+        """
+        Dense canonical ((z), n, n, s, s, c, c) plastic weights. Only formed on request, for inspection.
+        """
+        batch = self._num_instances()
+        decay = 1 - self.plasticity
+        weight = (torch.abs(self._compute(self.init_weight)) * decay ** self._updates).view(
+            (1, self.num_nodes, self.num_nodes, 1, 1, self.channels, self.channels))
+        weight = weight.expand((batch,) + self._weight_shape()[-6:])
+        if self._fast_a is not None:
+            blocks = self.plasticity * decay.unsqueeze(0) ** self._ages.view(-1, 1, 1, 1, 1)  # r, u, v, c, c
+            weight = weight + torch.einsum("zruai, zrvbj, ruvab -> zuvijab", self._fast_a, self._fast_b, blocks)
+        return weight.reshape(self._weight_shape())
+
+    @weight.setter
+    def weight(self, weight):
+        if weight is not None:
+            raise ValueError("Low rank edges can not be assigned dense weights.")
+        # fast weight terms, (z, r, n, c, s) source and target factors and the updates each term has aged.
+        self._fast_a = None
+        self._fast_b = None
+        self._ages = None
+        # number of updates the initial weights have decayed through.
+        self._updates = 0
+
+    def _cast_weights(self):
+        if self._fast_a is not None:
+            self._fast_a = self._compute(self._fast_a.detach())
+            self._fast_b = self._compute(self._fast_b.detach())
+
+    def _apply(self, x, scale=None):
+        """
+        Multiplies vectors by the (block scaled) plastic weights without forming them.
+        :param x: Tensor (z, k, u, c, s), k vectors in state layout.
+        :param scale: optional (n, n, c, c) block scale.
+        :return: Tensor (z, k, v, c, s)
+        """
+        decay = 1 - self.plasticity
+        init = torch.abs(self._compute(self.init_weight)) * decay ** self._updates
+        if scale is not None:
+            init = init * scale
+        # initial weights are constant over space, so only the spatial sum of the source is needed.
+        out = torch.einsum("zkua, uvab -> zkvb", x.sum(dim=-1), init).unsqueeze(-1)
+        if self._fast_a is None:
+            return out.expand(tuple(x.shape[:2]) + (self.num_nodes, self.channels, self.spatial))
+        blocks = self.plasticity * decay.unsqueeze(0) ** self._ages.view(-1, 1, 1, 1, 1)  # r, u, v, c, c
+        if scale is not None:
+            blocks = blocks * scale
+        proj = torch.einsum("zkuai, zruai -> zkrua", x, self._fast_a)
+        proj = torch.einsum("zkrua, ruvab -> zkrvb", proj, blocks)
+        return out + torch.einsum("zkrvb, zrvbj -> zkvbj", proj, self._fast_b)
+
+    def _propagate(self, x):
+        batch = self._num_instances()
+        scale = self.mask.view(self.num_nodes, self.num_nodes, 1, 1) * self.chan_map
+        out = self._apply(x.view((batch, 1, self.num_nodes, self.channels, self.spatial)), scale)
+        return out.reshape(x.shape)
+
+    def _new_terms(self, x):
+        # the update adds the two rank-1 terms of flip(coactivation).T @ gate, as (z, 2, n, c, s) factors.
+        batch = self._num_instances()
+        size = self.num_nodes * self.spatial * self.channels
+        target_meta_activations = x.reshape(batch, self.num_nodes * self.channels,
+                                            self.spatial).transpose(1, 2)  # (z, s, nc)
+        coactivation = torch.stack((self.activation_memory.reshape(batch, size),
+                                    target_meta_activations.reshape(batch, size)), dim=1)  # z, 2, mm
+        coactivation = coactivation.view((batch, 2, self.num_nodes, self.channels, self.spatial))
+        gate = self._apply(coactivation).reshape((batch, 2, size))
+        gate = torch.softmax(self.beta * gate, dim=1).view((batch, 2, self.num_nodes, self.channels, self.spatial))
+        return torch.flip(coactivation, (1,)), gate
+
+    def _hebbian(self, x):
+        if self.activation_memory is None:
+            return
+        if not self.through_time and self._fast_a is not None:
+            self._fast_a, self._fast_b = self._fast_a.detach(), self._fast_b.detach()
+        fast_a, fast_b = self._new_terms(x)
+        ages = torch.zeros((2,), device=x.device)
+        # older terms age by one update.
+        if self._fast_a is not None:
+            fast_a = torch.cat((self._fast_a, fast_a), dim=1)[:, -self.rank:]
+            fast_b = torch.cat((self._fast_b, fast_b), dim=1)[:, -self.rank:]
+            ages = torch.cat((self._ages + 1, ages))[-self.rank:]
+        self._fast_a, self._fast_b, self._ages = fast_a, fast_b, ages
+        self._updates += 1
+
+    def inference(self, enabled=True):
+        """
+        Switches the edge in or out of inference mode. The fast weight factors move to preallocated (z, rank, n, c, s)
+        ring buffers and each update overwrites the two oldest terms in place rather than concatenating new factors.
+        Steps do not track gradients, their contractions are linear in N and still allocate their outputs.
+        :param enabled: whether to enter or leave inference mode.
+        :return: self
+        """
+        self._inference = enabled
+        if not enabled:
+            if self._scratch is not None:
+                # back to oldest first order, as the concatenating update expects.
+                shift = -self._scratch["pos"]
+                self._fast_a = torch.roll(self._fast_a, shift, dims=1)
+                self._fast_b = torch.roll(self._fast_b, shift, dims=1)
+                self._ages = torch.roll(self._ages, shift, dims=0)
+                if self.activation_memory is not None:
+                    self.activation_memory = self.activation_memory.clone()
+            self._scratch = None
+            return self
+        if self._scratch is not None:
+            return self
+        batch = self._num_instances()
+        opts = {"device": self.device, "dtype": self.chan_map.dtype}
+        shape = (batch, self.rank, self.num_nodes, self.channels, self.spatial)
+        with torch.no_grad():
+            fast_a = self._compute(torch.zeros(shape, **opts))
+            fast_b = torch.zeros_like(fast_a)
+            ages = torch.zeros((self.rank,), device=self.device)
+            used = 0
+            if self._fast_a is not None:
+                used = self._fast_a.shape[1]
+                fast_a[:, :used] = self._fast_a
+                fast_b[:, :used] = self._fast_b
+                ages[:used] = self._ages
+        self._fast_a, self._fast_b, self._ages = fast_a, fast_b, ages
+        # ring position of the next write, the oldest term once the ring is full. Unused slots stay zero.
+        self._scratch = {"pos": used % self.rank}
+        return self
+
+    def _step_inference(self, x):
+        x = self._activate(x)
+        if self.activation_memory is not None:
+            fast_a, fast_b = self._new_terms(x)
+            # the two new terms take the slots of the two oldest.
+            pos = self._scratch["pos"]
+            self._ages.add_(1)
+            for j in range(2):
+                slot = (pos + j) % self.rank
+                self._fast_a[:, slot] = fast_a[:, j]
+                self._fast_b[:, slot] = fast_b[:, j]
+                self._ages[slot] = 0
+            self._scratch["pos"] = (pos + 2) % self.rank
+            self._updates += 1
+        self.activation_memory = x
+        return self._propagate(x)
+
+    def _get_plastic_state(self):
+        return self._fast_a, self._fast_b, self._ages, self._updates, self.activation_memory
+
+    def _set_plastic_state(self, state):
+        self._fast_a, self._fast_b, self._ages, self._updates, self.activation_memory = state
+
+    def truncate(self):
+        if self._fast_a is not None:
+            self._fast_a, self._fast_b = self._fast_a.detach(), self._fast_b.detach()
+        if self.activation_memory is not None:
+            self.activation_memory = self.activation_memory.detach()
+        return self
+
+    def detach(self, reset_weight=False):
+        if self._scratch is not None:
+            # ring buffers are reset in place.
+            if reset_weight:
+                self._fast_a.zero_()
+                self._fast_b.zero_()
+                self._ages.zero_()
+                self._updates = 0
+                self._scratch["pos"] = 0
+            self.activation_memory = None
+            return self
+        if reset_weight:
+            self.weight = None
+        else:
+            self.truncate()
+        self.activation_memory = None
+        return self
+
+    def to(self, device):
+        if self.optimize_weights:
+            self.init_weight = torch.nn.Parameter(self.init_weight.to(device))
         else:
-            s1 = s2 = s3 = m1 = m2 = m3 = 0.
-
-        instance.init_weight = torch.nn.Parameter(
-            self.init_weight.detach().clone() + torch.normal(size=self.init_weight.shape,
-                                                             mean=m1,
-                                                             std=s1, device=self.device))
-
-        instance.weight = instance._expand_base_weights(instance.init_weight)
-        instance.chan_map = torch.nn.Parameter(self.chan_map.detach().clone() + torch.normal(size=self.chan_map.shape,
-                                                                                             mean=m2,
-                                                                                             std=s2,
-                                                                                             device=self.device))
-        instance.plasticity = torch.nn.Parameter(
-            self.plasticity.detach().clone() + torch.normal(size=self.chan_map.shape,
-                                                            mean=m3,
-                                                            std=s3, device=self.device))
-
-        instance.beta = torch.nn.Parameter(
-            self.beta.detach().clone() + torch.normal(size=self.beta.shape,
-                                                      mean=m3,
-                                                      std=s3, device=self.device))
-        return instance
+            self.init_weight = self.init_weight.to(device)
+        self.chan_map = torch.nn.Parameter(self.chan_map.to(device))
+        self.plasticity = torch.nn.Parameter(self.plasticity.to(device))
+        self.beta = torch.nn.Parameter(self.beta.to(device))
+        self.mask = self.mask.to(device)
+        if self._fast_a is not None:
+            self._fast_a, self._fast_b = self._fast_a.to(device), self._fast_b.to(device)
+            self._ages = self._ages.to(device)
+        self.device = device
+        return self
@@ -0,0 +1,82 @@
+import numpy as np
+import torch
+
+
+class NoisePool:
+    """
+    Standard normal noise owned by one model. Noise is drawn from the pool's own generator in blocks covering many
+    ticks and handed out one tick at a time, so a tick costs no RNG launch and models never share a generator. Block i
+    is drawn from a generator seeded by (seed, stream, i), which makes the stream reproducible from its seed and lets
+    any tick be revisited by setting position, e.g. when a checkpointed segment is recomputed.
+    """
+
+    def __init__(self, shape, seed=None, stream=0, block_elements=2 ** 20, device='cpu', dtype=None):
+        """
+        :param shape: shape of the noise drawn each tick.
+        :param seed: seed of the stream. If None, a seed is drawn from the global torch RNG, so streams of separately
+                     constructed models are independent but still follow torch.manual_seed.
+        :param stream: id separating streams that share a seed, e.g. the state and channel noise of one model.
+        :param block_elements: approximate number of elements drawn at once.
+        :param device: device the noise is generated on.
+        :param dtype: dtype of the returned noise, default dtype if None. Noise is always drawn in float64 and cast,
+                      so pools with the same seed give the same noise up to rounding at any precision.
+        """
+        if seed is None:
+            seed = int(torch.randint(0, 2 ** 62, (1,)))
+        self.shape = tuple(shape)
+        self.seed = seed
+        self.stream = stream
+        self.block = max(1, block_elements // max(1, int(np.prod(self.shape))))
+        self.device = device
+        if dtype is None:
+            dtype = torch.get_default_dtype()
+        self.dtype = dtype
+        self.generator = torch.Generator(device=device)
+        # index of the next tick to hand out.
+        self.position = 0
+        self._index = None
+        self._noise = None
+
+    def _fill(self, index):
+        state = np.random.SeedSequence([self.seed, self.stream, index]).generate_state(1, np.uint64)[0]
+        self.generator.manual_seed(int(state) >> 1)
+        # a fresh block is allocated, so noise handed out earlier stays valid.
+        self._noise = torch.randn((self.block,) + self.shape, generator=self.generator, device=self.device,
+                                  dtype=torch.float64).to(self.dtype)
+        self._index = index
+
+    def draw(self):
+        """
+        :return: Tensor, noise for the next tick with the pool's shape. It is a view of the current block.
+        """
+        index, offset = divmod(self.position, self.block)
+        if index != self._index:
+            self._fill(index)
+        self.position += 1
+        return self._noise[offset]
+
+    def reseed(self, seed):
+        """
+        Restarts the pool on a new stream.
+        :param seed: new seed.
+        :return: self
+        """
+        self.seed = seed
+        self.position = 0
+        self._index = None
+        self._noise = None
+        return self
+
+    def to(self, device=None, dtype=None):
+        """
+        Moves the pool, the current position in the stream is kept.
+        :return: self
+        """
+        if device is not None and device != self.device:
+            self.device = device
+            self.generator = torch.Generator(device=device)
+        if dtype is not None:
+            self.dtype = dtype
+        self._index = None
+        self._noise = None
+        return self
@@ -0,0 +1,55 @@
+import torch
+
+
+class PrecisionPolicy:
+    """
+    Dtypes used by an intrinsic model in place of the global torch default. States, parameters and the forward pass
+    use the compute dtype. The plastic weights are an exponential average over many ticks with small plasticity, so
+    they are the one place rounding error accumulates and are kept in the accumulate dtype. Initial weights that are
+    not optimized can be stored in a smaller init_storage dtype (e.g. torch.bfloat16) and are cast up when expanded.
+    """
+
+    def __init__(self, compute=torch.float32, accumulate=torch.float64, init_storage=None):
+        """
+        :param compute: dtype of states, parameters and the forward contraction.
+        :param accumulate: dtype the plastic weights are stored and updated in.
+        :param init_storage: optional storage dtype for frozen initial weights, compute if None.
+        """
+        self.compute = compute
+        self.accumulate = accumulate
+        if init_storage is None:
+            init_storage = compute
+        self.init_storage = init_storage
+
+    def __repr__(self):
+        return "PrecisionPolicy(compute=" + str(self.compute) + ", accumulate=" + str(self.accumulate) + \
+               ", init_storage=" + str(self.init_storage) + ")"
+
+
+def check_parity(model, precision, steps=100, inputs=None, masks=None, ticks_per_input=1, seed=0):
+    """
+    Runs copies of a model under a precision policy and under a float64 reference with the same noise, and reports
+    how far the candidate drifts from the reference over the rollout.
+    :param model: Intrinsic or FCIntrinsic model, it is not modified.
+    :param precision: PrecisionPolicy to check.
+    :param steps: number of inputs to run when no inputs are given.
+    :param inputs: optional (T, ...) inputs passed to rollout.
+    :param masks: boolean (T, ...), required with inputs.
+    :param ticks_per_input: ticks run for each input.
+    :param seed: seed used for both runs.
+    :return: dict with the max absolute state error at each step, its maximum, the relative state error at the last
+             step and the max absolute plastic weight error at the end.
+    """
+    reference = model.clone().set_precision(PrecisionPolicy(compute=torch.float64, accumulate=torch.float64))
+    candidate = model.clone().set_precision(precision)
+    histories = []
+    for mod in (reference, candidate):
+        mod.reseed(seed)
+        mod_inputs = None if inputs is None else inputs.to(mod.states.dtype)
+        with torch.no_grad():
+            histories.append(mod.rollout(mod_inputs, masks, steps=steps, ticks_per_input=ticks_per_input).double())
+    error = (histories[0] - histories[1]).abs().flatten(1).max(dim=1).values
+    relative = torch.linalg.norm(histories[0][-1] - histories[1][-1]) / torch.linalg.norm(histories[0][-1])
+    weight_error = (reference.edge.weight.double() - candidate.edge.weight.double()).abs().max()
+    return {"state_error": error, "max_state_error": float(error.max()), "relative_error": float(relative),
+            "weight_error": float(weight_error)}
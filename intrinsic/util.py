@@ -1,3 +1,5 @@
+import itertools
+
 import torch
 import numpy as np
 
@@ -34,6 +36,29 @@ def conv_identity_params(in_spatial, desired_kernel, stride=1):
     return int(kernel + 1), int(pad)
 
 
+def xavier_std(shape, gain=1.):
+    """
+    Standard deviation torch.nn.init.xavier_normal_ uses for a tensor of the given shape.
+    :param shape: tensor shape, at least 2D
+    :param gain: optional scaling factor
+    :return: float
+    """
+    receptive = int(np.prod(shape[2:]))
+    fan_in = shape[1] * receptive
+    fan_out = shape[0] * receptive
+    return gain * (2. / (fan_in + fan_out)) ** .5
+
+
+def mask_to_edges(mask):
+    """
+    Compiles a (n, n) adjacency mask into a list of active edges.
+    :param mask: (n, n) adjacency matrix, nonzero entries are edges from the row node to the column node.
+    :return: (source, target) long tensors with one entry per active edge, in row major order.
+    """
+    src, dst = torch.nonzero(mask, as_tuple=True)
+    return src, dst
+
+
 def unfold_nd(input_tensor: torch.Tensor, kernel_size: int, padding: int, spatial_dims: int, stride=1):
     """
     Unfolds an input tensor with an arbitrary number of spatial dimensions using an even kernel.
@@ -61,22 +86,46 @@ def unfold_nd(input_tensor: torch.Tensor, kernel_size: int, padding: int, spatia
     return padded
 
 
+def fold_nd(input_tensor: torch.Tensor, output_size: tuple, kernel_size: int, padding: int, stride=1):
+    """
+    Inverse of unfold_nd, sums every receptive field back into place (scatter-add). Matches torch.nn.Fold for any
+    number of spatial dimensions. Runs one strided add per kernel offset.
+    :param input_tensor: (batch, channels * kernel^n, blocks) with channels outer, as returned by unfold_nd
+    :param output_size: spatial shape (spatial_0, ... , spatial_n) of the folded tensor
+    :param kernel_size: int < spatial
+    :param padding: int < kernel
+    :param stride: kernel stride length. defualt = 1
+    :return: folded tensor (batch, channels, spatial_0, ... , spatial_n)
+    """
+    spatial_dims = len(output_size)
+    batch_size = input_tensor.shape[0]
+    channel_size = input_tensor.shape[1] // kernel_size ** spatial_dims
+    padded_size = [s + 2 * padding for s in output_size]
+    blocks = [(s - kernel_size) // stride + 1 for s in padded_size]
+    unfolded = input_tensor.reshape([batch_size, channel_size] + [kernel_size] * spatial_dims + blocks)
+    folded = torch.zeros([batch_size, channel_size] + padded_size, device=input_tensor.device,
+                         dtype=input_tensor.dtype)
+    for offset in itertools.product(range(kernel_size), repeat=spatial_dims):
+        window = tuple(slice(o, o + stride * (b - 1) + 1, stride) for o, b in zip(offset, blocks))
+        folded[(slice(None), slice(None)) + window] += unfolded[(slice(None), slice(None)) + offset]
+    interior = tuple(slice(padding, padding + s) for s in output_size)
+    return folded[(slice(None), slice(None)) + interior]
+
+
 def triu_to_square(triu_vector, n, includes_diag=False):
     """
     Converts an upper triangle vector to a full (redundant) symmetrical square matrix.
-    :param tri_vector: data point vector
+    :param tri_vector: data point vector, or (pairs, ...) tensor with trailing dims kept on each entry
     :param n: size of resulting square
     :param includes_diag: whether the main diagonal is included in triu_vector
-    :return: a symmetric square tensor
+    :return: a symmetric square tensor (n, n, ...), with the dtype and device of triu_vector
     """
     if includes_diag:
         offset = 0
     else:
         offset = 1
-    adj = torch.zeros((n, n), dtype=torch.float)
-    ind = torch.triu_indices(n, n, offset=offset)
-    adj[ind[0], ind[1]] = triu_vector
-    adj = (adj.T + adj)
-    if includes_diag:
-        adj = adj - torch.diag(torch.diagonal(adj) / 2)
+    ind = torch.triu_indices(n, n, offset=offset, device=triu_vector.device)
+    adj = triu_vector.new_zeros((n, n) + tuple(triu_vector.shape[1:]))
+    # the diagonal is written twice with the same value, so it is not doubled.
+    adj = adj.index_put((ind[0], ind[1]), triu_vector).index_put((ind[1], ind[0]), triu_vector)
     return adj
@@ -2,7 +2,9 @@ from agent.agents import WaterworldAgent, DisjointWaterWorldAgent, FCWaterworldA
 from agent.evolve import EvoController
 import pickle
 import torch
-# torch.set_default_dtype(torch.float64)
+# evolution runs were tuned in double precision. Set here, not on import of agent.evolve, so that spawned workers
+# (which re-import this module) match and library users can choose an intrinsic.precision.PrecisionPolicy instead.
+torch.set_default_dtype(torch.float64)
 import sys
 
 if __name__=="__main__":
@@ -5,6 +5,7 @@ from torchvision.datasets.mnist import MNIST
 from torchvision.transforms import PILToTensor
 from torch.utils.data import DataLoader
 from intrinsic.model import Intrinsic, FCIntrinsic
+from agent.reward_functions import return_from_reward
 from sklearn.metrics import roc_curve, RocCurveDisplay
 import matplotlib
 from matplotlib import pyplot as plt
@@ -14,32 +15,6 @@ import numpy as np
 import pickle
 
 
-def return_from_reward(rewards, gamma):
-    """
-    Compute the discounted returns for each timestep from a tensor of rewards.
-
-    Parameters:
-    - rewards (torch.Tensor): Tensor containing the instantaneous rewards.
-    - gamma (float): Discount factor (0 < gamma <= 1).
-
-    Returns:
-    - torch.Tensor: Tensor containing the discounted returns.
-    """
-    # Initialize an empty tensor to store the returns
-    returns = torch.zeros_like(rewards)
-
-    # Variable to store the accumulated return, initialized to 0
-    G = 0
-
-    # Iterate through the rewards in reverse (from future to past)
-    for t in reversed(range(len(rewards))):
-        # Update the return: G_t = r_t + gamma * G_{t+1}
-        G = rewards[t] + gamma * G
-        returns[t] = G
-
-    return returns
-
-
 def l2l_loss(logits, targets, lfxn, classes=3, power=2, window=6):
     """
     :param logits: (examples, classes)
@@ -192,9 +167,11 @@ class Decoder:
             use_labels = self.train_labels
         l_fxn = torch.nn.CrossEntropyLoss()
         data = DataLoader(data, shuffle=True, batch_size=1)
+        self.model.inference(True)
         with torch.no_grad():
             logits, labels = self._fit(data, use_labels, iter)
             # loss = l2l_loss(logits, labels, l_fxn)
+        self.model.inference(False)
         # print("Self Learn Loss:", loss.detach().item())
 
     def evaluate(self, data, iter, use_labels=None):
@@ -202,8 +179,10 @@ class Decoder:
             use_labels = self.train_labels
         l_fxn = torch.nn.CrossEntropyLoss()
         data = DataLoader(data, shuffle=True, batch_size=1)
+        self.model.inference(True)
         with torch.no_grad():
             logits, labels = self._fit(data, use_labels, iter)
+        self.model.inference(False)
         labels = labels.long().flatten()
         probs = torch.softmax(logits, dim=1)[:, 1].flatten()
         avg_loss = l_fxn(logits, labels)
@@ -1,4 +1,11 @@
-from intrinsic import module
+import queue
+
+import networkx as nx
+import numpy as np
+from intrinsic import module, model, precision
+from agent import reward_functions, exist
+from agent.evolve import PopulationAdam, LineageStore, _compute_loss_values
+from agent.agents import WaterworldAgent
 import torch
 
 
@@ -33,6 +40,480 @@ def test_intrinsic():
     print('done')
 
 
+def test_batched_instances():
+    base = module.PlasticEdges(channels=2, spatial1=6, spatial2=6, kernel_size=3, num_nodes=3)
+    batched = base.instantiate(instances=3)
+    singles = [base.instantiate() for _ in range(3)]
+    states = torch.normal(mean=0, std=.5, size=(3, 3, 2, 6, 6))
+    # channel noise is drawn once per forward call, so a shared seed gives every instance the same noise.
+    for edge in [batched] + singles:
+        edge.reseed(0)
+    for step in range(3):
+        batched.update(states)
+        out = batched(states)
+        for i, single in enumerate(singles):
+            single.update(states[i])
+            assert torch.allclose(out[i], single(states[i]), atol=1e-5)
+        states = out.detach()
+
+
+def test_fc_batched_instances():
+    base = module.FCPlasticEdges(num_nodes=3, spatial=4, channels=2)
+    batched = base.instantiate(instances=2)
+    singles = [base.instantiate() for _ in range(2)]
+    states = torch.normal(mean=0, std=.5, size=(2, 3, 2, 4))
+    for step in range(3):
+        batched.update(states)
+        out = batched(states)
+        for i, single in enumerate(singles):
+            single.update(states[i])
+            assert torch.allclose(out[i], single(states[i]), atol=1e-5)
+        states = out.detach()
+
+
+def test_contraction_plans():
+    mask = (torch.rand((3, 3)) > .3).float()
+    base = module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=3, mask=mask,
+                               contraction_plan="compose")
+    states = torch.normal(mean=0, std=.5, size=(3, 2, 5, 5))
+    base.update(states)
+    base.reseed(0)
+    expected = base(states)
+    for plan in ["reduce", "stream"]:
+        base.contraction_plan = plan
+        base._plans = {}
+        base.reseed(0)
+        assert torch.allclose(base(states), expected, atol=1e-5)
+        assert base.plan["name"] == plan
+
+
+def test_fused_step():
+    for base in [module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=3),
+                 module.FCPlasticEdges(num_nodes=3, spatial=4, channels=2)]:
+        fused = base.instantiate()
+        split = base.instantiate()
+        states = torch.normal(mean=0, std=.5, size=(3, 2) + ((5, 5) if base.kernel_size else (4,)))
+        fused.reseed(0)
+        split.reseed(0)
+        for step in range(3):
+            out = fused.step(states)
+            split.update(states)
+            assert torch.allclose(out, split(states), atol=1e-5)
+            states = out.detach()
+
+
+def test_lazy_weights():
+    mask = (torch.rand((3, 3)) > .3).float()
+    base = module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=3, mask=mask)
+    base.weight = base._expand_base_weights(base.init_weight)
+    assert base.weight.storage().size() < base.weight.numel()
+    states = torch.normal(mean=0, std=.5, size=(3, 2, 5, 5))
+    base.reseed(0)
+    expected = base(states)
+    base.weight = base.weight.contiguous()
+    base._weight_base = None
+    base.reseed(0)
+    assert torch.allclose(base(states), expected, atol=1e-5)
+
+
+def test_edge_list():
+    mask = (torch.rand((4, 4)) > .5).float()
+    dense = module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=4, mask=mask)
+    sparse = module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=4, mask=mask,
+                                 edge_list=True)
+    sparse.init_weight, sparse.chan_map, sparse.plasticity = dense.init_weight, dense.chan_map, dense.plasticity
+    states = torch.normal(mean=0, std=.5, size=(4, 2, 5, 5))
+    dense.reseed(0)
+    sparse.reseed(0)
+    for step in range(3):
+        out = dense.step(states)
+        assert torch.allclose(sparse.step(states), out, atol=1e-5)
+        states = out.detach()
+    assert sparse.weight.shape[0] == int(mask.sum())
+
+
+def test_inference_mode():
+    mask = (torch.rand((3, 3)) > .3).float()
+    # edge lists fall back to the ordinary step, low rank edges wrap their ring buffers after two steps.
+    for edge in [module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=3, mask=mask),
+                 module.FCPlasticEdges(num_nodes=3, spatial=4, channels=2, mask=mask),
+                 module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=3, mask=mask,
+                                     edge_list=True),
+                 module.FCPlasticEdges(num_nodes=3, spatial=4, channels=2, mask=mask, edge_list=True),
+                 module.LowRankFCPlasticEdges(num_nodes=3, spatial=4, channels=2, mask=mask, rank=4)]:
+        inference = edge.clone().inference(True)
+        reference = edge.clone()
+        states = torch.normal(mean=0, std=.5, size=(3, 2, 5, 5) if edge.kernel_size else (3, 2, 4))
+        inference.reseed(0)
+        reference.reseed(0)
+        for step in range(5):
+            with torch.no_grad():
+                out = reference.step(states)
+            step_out = inference.step(states)
+            assert not step_out.requires_grad
+            assert torch.allclose(step_out, out, atol=1e-5)
+            states = out
+        # leaving inference mode keeps the plastic state.
+        inference.inference(False)
+        with torch.no_grad():
+            assert torch.allclose(inference.step(states), reference.step(states), atol=1e-5)
+
+
+def test_rollout():
+    base = model.FCIntrinsic(num_nodes=3, node_shape=(1, 2, 4), inject_noise=True)
+    stepped = base.clone()
+    inputs = torch.normal(mean=0, std=.5, size=(4, 3, 2, 4))
+    masks = torch.zeros_like(inputs).bool()
+    masks[:, 0] = True
+    base.reseed(0)
+    history = base.rollout(inputs, masks, ticks_per_input=2)
+    stepped.reseed(0)
+    for t in range(4):
+        stepped(inputs[t], masks[t])
+        stepped()
+        assert torch.allclose(history[t], stepped.states, atol=1e-5)
+
+
+def test_checkpointed_rollout():
+    base = model.FCIntrinsic(num_nodes=3, node_shape=(1, 2, 4), through_time=True)
+    checkpointed = base.clone()
+    checkpointed.checkpoint_segment = 2
+    inputs = torch.normal(mean=0, std=.5, size=(5, 3, 2, 4))
+    masks = torch.zeros_like(inputs).bool()
+    masks[:, 0] = True
+    grads = []
+    for mod in [base, checkpointed]:
+        mod.reseed(0)
+        mod.rollout(inputs, masks).sum().backward()
+        grads.append([p.grad for p in mod.parameters()])
+    for expected, grad in zip(*grads):
+        # every parameter, init_weight included, gets the gradient of the rollout without checkpoints.
+        assert expected is not None and grad is not None
+        assert torch.allclose(expected, grad, atol=1e-5)
+    assert torch.linalg.norm(checkpointed.edge.init_weight.grad) > 0
+    assert checkpointed.memory_plan(5)["recomputed_ticks"] == 5
+
+
+def test_precision_parity():
+    base = model.FCIntrinsic(num_nodes=3, node_shape=(1, 2, 4), inject_noise=True)
+    policy = precision.PrecisionPolicy(compute=torch.float32, accumulate=torch.float64)
+    report = precision.check_parity(base, policy, steps=20)
+    assert report["max_state_error"] < 1e-3
+    candidate = base.clone().set_precision(policy)
+    candidate.rollout(steps=2)
+    assert candidate.states.dtype == torch.float32 and candidate.edge.weight.dtype == torch.float64
+
+
+def test_fc_weight_layouts():
+    edge = module.FCPlasticEdges(num_nodes=3, spatial=4, channels=2)
+    states = torch.normal(mean=0, std=.5, size=(3, 2, 4))
+    for step in range(3):
+        states = edge.step(states).detach()
+    canonical = edge.weight.unsqueeze(0)
+    assert edge._weight_l.is_contiguous()
+    assert torch.allclose(edge._weight_l, canonical.permute(0, 1, 4, 3, 6, 2, 5), atol=1e-6)
+    out = edge(states)
+    # the forward pass reads the stored layout and scales its outputs, the same map as the canonical weights.
+    scale = edge.mask.view(3, 3, 1, 1) * edge.chan_map
+    expected = torch.einsum("uai, uvitab, uvab -> vbt", torch.sigmoid(states), edge.weight, scale)
+    assert torch.allclose(out, expected, atol=1e-5)
+    # a canonical weight assigned back is converted to the same layouts.
+    edge.weight = edge.weight.clone()
+    assert torch.allclose(edge(states), out, atol=1e-6)
+
+
+def test_low_rank_edges():
+    mask = (torch.rand((3, 3)) > .3).float()
+    edge = module.LowRankFCPlasticEdges(num_nodes=3, spatial=4, channels=2, mask=mask, rank=4)
+    states = torch.normal(mean=0, std=.5, size=(3, 2, 4))
+    for step in range(3):
+        states = edge.step(states).detach()
+    assert edge._fast_a.shape[1] == 4
+    # the factored forward pass matches the dense weights it represents.
+    weight = edge.weight
+    expected = torch.einsum("uai, uvijab, uv, uvab -> vbj", torch.sigmoid(states), weight, mask, edge.chan_map)
+    assert torch.allclose(edge(states), expected, atol=1e-5)
+
+
+def test_nd_edges():
+    base = module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=3)
+    nd = module.PlasticEdgesND(3, 5, 5, kernel_size=3, channels=2)
+    nd.init_weight = torch.nn.Parameter(base.init_weight.detach().clone())
+    nd.chan_map = torch.nn.Parameter(base.chan_map.detach().clone())
+    nd.plasticity = torch.nn.Parameter(base.plasticity.detach().clone())
+    states = torch.normal(mean=0, std=.5, size=(3, 2, 5, 5))
+    base.reseed(0)
+    nd.reseed(0)
+    for step in range(3):
+        out = base.step(states)
+        assert torch.allclose(nd.step(states), out, atol=1e-5)
+        states = out.detach()
+    # 1D and 3D nodes run through the full model.
+    for node_shape in [(1, 2, 7), (1, 2, 4, 4, 4)]:
+        mod = model.Intrinsic(3, node_shape=node_shape, edge_module=module.PlasticEdgesND, instances=2)
+        history = mod.rollout(steps=2)
+        assert history.shape == (2, 2, 3) + node_shape[1:]
+
+
+def test_symmetric_edges():
+    mask = (torch.rand((4, 4)) > .4).float()
+    mask = torch.maximum(mask, mask.T)
+    sym = module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=4, mask=mask,
+                              symmetric=True)
+    assert sym.chan_map.shape == (10, 2, 2)
+    # a directed edge list with the mirrored parameters sends the same first messages.
+    directed = module.PlasticEdges(channels=2, spatial1=5, spatial2=5, kernel_size=3, num_nodes=4, mask=mask,
+                                   edge_list=True)
+    directed.init_weight = torch.nn.Parameter(sym._square(sym.init_weight.detach()))
+    directed.chan_map = torch.nn.Parameter(sym._square(sym.chan_map.detach()))
+    directed.plasticity = torch.nn.Parameter(sym._square(sym.plasticity.detach()))
+    # the two channel maps have different shapes, so their noise streams can not be matched and noise is turned off.
+    sym._chan_noise_std = 0.
+    directed._chan_noise_std = 0.
+    states = torch.normal(mean=0, std=.5, size=(4, 2, 5, 5))
+    assert torch.allclose(sym.step(states), directed.step(states), atol=1e-6)
+    sym.step(states)
+    assert sym.weight.shape[0] == int(torch.triu(mask).sum())
+
+
+def test_noise_streams():
+    base = model.Intrinsic(3, node_shape=(1, 2, 5, 5), inject_noise=True)
+    copies = [base.clone().reseed(7) for _ in range(2)]
+    histories = [mod.rollout(steps=3).detach() for mod in copies]
+    assert torch.equal(histories[0], histories[1])
+    # streams are seekable, a rewound pool hands out the same noise again.
+    pool = base.noise_pool
+    first = pool.draw().clone()
+    pool.position -= 1
+    assert torch.equal(pool.draw(), first)
+
+
+def test_shared_instances():
+    base = model.FCIntrinsic(num_nodes=3, node_shape=(1, 2, 4), through_time=True)
+    copies = [base.instantiate() for _ in range(2)]
+    for mod in copies:
+        assert all(p is q for p, q in zip(mod.parameters(), base.parameters()))
+        mod.rollout(steps=3).sum().backward()
+    # both copies backpropagate into the base parameters, and their plastic state stays separate.
+    assert all(p.grad is not None for p in base.parameters())
+    assert copies[0].edge.weight is not copies[1].edge.weight
+
+
+def test_clone():
+    for base in [model.Intrinsic(3, node_shape=(1, 2, 5, 5)), model.FCIntrinsic(3, node_shape=(1, 2, 4)),
+                 model.FCIntrinsic(3, node_shape=(1, 2, 4), edge_module=module.LowRankFCPlasticEdges)]:
+        exact = base.clone()
+        for p, q in zip(base.parameters(), exact.parameters()):
+            assert p is not q and torch.equal(p, q)
+        fuzzy = base.clone(fuzzy=True)
+        assert not torch.equal(base.edge.chan_map, fuzzy.edge.chan_map)
+        history = exact.rollout(steps=2)
+        assert history.shape[1:] == base.states.shape
+
+
+def test_batched_returns():
+    rewards = torch.normal(mean=0, std=1, size=(40, 3), dtype=torch.float64)
+    lengths = [40, 25, 12]
+    returns = reward_functions.return_from_reward(rewards, .9, lengths)
+    for j, length in enumerate(lengths):
+        expected = torch.zeros(length, dtype=torch.float64)
+        g = 0.
+        for t in reversed(range(length)):
+            g = rewards[t, j] + .9 * g
+            expected[t] = g
+        assert torch.allclose(returns[:length, j], expected)
+        assert torch.all(returns[length:, j] == 0)
+    # one batched call matches successive per agent calls, including the running return statistics.
+    values, log_probs, entropies = (torch.rand((40, 3), dtype=torch.float64) for _ in range(3))
+    batched = reward_functions.ActorCritic(gamma=.9, alpha=.01)
+    single = reward_functions.ActorCritic(gamma=.9, alpha=.01)
+    critic, actor = batched.loss_batch(rewards, values, log_probs, entropies, lengths)
+    for j, length in enumerate(lengths):
+        expected = single.loss(rewards[:length, j], values[:length, j], log_probs[:length, j], entropies[:length, j])
+        assert torch.allclose(critic[j], expected[0]) and torch.allclose(actor[j], expected[1])
+
+
+def test_set_parameters():
+    for base in [model.Intrinsic(3, node_shape=(1, 2, 5, 5)), model.FCIntrinsic(3, node_shape=(1, 2, 4))]:
+        params = base.parameters()
+        # parameters of an instance become views of one flat buffer, as in a shared memory arena.
+        flat = torch.cat([p.detach().reshape(-1) for p in params]) * 2
+        views = [torch.nn.Parameter(v.view(p.shape)) for v, p in zip(flat.split([p.numel() for p in params]), params)]
+        instance = base.instantiate().set_parameters(views)
+        for p, q, v in zip(base.parameters(), instance.parameters(), views):
+            assert q is v and q.data_ptr() != p.data_ptr()
+            assert torch.equal(q, 2 * p)
+        history = instance.rollout(steps=2)
+        assert history.shape[1:] == base.states.shape
+
+
+def test_zero_cycle_episode():
+    # the environment steps once even when the episode is drawn with zero cycles.
+    info, scores, trajectories = exist.episode([WaterworldAgent()], [2], 0, 0)
+    assert trajectories.cycle >= 1 and trajectories.max_cycles >= trajectories.cycle
+    for agent_info in info.values():
+        assert agent_info["counts"] == len(agent_info["inst_r"]) <= trajectories.cycle
+
+
+def test_environment_cache():
+    # episodes of different lengths share one cached environment, each runs for its own number of cycles.
+    agent = WaterworldAgent()
+    _, _, first = exist.episode([agent], [2], 5, 5)
+    env = next(reversed(exist._env_cache.values()))
+    _, _, second = exist.episode([agent], [2], 3, 3)
+    assert next(reversed(exist._env_cache.values())) is env
+    assert first.cycle == 5 and second.cycle == 3
+
+
+def _evolve_gradients(bases, copies, **kwargs):
+    # runs one short local_evolve generation in process and checks every base agent returned a usable gradient.
+    q = queue.Queue()
+    exist.local_evolve(q, None, 1, bases, copies, reward_functions.ActorCritic(.96, .1), **kwargs)
+    stats, _, _ = q.get()
+    assert stats is not None
+    for a in bases:
+        assert not stats[a.id]["failure"]
+        grad = stats[a.id]["gradient"]
+        if not isinstance(grad, tuple):
+            assert torch.isfinite(grad).all() and torch.any(grad != 0)
+    return stats
+
+
+def test_local_evolve():
+    _evolve_gradients([WaterworldAgent()], [2])
+
+
+def test_local_evolve_bases():
+    # every base agent shares the episode graph, a second backward through it used to fail.
+    _evolve_gradients([WaterworldAgent(), WaterworldAgent()], [2, 2])
+
+
+def test_population_adam():
+    # every agent should follow torch Adam with its own learning rate, whatever happens to the population rows.
+    agents = [WaterworldAgent().flatten() for _ in range(4)]
+    lrs = [.01, .001, .005, .01]
+    pop = PopulationAdam(agents[0], capacity=2)
+    refs = {}
+
+    def add(a, lr):
+        p = torch.nn.Parameter(a.flat.detach().clone())
+        refs[a.id] = (p, torch.optim.Adam([p], lr=lr))
+        pop.add(a, lr)
+
+    def step(ids):
+        grads = torch.randn((len(ids), pop.size), dtype=pop.dtype)
+        pop.smooth_grad(ids, grads, keep=0.)
+        for aid, g in zip(ids, grads):
+            p, opt = refs[aid]
+            p.grad = g.clone()
+            opt.step()
+        pop.step(ids)
+        for aid in ids:
+            a = pop.agents[aid]
+            assert torch.allclose(a.flat, refs[aid][0], atol=1e-6)
+            assert a.parameters()[0].data_ptr() == pop.params[pop.rows[aid]].data_ptr()
+
+    add(agents[0], lrs[0])
+    add(agents[1], lrs[1])
+    step([agents[0].id, agents[1].id])
+    # the third agent doubles the matrices, the first two keep their gradients and moments on the new rows.
+    grad = agents[0].flat_grad.clone()
+    add(agents[2], lrs[2])
+    assert len(pop.lr) == 4
+    assert torch.equal(agents[0].flat_grad, grad)
+    step([agents[0].id, agents[1].id, agents[2].id])
+    # a removed agent's row goes to the next one, which starts with fresh moments.
+    row = pop.rows[agents[1].id]
+    pop.remove(agents[1].id)
+    assert agents[1].id not in pop
+    add(agents[3], lrs[3])
+    assert pop.rows[agents[3].id] == row
+    step([agents[3].id, agents[0].id])
+    step([agents[2].id])
+    # smoothing blends the new gradient into the one already in the row.
+    ids = [agents[0].id, agents[3].id]
+    old = torch.stack([pop.agents[aid].flat_grad.clone() for aid in ids])
+    new = torch.randn((2, pop.size), dtype=pop.dtype)
+    pop.smooth_grad(ids, new, keep=.4)
+    for i, aid in enumerate(ids):
+        assert torch.allclose(pop.agents[aid].flat_grad, .4 * old[i] + .6 * new[i], atol=1e-6)
+
+
+def test_lineage_store():
+    window = 4
+    store = LineageStore(window=window, capacity=1)
+    store.add("a")
+    store.add("b")
+    store.add("c", parents=("a", "b"))
+    assert sorted(store.parents("c")) == ["a", "b"] and store.parents("a") == []
+    assert store.children("a") == ["c"] and store.children("c") == []
+    assert store.score("c", "fitness") == 0. and np.isnan(store.mean_copies("c"))
+    # scores follow _compute_loss_values while the window fills, wraps around and holds NaN entries.
+    history = {m: [] for m in LineageStore.metrics}
+    copies = []
+    for i in range(3 * window + 1):
+        entry = {"fitness": None if i % 3 == 1 else float(np.sin(i)), "vloss": float(i),
+                 "ploss": None if i == 2 else -.5 * i}
+        copies.append(float(1 + i % 2))
+        store.append("c", copies[-1], **entry)
+        for m in LineageStore.metrics:
+            history[m].append(np.nan if entry[m] is None else entry[m])
+            assert np.isclose(store.score("c", m), _compute_loss_values(history[m], copies, window=window))
+    assert np.isclose(store.mean_copies("c"), np.mean(copies))
+    # older snapshots hold a networkx tree with parent -> child edges.
+    tree = nx.DiGraph()
+    for aid in ("p", "q"):
+        tree.add_node(aid, fitness=[1., None], copies=[2., 4.], vloss=[.5, .1], ploss=[.2, .3])
+    tree.add_edge("p", "q")
+    converted = LineageStore.from_tree(tree, window=window)
+    assert converted.parents("q") == ["p"] and converted.children("p") == ["q"]
+    assert np.isclose(converted.score("q", "fitness"), _compute_loss_values([1., np.nan], [2., 4.], window=window))
+    assert np.isclose(converted.mean_copies("p"), 3.)
+
+
+def test_arena_local_evolve():
+    # a job as the worker pool runs it, the agent lives on its parameter slot and the gradient comes back in the arena.
+    template = WaterworldAgent().flatten()
+    arena = exist.ParameterArena(template, num_slots=2, num_jobs=1, agents_per_job=1)
+    meta = arena.checkout(template, epsilon=.1)
+    grad_slot = arena.gradient_slot()
+    agent = arena.agent(template, meta)
+    assert agent.id == template.id and agent.flat.data_ptr() == arena.params[meta["slot"]].data_ptr()
+    assert torch.equal(agent.flat, template.flat)
+    stats = _evolve_gradients([agent], [2], arena=arena, grad_slot=grad_slot)
+    assert stats[agent.id]["gradient"] == (grad_slot, 0)
+    grad = arena.gradients(*stats[agent.id]["gradient"])
+    assert torch.isfinite(grad).all() and torch.any(grad != 0)
+    arena.release([meta], grad_slot)
+    assert arena.holds.sum() == 0 and arena.free_grads == [grad_slot]
+
+
 if __name__=='__main__':
     test_einsum_solution_simple()
-    test_intrinsic()
\ No newline at end of file
+    test_intrinsic()
+    test_batched_instances()
+    test_fc_batched_instances()
+    test_contraction_plans()
+    test_fused_step()
+    test_lazy_weights()
+    test_edge_list()
+    test_inference_mode()
+    test_rollout()
+    test_checkpointed_rollout()
+    test_precision_parity()
+    test_fc_weight_layouts()
+    test_low_rank_edges()
+    test_nd_edges()
+    test_symmetric_edges()
+    test_noise_streams()
+    test_shared_instances()
+    test_clone()
+    test_batched_returns()
+    test_set_parameters()
+    test_zero_cycle_episode()
+    test_environment_cache()
+    test_local_evolve()
+    test_local_evolve_bases()
+    test_population_adam()
+    test_lineage_store()
+    test_arena_local_evolve()